@@ -0,0 +1,256 @@
+import asyncio
+import selectors
+import socket
+import time
+
+# uvloop is optional. If it is installed its event loop is used, otherwise the loop comes from the current asyncio
+# event loop policy (so any other uvloop-style policy that has been installed is picked up as well)
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+
+# This class lets IRCServer run on an asyncio event loop instead of its own select() loop, without changing any of the
+# server's message handling. It stands in for the selector: it implements the parts of the selectors API that
+# IRCServer uses (register, modify, unregister, get_key, get_map and close), but rather than being polled by select(),
+# every connection registered with it is handed to the event loop as a transport driven by an IRCProtocol.
+# * The listening socket is watched with add_reader(), which calls IRCServer.accept_new_connection()
+# * Received data is passed to IRCServer.process_data() as soon as the transport delivers it
+# * Registering a connection for EVENT_WRITE schedules its queued output to be handed to the transport, which takes
+#   care of buffering it, and tells the protocol to hold back further output (flow control) when the peer is slow
+# * Removing EVENT_READ pauses reading from the transport, and so does a connection running out of message budget
+#   (see IRCServer.defer_input()) until the backlog has given it another turn
+# * The server's timer wheel is run by a single call_at() for the earliest deadline, rather than a loop callback for
+#   every timer
+class AsyncioSelector(object):
+    def __init__(self, server):
+        self.server = server
+        if uvloop:
+            self.loop = uvloop.new_event_loop()
+        else:
+            self.loop = asyncio.new_event_loop()
+
+        # Registered connections, keyed by file descriptor, in the same form the selectors module uses
+        self._fd_to_key = {}
+        self.protocols = {}
+
+        # The TimerHandle that runs the server's timers next, if one is scheduled
+        self.timer_handle = None
+
+        # The protocols that have stopped reading while their connection is in the server's backlog, and whether a
+        # pass over the backlog has been scheduled
+        self.held = {}
+        self.backlog_scheduled = False
+
+    # Run the event loop until the server is asked to terminate
+    def run(self):
+        self.loop.call_soon(self.check_terminate)
+        self.loop.run_forever()
+
+    # IRCServer is stopped by setting request_terminate, which wakes the loop up with run_commands()
+    def check_terminate(self):
+        if self.server.request_terminate:
+            self.loop.stop()
+
+    # Run the callbacks handed to IRCServer.call_from_thread(), then check whether the server has been asked to stop
+    def run_commands(self):
+        self.server.run_commands()
+        self.schedule_evictions()
+        self.check_terminate()
+
+    # Make sure the server's timers are run within delay seconds
+    def wake_up(self, delay):
+        when = self.loop.time() + delay
+        if self.timer_handle is None or when < self.timer_handle.when():
+            if self.timer_handle is not None:
+                self.timer_handle.cancel()
+            self.timer_handle = self.loop.call_at(when, self.run_timers)
+
+    # Fire the server's timers that are due, and wake up again when the next one is (checking at least every second
+    # while there are timers further away than that)
+    def run_timers(self):
+        self.timer_handle = None
+        self.server.run_timers()
+        if len(self.server.timers):
+            timeout = self.server.timers.timeout(time.monotonic(), 1)
+            self.wake_up(1 if timeout is None else timeout)
+
+    # Stop reading from a connection that has run out of message budget, and give it another turn on the next pass of
+    # the event loop
+    def hold_input(self, data):
+        protocol = self.protocols.get(data.connection.sock.fileno())
+        if protocol is not None:
+            self.held[protocol.fd] = protocol
+            protocol.set_held(True)
+        if not self.backlog_scheduled:
+            self.backlog_scheduled = True
+            self.loop.call_soon(self.run_backlog)
+
+    # One pass over the server's backlog. Every pass counts as a new tick, so each connection gets a new budget. The
+    # connections that are no longer in the backlog are read from again
+    def run_backlog(self):
+        self.backlog_scheduled = False
+        self.server.tick += 1
+        self.server.run_backlog()
+        self.schedule_evictions()
+        for fd, protocol in list(self.held.items()):
+            key = self._fd_to_key.get(fd)
+            if key is None or key.data not in self.server.backlog:
+                del self.held[fd]
+                protocol.set_held(False)
+        if self.server.backlog and not self.backlog_scheduled:
+            self.backlog_scheduled = True
+            self.loop.call_soon(self.run_backlog)
+
+    # Connections that went over their send queue limit are only disconnected once the output queued for them so far
+    # has been offered to their transports (the flushes were scheduled first, so they run first)
+    def schedule_evictions(self):
+        if self.server.slow_consumers:
+            self.loop.call_soon(self.server.evict_slow_consumers)
+
+    def get_map(self):
+        return self._fd_to_key
+
+    def get_key(self, fileobj):
+        return self._fd_to_key[fileobj.fileno()]
+
+    def register(self, fileobj, events, data=None):
+        key = selectors.SelectorKey(fileobj, fileobj.fileno(), events, data)
+        self._fd_to_key[key.fd] = key
+
+        if fileobj is self.server.server_socket:
+            self.loop.add_reader(fileobj, self.server.accept_new_connection, fileobj)
+            return key
+
+        protocol = IRCProtocol(self, key.fd)
+        self.protocols[key.fd] = protocol
+        try:
+            fileobj.getpeername()
+        except OSError:
+            # The socket is still connecting. It becomes writable once the connection has been established
+            self.loop.add_writer(fileobj, self.connection_established, fileobj, protocol)
+        else:
+            self.loop.create_task(self.loop.connect_accepted_socket(lambda: protocol, fileobj))
+        return key
+
+    def connection_established(self, sock, protocol):
+        self.loop.remove_writer(sock)
+        if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+            self.server.close_connection(sock)
+        else:
+            self.loop.create_task(self.loop.connect_accepted_socket(lambda: protocol, sock))
+
+    def modify(self, fileobj, events, data=None):
+        old_key = self._fd_to_key[fileobj.fileno()]
+        key = old_key._replace(events=events, data=data)
+        self._fd_to_key[key.fd] = key
+
+        protocol = self.protocols.get(key.fd)
+        if protocol:
+            if events & selectors.EVENT_WRITE:
+                protocol.schedule_flush()
+            if (events ^ old_key.events) & selectors.EVENT_READ:
+                protocol.set_reading(events & selectors.EVENT_READ)
+        return key
+
+    def unregister(self, fileobj):
+        key = self._fd_to_key.pop(fileobj.fileno())
+        if fileobj is self.server.server_socket:
+            self.loop.remove_reader(fileobj)
+        else:
+            self.protocols.pop(key.fd).abort()
+        return key
+
+    # Close the event loop. Like IRCServer.cleanup() does with the selectors engine, the remaining connections are not
+    # closed here: their sockets are released along with the server. Closing them would make every neighbour that is
+    # still running see a netsplit, so the two engines would leave the rest of the network in different states
+    def close(self):
+        self._fd_to_key.clear()
+        self.loop.close()
+
+
+# The asyncio protocol for a single connection with a client or server. All of the connection's state is still kept
+# in the Connection of the ConnectionData (or UserDetails/ServerDetails) registered with the AsyncioSelector; the
+# protocol only moves data between the transport and IRCServer.
+class IRCProtocol(asyncio.Protocol):
+    def __init__(self, selector, fd):
+        self.selector = selector
+        self.fd = fd
+        self.transport = None
+        self.reading = True
+        self.held = False               # True while the connection is waiting for its turn in the server's backlog
+        self.paused = False             # True while the transport has asked us to stop writing
+        self.closed = False
+        self.flush_scheduled = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.closed:
+            transport.abort()
+            return
+        if not self.reading or self.held:
+            transport.pause_reading()
+        self.flush()
+
+    def data_received(self, data):
+        key = self.selector._fd_to_key.get(self.fd)
+        if key is not None:
+            self.selector.server.process_data(key, data)
+            self.selector.schedule_evictions()
+
+    def connection_lost(self, exc):
+        key = self.selector._fd_to_key.get(self.fd)
+        if key is not None and self.selector.protocols.get(self.fd) is self:
+            self.selector.server.close_connection(key.fileobj)
+            self.selector.schedule_evictions()
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        self.flush()
+
+    def set_reading(self, reading):
+        self.reading = reading
+        self.update_transport()
+
+    def set_held(self, held):
+        self.held = held
+        self.update_transport()
+
+    def update_transport(self):
+        if self.transport is not None and not self.closed:
+            if self.reading and not self.held:
+                self.transport.resume_reading()
+            else:
+                self.transport.pause_reading()
+
+    # Output is handed to the transport once per pass of the event loop, so everything a handler queues while
+    # processing a batch of messages is written together
+    def schedule_flush(self):
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.selector.loop.call_soon(self.flush)
+
+    def flush(self):
+        self.flush_scheduled = False
+        key = self.selector._fd_to_key.get(self.fd)
+        if key is None or self.transport is None or self.paused:
+            return
+        if key.events & selectors.EVENT_WRITE:
+            write_buffer = key.data.connection.write_buffer
+            self.transport.writelines(write_buffer.pop_all())
+            self.selector.server.stop_writing(key.data)
+            # stop_writing() may have queued more output (the next part of a burst). It is handed over on the next
+            # pass, unless the transport asks us to pause first
+            if write_buffer:
+                self.schedule_flush()
+
+    def abort(self):
+        self.closed = True
+        if self.transport is not None:
+            self.transport.abort()
+        else:
+            self.selector.loop.remove_writer(self.fd)
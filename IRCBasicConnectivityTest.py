@@ -1,10 +1,12 @@
 import threading, os, re, time, sys, json, copy
 from optparse import OptionParser
+from IRCServer import server_option_parser
 
 
 class IRCBasicConnectivityTest():
     
-    def __init__(self, IRCServerModule):
+    def __init__(self, IRCServerModule, engine=None):
+        self.engine = engine
         class NewIRCServerModule(IRCServerModule):
             def __init__(self, options, run_on_localhost=False):
                 super().__init__(options, run_on_localhost)
@@ -14,15 +16,19 @@ class IRCBasicConnectivityTest():
 
 
             def process_data(self, select_key, recv_data):
-                self.recvd_messages_asdqw.append(recv_data)
+                self.recvd_messages_asdqw.append(bytes(recv_data).decode())
             
 
+            # Called from the test thread, so the message is queued by the server's own loop thread
             def write_data(self, server_name, message):
+                self.sent_messages_asdqw.append(message)
+                if server_name in self.special_map:
+                    self.call_from_thread(self.inject_data, self.special_map[server_name], message)
+
+
+            def inject_data(self, key, message):
                 try:
-                    self.sent_messages_asdqw.append(message)
-                    if server_name in self.special_map:
-                        key = self.special_map[server_name]
-                        self.sel._fd_to_key[key].data.write_buffer = message
+                    self.send_message_to_select_key(self.sel._fd_to_key[key], message)
                 except Exception as e:
                     print(e)
 
@@ -51,41 +57,7 @@ class IRCBasicConnectivityTest():
         
         ######################################################################
         # Server options
-        self.server_op = OptionParser(
-            version="0.1a",
-            description="CPSC 3600 IRC Server application")
-        self.server_op.add_option(
-            "--servername",
-            metavar="X", type="string",
-            help="The name for this server")
-        self.server_op.add_option(
-            "--port",
-            metavar="X", type="int",
-            help="The port this server listens on")
-        self.server_op.add_option(
-            "--info",
-            metavar="X", type="string",
-            help="Human readable information about this server")
-        self.server_op.add_option(
-            "--connect_to_host",
-            metavar="X", type="string",
-            help="Connect to a server running on this host")  
-        self.server_op.add_option(
-            "--connect_to_port",
-            metavar="X", type="int",
-            help="Connect to a server running on port X")  
-        self.server_op.add_option(
-            "--debug",
-            action="store_true",
-            help="print debug messages to stdout")
-        self.server_op.add_option(
-            "--verbose",
-            action="store_true",
-            help="be verbose (print some progress messages to stdout)")
-        self.server_op.add_option(
-            "--log-file",
-            metavar="X",
-            help="store log in file X")
+        self.server_op = server_option_parser()
 
         ######################################################################
         # Server options
@@ -174,6 +146,8 @@ class IRCBasicConnectivityTest():
 
     ######################################################################
     def launch_server(self, args):
+        if self.engine:
+            args += " --engine " + self.engine
         print("\nStarting " + args)
         # https://stackoverflow.com/questions/16710076/python-split-a-string-respect-and-preserve-quotes
         args = re.findall(r'(?:[^\s,"]|"(?:\\.|[^"])*")+', args)
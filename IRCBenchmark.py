@@ -0,0 +1,1131 @@
+# Benchmarks for the IRC server internals. These are not graded test cases, they are used to measure how parts
+# of the server perform and scale. Run every benchmark with:
+#   python3 IRCBenchmark.py
+# or only the benchmarks named on the command line:
+#   python3 IRCBenchmark.py framing
+
+import os
+import sys
+import gc
+import time
+import threading
+import socket
+import selectors
+import tempfile
+import tracemalloc
+from IRCServer import IRCServer, LineBuffer, OutputQueue, ConnectionData, Connection, ServerDetails, UserDetails, \
+    Channel, DEFAULT_FLOOD_RATE
+from IRCMessage import IRCMessage
+from IRCTimerWheel import TimerWheel
+from IRCUserStore import UserStore
+from IRCJournal import Journal
+from tests.support import server_options, SimulatedNetwork
+
+
+# Start an IRCServer in a background thread, the way the test launcher does
+def start_server(**kwargs):
+    server = IRCServer(server_options(**kwargs), run_on_localhost=True)
+    thread = threading.Thread(target=server.run)
+    thread.start()
+    time.sleep(0.5)
+    return server, thread
+
+
+def stop_server(server, thread):
+    server.request_terminate = True
+    thread.join()
+
+
+# Open a client connection and register it with the USER command
+def connect_client(port, nick):
+    sock = socket.create_connection(("127.0.0.1", port))
+    sock.sendall(("USER %s benchhost bench.irc :Bench User\r\n" % nick).encode())
+    return sock
+
+
+# Report the result of a single benchmark run in a consistent format
+def report(name, count, elapsed, unit="messages"):
+    rate = count / elapsed if elapsed else float("inf")
+    print("%-40s %10i %s in %8.3fs  (%12.0f %s/sec)" %
+          (name, count, unit, elapsed, rate, unit))
+
+
+######################################################################
+# Message framing
+# Feeds a stream of typical messages into a LineBuffer in fixed size chunks, the way they would arrive from recv(),
+# and measures how many complete messages per second can be pulled back out.
+
+def benchmark_framing(message_count=200000):
+    messages = [
+        ":theshire.nz USER samgamgee windows1 theshire.nz :Sam Gamgee\r\n",
+        ":frodobaggins PRIVMSG #RingBearers :I will take the Ring, though I do not know the way.\r\n",
+        ":rivendale.nz SERVER minastirith.nz 2 :Tower of Guard\r\n",
+        ":elrond PRIVMSG samgamgee :Nous n'avons pas oublié la Dernière Alliance\r\n",
+    ]
+    stream = "".join(messages[i % len(messages)] for i in range(message_count)).encode()
+
+    for chunk_size in (16, 64, 512, 2048, 8192):
+        line_buffer = LineBuffer()
+        received = 0
+        start = time.perf_counter()
+        for offset in range(0, len(stream), chunk_size):
+            line_buffer.feed(stream[offset:offset + chunk_size])
+            msg = line_buffer.readline()
+            while msg is not None:
+                received += 1
+                msg = line_buffer.readline()
+        elapsed = time.perf_counter() - start
+        assert received == message_count
+        report("framing (recv chunk %i bytes)" % chunk_size, received, elapsed)
+
+
+######################################################################
+# Idle connections
+# Connects a number of clients that register and then go quiet, and counts how many times the server's main loop
+# wakes up while nothing is happening. With sockets only registered for writing while they have output queued,
+# this should be roughly one iteration per select() timeout, no matter how many clients are connected.
+
+def benchmark_idle(client_count=2000, idle_seconds=3):
+    server, thread = start_server(port=6701)
+    clients = []
+    for i in range(client_count):
+        clients.append(connect_client(6701, "idle%i" % i))
+        # The server socket has a tiny listen backlog, so let each connection be accepted before opening the next
+        while len(server.adjacent_users) <= i:
+            time.sleep(0.001)
+    time.sleep(0.5)
+
+    before = server.loop_iterations
+    cpu_before = time.process_time()
+    time.sleep(idle_seconds)
+    iterations = server.loop_iterations - before
+    cpu = time.process_time() - cpu_before
+
+    stop_server(server, thread)
+    for sock in clients:
+        sock.close()
+    print("%-40s %10i loop iterations in %is with %i idle clients (%.3fs CPU)" %
+          ("idle", iterations, idle_seconds, client_count, cpu))
+
+
+######################################################################
+# Reconnect storm
+# Opens 5000 connections at once against a single server, as if every client had reconnected after a restart, and
+# measures how long it takes until the server has dealt with all of them. This is run with the old listen(1) and one
+# accept() per event, with the default listen backlog and accept loop, and with a limit of 1000 connections per
+# address (every connection comes from 127.0.0.1, so the rest are refused).
+
+def benchmark_accept_storm(connection_count=5000, deadline=10):
+    runs = (("listen(1), one accept per event", 6707, dict(listen_backlog=1, accept_budget=1)),
+            ("default backlog and accept loop", 6708, {}),
+            ("1000 connections per address", 6709, dict(max_connections_per_ip=1000)))
+    for label, port, options in runs:
+        server, thread = start_server(port=port, **options)
+        socks = []
+        start = time.perf_counter()
+        for i in range(connection_count):
+            sock = socket.socket()
+            sock.setblocking(False)
+            sock.connect_ex(("127.0.0.1", port))
+            socks.append(sock)
+        while server.connection_count + server.connections_refused < connection_count and \
+                time.perf_counter() - start < deadline:
+            time.sleep(0.001)
+        elapsed = time.perf_counter() - start
+        accepted, refused = server.connection_count, server.connections_refused
+        stop_server(server, thread)
+        for sock in socks:
+            sock.close()
+        print("%-40s %10i accepted, %i refused in %.3fs" % (label, accepted, refused, elapsed))
+
+# A client that never reads sits in a busy channel while another client floods it. Once the output waiting for the
+# stalled client passes the client send queue limit, the server should disconnect it (telling the rest of the channel
+# with a QUIT) rather than hold on to everything sent to the channel, and the clients that do read should still get
+# every message.
+
+def read_channel(sock, expected, results, index):
+    sock.settimeout(10)
+    partial = b""
+    count = 0
+    evicted = False
+    try:
+        while count < expected or not evicted:
+            data = sock.recv(65536)
+            if not data:
+                break
+            lines = (partial + data).split(b"\r\n")
+            partial = lines.pop()
+            for line in lines:
+                if b"Flood number" in line:
+                    count += 1
+                elif line == b":stalled QUIT :SendQ exceeded":
+                    evicted = True
+    except socket.timeout:
+        pass
+    results[index] = (count, evicted)
+
+
+def benchmark_slow_consumer(reader_count=4, message_count=50000, sendq=256 * 1024):
+    # The talker floods on purpose, so flood control is turned off
+    server, thread = start_server(port=6702, sendq_client=sendq, flood_rate=0)
+
+    stalled = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    stalled.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    stalled.connect(("127.0.0.1", 6702))
+    stalled.sendall(b"USER stalled benchhost bench.irc :Bench User\r\nJOIN #flood\r\n")
+    readers = [connect_client(6702, "reader%i" % i) for i in range(reader_count)]
+    talker = connect_client(6702, "talker")
+    for sock in readers + [talker]:
+        sock.sendall(b"JOIN #flood\r\n")
+    while len(server.channels.get("#flood", ()) and server.channels["#flood"].users) < reader_count + 2:
+        time.sleep(0.01)
+
+    results = [None] * reader_count
+    threads = [threading.Thread(target=read_channel, args=(sock, message_count, results, i))
+               for i, sock in enumerate(readers)]
+    for reader in threads:
+        reader.start()
+    text = "Flood number %%i %s\r\n" % ("x" * 180)
+    start = time.perf_counter()
+    for i in range(message_count):
+        talker.sendall(("PRIVMSG #flood :" + text % i).encode())
+    for reader in threads:
+        reader.join()
+    elapsed = time.perf_counter() - start
+
+    stop_server(server, thread)
+    for sock in readers + [talker, stalled]:
+        sock.close()
+    assert all(result == (message_count, True) for result in results), results
+    assert server.sendq_evictions == 1
+    report("flood with a stalled client", message_count * reader_count, elapsed, "deliveries")
+    print("%-40s %10i evictions, %i KiB queued at most (limit %i KiB)" %
+          ("", server.sendq_evictions, server.sendq_peak // 1024, sendq // 1024))
+
+
+######################################################################
+# Flood control fairness
+# One client pastes a flood of PRIVMSGs while pairs of well-behaved clients message each other once in a while, and
+# the time each of those messages takes to arrive is measured. This is run with flood control off (the flood is
+# handled as fast as it arrives) and on (the flooder is held to its rate, and its excess lines wait in its buffer).
+
+def flood(sock, line_count, stop, channelname="#flood"):
+    line = ("PRIVMSG %s :%s\r\n" % (channelname, "x" * 100)).encode()
+    try:
+        for i in range(0, line_count, 100):
+            if stop.is_set():
+                break
+            sock.sendall(line * 100)
+    except OSError:
+        pass
+
+
+def receive_pings(sock, expected, latencies):
+    sock.settimeout(30)
+    partial = b""
+    try:
+        while len(latencies) < expected:
+            data = sock.recv(65536)
+            if not data:
+                break
+            lines = (partial + data).split(b"\r\n")
+            partial = lines.pop()
+            for line in lines:
+                if b" :ping " in line:
+                    latencies.append(time.perf_counter() - float(line.rsplit(b" ", 1)[1]))
+    except socket.timeout:
+        pass
+
+
+def benchmark_flood(pair_count=4, ping_count=50, flood_lines=500000):
+    for port, flood_rate in ((6703, 0), (6704, DEFAULT_FLOOD_RATE)):
+        server, thread = start_server(port=port, flood_rate=flood_rate)
+        flooder = connect_client(port, "flooder")
+        flooder.sendall(b"JOIN #flood\r\n")
+        senders = [connect_client(port, "sender%i" % i) for i in range(pair_count)]
+        receivers = [connect_client(port, "receiver%i" % i) for i in range(pair_count)]
+        while len(server.adjacent_users) < 2 * pair_count + 1:
+            time.sleep(0.01)
+
+        stop = threading.Event()
+        flooding = threading.Thread(target=flood, args=(flooder, flood_lines, stop))
+        flooding.start()
+        time.sleep(0.5)
+
+        latencies = [[] for i in range(pair_count)]
+        threads = [threading.Thread(target=receive_pings, args=(sock, ping_count, latencies[i]))
+                   for i, sock in enumerate(receivers)]
+        for receiving in threads:
+            receiving.start()
+        for n in range(ping_count):
+            for i, sock in enumerate(senders):
+                sock.sendall(("PRIVMSG receiver%i :ping %r\r\n" % (i, time.perf_counter())).encode())
+            time.sleep(0.02)
+        for receiving in threads:
+            receiving.join()
+        stop.set()
+
+        stop_server(server, thread)
+        # The flooder may be blocked sending to a server that is no longer reading
+        flooder.shutdown(socket.SHUT_RDWR)
+        flooding.join()
+        for sock in senders + receivers + [flooder]:
+            sock.close()
+        latencies = sorted(latency for pair in latencies for latency in pair)
+        assert len(latencies) == pair_count * ping_count
+        print("%-40s %10.2f ms median, %.2f ms 99th percentile latency" %
+              ("flood control %s" % ("on" if flood_rate else "off"), latencies[len(latencies) // 2] * 1000,
+               latencies[len(latencies) * 99 // 100] * 1000))
+
+
+######################################################################
+# Fairness budgets
+# A bulk sender pastes PRIVMSGs into a channel as fast as it can, a client in the channel reads them all, and pairs of
+# other clients message each other while it does, as in the flood control benchmark (with flood control off, so
+# only the budgets hold the bulk sender back). It is run once with the server reading and handling each socket the
+# way it used to (one 2 KiB recv() per event, every message in it handled at once), and once with the default read
+# and message budgets, measuring the bulk sender's throughput and everyone else's latency.
+
+def count_lines(sock, expected, marker, counts, index):
+    sock.settimeout(30)
+    partial = b""
+    count = 0
+    try:
+        while count < expected:
+            data = sock.recv(65536)
+            if not data:
+                break
+            lines = (partial + data).split(b"\r\n")
+            partial = lines.pop()
+            count += sum(1 for line in lines if marker in line)
+    except socket.timeout:
+        pass
+    counts[index] = count
+
+
+def benchmark_budgets(pair_count=4, ping_count=50, bulk_lines=200000):
+    runs = (("one recv per event", 6705, dict(read_budget=2048, message_budget=10 ** 9)),
+            ("default budgets", 6706, {}))
+    for label, port, budgets in runs:
+        server, thread = start_server(port=port, flood_rate=0, **budgets)
+        bulk = connect_client(port, "bulk")
+        sink = connect_client(port, "sink")
+        for sock in (bulk, sink):
+            sock.sendall(b"JOIN #bulk\r\n")
+        senders = [connect_client(port, "sender%i" % i) for i in range(pair_count)]
+        receivers = [connect_client(port, "receiver%i" % i) for i in range(pair_count)]
+        while len(server.adjacent_users) < 2 * pair_count + 2 or len(server.channels.get("#bulk", ())
+                                                                       and server.channels["#bulk"].users) < 2:
+            time.sleep(0.01)
+
+        counts = [0]
+        sinking = threading.Thread(target=count_lines, args=(sink, bulk_lines, b" PRIVMSG #bulk ", counts, 0))
+        sinking.start()
+        latencies = [[] for i in range(pair_count)]
+        threads = [threading.Thread(target=receive_pings, args=(sock, ping_count, latencies[i]))
+                   for i, sock in enumerate(receivers)]
+        for receiving in threads:
+            receiving.start()
+        start = time.perf_counter()
+        sending = threading.Thread(target=flood, args=(bulk, bulk_lines, threading.Event(), "#bulk"))
+        sending.start()
+        for n in range(ping_count):
+            for i, sock in enumerate(senders):
+                sock.sendall(("PRIVMSG receiver%i :ping %r\r\n" % (i, time.perf_counter())).encode())
+            time.sleep(0.02)
+        for receiving in threads:
+            receiving.join()
+        sinking.join()
+        elapsed = time.perf_counter() - start
+        sending.join()
+
+        stop_server(server, thread)
+        for sock in senders + receivers + [bulk, sink]:
+            sock.close()
+        assert counts[0] == bulk_lines
+        latencies = sorted(latency for pair in latencies for latency in pair)
+        assert len(latencies) == pair_count * ping_count
+        report("bulk sender, %s" % label, bulk_lines, elapsed)
+        print("%-40s %10.2f ms median, %.2f ms 99th percentile latency" %
+              ("", latencies[len(latencies) // 2] * 1000, latencies[len(latencies) * 99 // 100] * 1000))
+
+
+######################################################################
+# Broadcast fan-out
+# Broadcasts channel-sized messages to a mesh of adjacent servers (without sockets, so only the queueing work is
+# measured), first encoding the message separately for every server, and then through broadcast_message_to_servers(),
+# which encodes once and shares the bytes between every write buffer.
+
+def add_fake_servers(server, count):
+    for i in range(count):
+        data = ServerDetails()
+        data.connection = Connection()
+        data.servername = "leaf%i.irc" % i
+        data.hopcount = "1"
+        data.first_link = data.servername
+        server.add_server(data)
+        server.adjacent_servers.append(data.servername)
+
+
+def benchmark_fanout(message_count=100000, server_count=8):
+    message = ":frodobaggins PRIVMSG #RingBearers :" + "I will take the Ring, though I do not know the way. " * 4 + "\r\n"
+
+    server = IRCServer(server_options())
+    add_fake_servers(server, server_count)
+    start = time.perf_counter()
+    for i in range(message_count):
+        for name in server.adjacent_servers:
+            server.queue_message(server.servers_lookuptable[name], message)
+    report("fan-out, encode per server", message_count * server_count, time.perf_counter() - start)
+
+    server = IRCServer(server_options())
+    add_fake_servers(server, server_count)
+    start = time.perf_counter()
+    for i in range(message_count):
+        server.broadcast_message_to_servers(message)
+    report("fan-out, encode once", message_count * server_count, time.perf_counter() - start)
+
+
+######################################################################
+# Message parsing
+# Compares the IRCMessage codec against the parser that used to live in IRCServer.process_data (kept here, unchanged,
+# as legacy_parse so the two can be compared).
+
+def legacy_parse(msg):
+    prefix = None
+    command = None
+    params = None
+
+    parsed_msg = msg.split(" ")
+    if ":" in parsed_msg[0]:
+        start = 2
+        command = parsed_msg[1]
+        o_prefix = parsed_msg[0]
+        prefix = ""
+        for c in o_prefix:
+            if not c == ':':
+                prefix += c
+    else:
+        start = 1
+        command = parsed_msg[0]
+
+    if len(parsed_msg) > start:
+        params = []
+
+    is_trail = False
+    trail = None
+    index = 1
+    for part in parsed_msg:
+        if index > start:
+            if is_trail:
+                trail += " "
+            elif part[0] == ":":
+                is_trail = True
+                trail = part[1:]
+            else:
+                params.append(part)
+        index += 1
+    if trail:
+        params.append(trail)
+    return prefix, command, params
+
+
+def benchmark_codec(message_count=300000):
+    messages = [
+        ":theshire.nz USER samgamgee windows1 theshire.nz :Sam Gamgee",
+        ":frodobaggins PRIVMSG #RingBearers :I will take the Ring, though I do not know the way.",
+        ":rivendale.nz SERVER minastirith.nz 2 :Tower of Guard",
+        "JOIN #TheFellowship fubar",
+        "QUIT",
+    ]
+    lines = [messages[i % len(messages)] for i in range(message_count)]
+
+    start = time.perf_counter()
+    for line in lines:
+        legacy_parse(line)
+    report("parse, legacy process_data", message_count, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for line in lines:
+        IRCMessage.parse(line).handler_params()
+    report("parse, IRCMessage", message_count, time.perf_counter() - start)
+
+    # Relaying: parse, re-prefix and serialize
+    start = time.perf_counter()
+    for line in lines:
+        msg = IRCMessage.parse(line)
+        IRCMessage(msg.command, msg.params, msg.trailing, "bench.irc").serialize()
+    report("parse + serialize, IRCMessage", message_count, time.perf_counter() - start)
+
+
+######################################################################
+# User registration
+# Registers users through handle_user_message(), as if they had been announced by a neighbouring server. Every
+# registration checks for a nick collision, which is a single lookup in the case insensitive nick index.
+
+def benchmark_registration(user_count=100000):
+    server = IRCServer(server_options())
+    # The connection the USER messages arrive on. It has no socket, so replies just accumulate in its write buffer
+    link = selectors.SelectorKey(None, -1, selectors.EVENT_READ, ServerDetails())
+    link.data.connection = Connection()
+    start = time.perf_counter()
+    for i in range(user_count):
+        server.handle_user_message(link, "leaf.irc", "USER", ["User%i" % i, "host%i" % i, "leaf.irc", "Bench User"])
+    report("USER registrations", user_count, time.perf_counter() - start, "users")
+
+    # Every one of these collides with an existing user, differing only by case
+    start = time.perf_counter()
+    for i in range(user_count):
+        server.handle_user_message(link, "leaf.irc", "USER", ["uSER%i" % i, "host%i" % i, "leaf.irc", "Bench User"])
+    report("USER collisions", user_count, time.perf_counter() - start, "users")
+    assert len(server.users_lookuptable) == user_count
+
+
+######################################################################
+# Membership
+# Joins and then removes every member of a channel through Channel.add_nick() and users.remove(), and quits every
+# user directly connected to a server through handle_quit_message(), at several sizes. Each operation is a single
+# lookup in an OrderedSet, so the rate should stay flat as the number of members grows. The same channel operations on
+# a plain list are timed for comparison at the smaller sizes (at 100k members they would take minutes).
+
+def benchmark_membership(sizes=(1000, 10000, 100000)):
+    for size in sizes:
+        nicks = ["member%i" % i for i in range(size)]
+
+        channel = Channel()
+        start = time.perf_counter()
+        for nick in nicks:
+            channel.add_nick(nick)
+        report("channel join (%i members)" % size, size, time.perf_counter() - start, "joins")
+        assert len(channel.users) == size
+
+        start = time.perf_counter()
+        for nick in nicks:
+            channel.users.remove(nick)
+        report("channel part (%i members)" % size, size, time.perf_counter() - start, "parts")
+
+        if size <= 10000:
+            users = []
+            start = time.perf_counter()
+            for nick in nicks:
+                if nick not in users:
+                    users.append(nick)
+            for nick in nicks:
+                users.remove(nick)
+            report("list join + part (%i members)" % size, size * 2, time.perf_counter() - start, "ops")
+
+        server = IRCServer(server_options())
+        keys = []
+        for nick in nicks:
+            user = UserDetails()
+            user.connection = Connection()
+            user.nick = nick
+            user.first_link = server.servername
+            server.add_user(user)
+            server.adjacent_users.append(nick)
+            keys.append(selectors.SelectorKey(None, -1, selectors.EVENT_READ, user))
+        start = time.perf_counter()
+        for key in keys:
+            server.handle_quit_message(key, None, "QUIT", None)
+        report("local QUIT (%i users)" % size, size, time.perf_counter() - start, "quits")
+        assert not server.adjacent_users
+
+
+######################################################################
+# Routing
+# Sends messages to users through send_message_to_client(). Half of the users are connected to the server, and the
+# rest are spread across remote servers behind a handful of adjacent ones. Every delivery is a lookup in the routing
+# table followed by an append to the next hop's write buffer.
+
+def benchmark_routing(user_count=100000, message_count=1000000, server_count=8):
+    server = IRCServer(server_options())
+    add_fake_servers(server, server_count)
+    for i in range(server_count):
+        remote = ServerDetails()
+        remote.servername = "remote%i.irc" % i
+        remote.hopcount = "2"
+        remote.first_link = "leaf%i.irc" % i
+        server.add_server(remote)
+
+    nicks = []
+    for i in range(user_count):
+        user = UserDetails()
+        user.nick = "user%i" % i
+        if i % 2:
+            user.first_link = "leaf%i.irc" % (i % server_count)
+        else:
+            user.connection = Connection()
+            user.first_link = server.servername
+            server.adjacent_users.append(user.nick)
+        server.add_user(user)
+        nicks.append(user.nick)
+
+    message = b":frodobaggins PRIVMSG samgamgee :I will take the Ring, though I do not know the way.\r\n"
+    start = time.perf_counter()
+    for i in range(message_count):
+        server.send_message_to_client(nicks[i % user_count], message)
+    report("send_message_to_client", message_count, time.perf_counter() - start)
+
+
+######################################################################
+# Netsplit
+# Puts a number of remote users (and a few remote servers) behind one adjacent server, with more adjacent servers on
+# the other side, and times netsplit() removing everything behind the lost link and queueing the QUIT/SQUIT batch for
+# the remaining servers.
+
+def benchmark_netsplit(user_count=50000, server_count=16, neighbour_count=4):
+    server = IRCServer(server_options())
+    add_fake_servers(server, neighbour_count + 1)
+    lost = "leaf0.irc"
+    for i in range(server_count):
+        remote = ServerDetails()
+        remote.servername = "remote%i.irc" % i
+        remote.hopcount = "2"
+        remote.first_link = lost
+        server.add_server(remote)
+    for i in range(user_count):
+        user = UserDetails()
+        user.nick = "user%i" % i
+        user.servername = "remote%i.irc" % (i % server_count)
+        user.first_link = lost
+        server.add_user(user)
+
+    start = time.perf_counter()
+    server.netsplit(lost)
+    report("netsplit cleanup", user_count, time.perf_counter() - start, "users")
+    assert not server.users_lookuptable and not server.user_routes
+    assert len(server.servers_lookuptable) == neighbour_count
+
+
+######################################################################
+# Channel membership cleanup
+# Spreads users over a large number of channels through handle_join_message() (as remote joins relayed by a
+# neighbouring server), then quits every user with a goodbye message. Each QUIT only visits the channels the user was
+# in (through user_channels), and the channels are reclaimed as they empty.
+
+def benchmark_channels(user_count=20000, channel_count=50000, channels_per_user=10):
+    server = IRCServer(server_options())
+    add_fake_servers(server, 1)
+    link = selectors.SelectorKey(None, -1, selectors.EVENT_READ, server.servers_lookuptable["leaf0.irc"])
+    for i in range(user_count):
+        server.handle_user_message(link, "leaf0.irc", "USER", ["user%i" % i, "host", "leaf0.irc", "Bench User"])
+
+    start = time.perf_counter()
+    for i in range(user_count):
+        for j in range(channels_per_user):
+            channelname = "#channel%i" % ((i * channels_per_user + j) % channel_count)
+            server.handle_join_message(link, "user%i" % i, "JOIN", [channelname])
+    report("JOIN (%i channels)" % channel_count, user_count * channels_per_user, time.perf_counter() - start, "joins")
+
+    start = time.perf_counter()
+    for i in range(user_count):
+        server.handle_quit_message(link, "user%i" % i, "QUIT", ["Gone fishing"])
+    report("QUIT with %i channels each" % channels_per_user, user_count, time.perf_counter() - start, "quits")
+    assert not server.channels and not server.user_channels
+
+
+######################################################################
+# Simulated networks
+# The benchmarks below run whole networks of servers in-process, with the SimulatedNetwork from tests/support.py.
+
+# Builds a tree of server_count servers, each with up to fanout children, and puts the members of one channel on just
+# two leaves. Every channel PRIVMSG should only cross the links on the path between those two leaves, where flooding
+# it to every server would cross all server_count - 1 links.
+def benchmark_channel_routing(server_count=64, fanout=4, message_count=2000):
+    network = SimulatedNetwork()
+    for i in range(server_count):
+        network.add_server("server%i.irc" % i, "server%i.irc" % ((i - 1) // fanout) if i else None)
+
+    for i in range(server_count):
+        network.add_client("server%i.irc" % i, "user%i" % i)
+    first, last = server_count // fanout, server_count - 1
+    for i in (first, last):
+        network.send("user%i" % i, "JOIN #routed")
+    # Everyone else is in a different channel, so the servers have traffic to ignore
+    for i in range(server_count):
+        if i not in (first, last):
+            network.send("user%i" % i, "JOIN #elsewhere")
+
+    hops = 0
+    a, b = first, last
+    while a != b:
+        if a > b:
+            a = (a - 1) // fanout
+        else:
+            b = (b - 1) // fanout
+        hops += 1
+
+    network.link_messages = 0
+    start = time.perf_counter()
+    for i in range(message_count):
+        network.send("user%i" % first, "PRIVMSG #routed :Message number %i" % i)
+    elapsed = time.perf_counter() - start
+    received = [line for line in network.received["user%i" % last] if "#routed :Message number" in line]
+    assert len(received) == message_count
+    assert not any("#routed :Message number" in line for nick, lines in network.received.items()
+                   if nick != "user%i" % last for line in lines)
+    report("channel PRIVMSG, %i-server tree" % server_count, message_count, elapsed)
+    print("%-40s %10.1f link messages per PRIVMSG (path length %i, flooding would be %i)" %
+          ("", network.link_messages / message_count, hops, server_count - 1))
+
+
+# Sends one PRIVMSG addressed to announce_count nicks, all behind the sender's single uplink, spread over the leaves
+# below it. The text should cross the uplink once (or a few times, if the target list has to be split to respect
+# MAX_LINE_LENGTH) instead of once per nick.
+def benchmark_multi_target(announce_count=500, leaf_count=4, message_count=200):
+    network = SimulatedNetwork()
+    network.add_server("hub.irc")
+    network.add_server("uplink.irc", "hub.irc")
+    for i in range(leaf_count):
+        network.add_server("leaf%i.irc" % i, "uplink.irc")
+    network.add_client("hub.irc", "announcer")
+    # Short nicks, so the announcer's own message (with every nick in it) fits in MAX_LINE_LENGTH
+    nicks = ["n%i" % i for i in range(announce_count)]
+    for i, nick in enumerate(nicks):
+        network.add_client("leaf%i.irc" % (i % leaf_count), nick)
+
+    receivers = ",".join(nicks)
+    network.link_messages = 0
+    start = time.perf_counter()
+    for i in range(message_count):
+        network.send("announcer", "PRIVMSG %s :Announcement number %i" % (receivers, i))
+    elapsed = time.perf_counter() - start
+    for nick in nicks:
+        assert len([line for line in network.received[nick] if "Announcement number" in line]) == message_count
+    report("PRIVMSG to %i nicks" % announce_count, message_count * announce_count, elapsed, "deliveries")
+    print("%-40s %10.1f link messages per PRIVMSG (%i links, %i without grouping by next hop)" %
+          ("", network.link_messages / message_count, leaf_count + 1, announce_count * 2))
+
+
+
+# Links a new server to a hub that already knows user_count users spread over channel_count channels, and measures how
+# long the new server takes to learn the network from the hub's burst. The burst is streamed, so the hub never has
+# much more than BURST_HIGH_WATER bytes of it queued at once.
+# The link time includes the hub building the burst and the SimulatedNetwork moving it, so the receiving side is then
+# timed on its own, like for like: the same state is handed to a server as the hub's burst, and as it would arrive
+# unbatched (a USER message per user and a JOIN message per channel membership, each handled one at a time). Either
+# way the server passes what it learns on to one more adjacent server, as a server in the middle of a network would.
+
+# A server that has just accepted a link from hub.irc, and has one other adjacent server (leaf0.irc). Returns the
+# server, the key of the hub's link and the leaf's ServerDetails
+def burst_receiver(servername):
+    server = IRCServer(server_options(servername=servername))
+    add_fake_servers(server, 1)
+    sock, peer = socket.socketpair()
+    data = ServerDetails()
+    data.connection = Connection(sock)
+    data.servername = data.first_link = "hub.irc"
+    server.add_server(data)
+    server.adjacent_servers.append(data.servername)
+    link = server.sel.register(sock, selectors.EVENT_READ, data)
+    return server, link, server.servers_lookuptable["leaf0.irc"], peer
+
+
+# Hand payload to the server as if it had arrived on link, and pass on everything the server sends to the leaf (the
+# leaf's output is thrown away, and a burst streamed to it is carried on as its output drains)
+def receive(server, link, leaf, payload):
+    server.process_data(link, payload)
+    while server.backlog:
+        server.tick += 1
+        server.run_backlog()
+    forwarded = 0
+    while True:
+        forwarded += sum(len(chunk) for chunk in leaf.connection.write_buffer.pop_all())
+        if leaf.outgoing_burst is None:
+            return forwarded
+        server.continue_burst(leaf)
+
+
+def benchmark_burst(user_count=100000, channel_count=20000, channels_per_user=2):
+    network = SimulatedNetwork()
+    hub = network.add_server("hub.irc")
+    for i in range(user_count):
+        user = UserDetails()
+        user.nick = "user%i" % i
+        user.hostname = "host"
+        user.servername = "hub.irc"
+        user.realname = "Bench User"
+        user.first_link = "hub.irc"
+        hub.add_user(user)
+    for i in range(channel_count):
+        channel = Channel()
+        channel.channelname = "#channel%i" % i
+        channel.topic = "Topic number %i" % i
+        hub.add_channel(channel)
+    memberships = 0
+    for i in range(user_count):
+        for j in range(channels_per_user):
+            hub.add_channel_member(hub.channels["#channel%i" % ((i * channels_per_user + j) % channel_count)],
+                                   "user%i" % i)
+            memberships += 1
+
+    network.link_messages = 0
+    network.largest_write = 0
+    start = time.perf_counter()
+    linked = network.add_server("linked.irc", "hub.irc")
+    elapsed = time.perf_counter() - start
+    assert len(linked.users_lookuptable) == user_count and len(linked.channels) == channel_count
+    assert sum(len(channel.users) for channel in linked.channels.values()) == memberships
+    report("link (%i users, %i channels)" % (user_count, channel_count), network.link_messages, elapsed)
+    burst = list(hub.network_burst("receiver.irc"))
+    print("%-40s %10i KiB queued at most (%i KiB in the whole burst)" %
+          ("", network.largest_write // 1024, sum(len(line) for line in burst) // 1024))
+    network.close()
+
+    unbatched = [IRCMessage("USER", [user.nick, user.hostname, user.servername], user.realname,
+                            prefix="hub.irc").serialize() for user in hub.users_lookuptable.values()]
+    unbatched += [IRCMessage("JOIN", [channel.channelname], prefix=nick).serialize()
+                  for channel in hub.channels.values() for nick in channel.users]
+    times = []
+    for label, lines in (("receive the burst", burst), ("receive unbatched USER and JOIN", unbatched)):
+        server, link, leaf, peer = burst_receiver("receiver.irc")
+        start = time.perf_counter()
+        forwarded = receive(server, link, leaf, b"".join(lines))
+        elapsed = time.perf_counter() - start
+        assert len(server.users_lookuptable) == user_count and len(server.channels) == channel_count
+        assert sum(len(channel.users) for channel in server.channels.values()) == memberships
+        report(label, len(lines), elapsed)
+        print("%-40s %10i KiB passed on to the next server" % ("", forwarded // 1024))
+        times.append(elapsed)
+        link.fileobj.close()
+        peer.close()
+    print("%-40s %10.2fx faster, %i link messages (%i unbatched)" %
+          ("burst", times[1] / times[0], len(burst), len(unbatched)))
+
+
+######################################################################
+# Timers
+# Every connection has a timer pending, and a busy client's keepalive is pushed back all the time. This schedules a
+# timer for each of 100k connections, cancels and reschedules every one of them, and fires them all. Then a server
+# with 100k quiet connections runs their keepalives, which each send a PING.
+
+def benchmark_timers(connection_count=100000):
+    wheel = TimerWheel()
+    fired = []
+    start = time.perf_counter()
+    timers = [wheel.schedule(60 + i % 60, fired.append, i) for i in range(connection_count)]
+    report("schedule", connection_count, time.perf_counter() - start, "timers")
+    start = time.perf_counter()
+    for i, timer in enumerate(timers):
+        wheel.cancel(timer)
+        timers[i] = wheel.schedule(i % 60, fired.append, i)
+    report("cancel and reschedule", connection_count, time.perf_counter() - start, "timers")
+    start = time.perf_counter()
+    wheel.advance(time.monotonic() + 61)
+    report("fire", len(fired), time.perf_counter() - start, "timers")
+    assert len(fired) == connection_count and not len(wheel)
+
+    server = IRCServer(server_options(servername="timers.irc", ping_interval=1))
+    connections = []
+    for i in range(connection_count):
+        data = UserDetails()
+        data.connection = Connection()
+        data.nick = "user%i" % i
+        server.schedule_timer(0, server.check_keepalive, data)
+        connections.append(data)
+    start = time.perf_counter()
+    server.timers.advance(time.monotonic() + 1)
+    report("keepalive PINGs", connection_count, time.perf_counter() - start, "connections")
+    assert all(data.connection.ping_sent is not None and data.write_buffer for data in connections)
+    assert len(server.timers) == connection_count
+
+
+######################################################################
+# Shutdown
+# Starts a network of 100 servers, each linked to the one before it, and measures how long it takes to stop them all
+# the way the test launcher does: request_terminate is set on every server, and then every thread is joined. Each
+# server's loop is woken up as soon as request_terminate is set, rather than noticing it the next time select() times
+# out. A message is also handed to the first server from this thread with call_from_thread(), and timed until it has
+# been relayed to the last one.
+
+def benchmark_shutdown(server_count=100):
+    for engine, base_port in (("selectors", 6800), ("asyncio", 6900)):
+        servers = []
+        for i in range(server_count):
+            if i:
+                options = dict(connect_to_host="127.0.0.1", connect_to_port=base_port + i - 1)
+            else:
+                options = {}
+            server = IRCServer(server_options(servername="server%i.irc" % i, port=base_port + i, engine=engine,
+                                              **options), run_on_localhost=True)
+            thread = threading.Thread(target=server.run)
+            thread.start()
+            servers.append((server, thread))
+            while not server.server_socket:
+                time.sleep(0.001)
+        first, last = servers[0][0], servers[-1][0]
+        while len(first.servers_lookuptable) < server_count - 1 or len(last.servers_lookuptable) < server_count - 1:
+            time.sleep(0.01)
+
+        user = UserDetails()
+        user.nick, user.hostname, user.servername, user.realname = "injected", "host", "server0.irc", "Bench User"
+        user.first_link = "server0.irc"
+        message = IRCMessage("USER", [user.nick, user.hostname, user.servername], user.realname, prefix="server0.irc")
+        start = time.perf_counter()
+        first.call_from_thread(first.add_user, user)
+        first.call_from_thread(first.broadcast_message_to_servers, message.serialize())
+        while "injected" not in last.users_lookuptable:
+            time.sleep(0.0001)
+        print("%-40s %10.1f ms to reach the last of %i servers (%s)" %
+              ("injected message", (time.perf_counter() - start) * 1000, server_count, engine))
+
+        start = time.perf_counter()
+        for server, thread in servers:
+            server.request_terminate = True
+        for server, thread in servers:
+            thread.join()
+        print("%-40s %10.1f ms to stop %i servers (%s)" %
+              ("shutdown", (time.perf_counter() - start) * 1000, server_count, engine))
+
+
+######################################################################
+# Memory
+# Measures, with tracemalloc, how much memory a server holds for every user it knows about, with each of the two user
+# stores. The users are announced by an adjacent server with USER messages parsed from the wire format, so every name
+# arrives as a new string the way it would from a socket, and the hostnames and servernames repeat the way they do on a
+# real network. Only adjacent users have a Connection (with the buffers), so with the dictionary store a remote user is
+# its UserDetails, its strings and its entries in the lookup tables; the columnar store (UserStore) keeps no objects
+# for remote users at all.
+# users_lookuptable is then measured on its own (the nicks are shared with the server's other tables, so they are
+# left out), as a dictionary of UserDetails, as a UserStore, and as a dictionary of user objects in the layout they had
+# before: an instance __dict__, and a read and write buffer for every user.
+
+class DictUserDetails(object):
+    def __init__(self):
+        self.read_buffer = LineBuffer()
+        self.write_buffer = OutputQueue()
+        self.sock = None
+        self.writing = False
+        self.reading = True
+        self.flood = None
+        self.timer = None
+        self.tick = -1
+        self.budget = 0
+        self.address = None
+        self.last_active = 0.0
+        self.ping_sent = None
+        self.rtt = None
+        self.nick = None
+        self.hostname = None
+        self.servername = None
+        self.realname = None
+        self.first_link = None
+
+
+# The number of bytes allocated (and still held) while calling build(), which returns what it built
+def traced_memory(build):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return used, result
+
+
+def benchmark_memory(sizes=(100000, 1000000), host_count=1000, server_count=8):
+    for user_count in sizes:
+        for user_store in ("dict", "columnar"):
+            server = IRCServer(server_options(user_store=user_store))
+            add_fake_servers(server, 1)
+            for i in range(server_count):
+                remote = ServerDetails()
+                remote.servername = "remote%i.irc" % i
+                remote.hopcount = "2"
+                remote.first_link = "leaf0.irc"
+                server.add_server(remote)
+            link = selectors.SelectorKey(None, -1, selectors.EVENT_READ, server.servers_lookuptable["leaf0.irc"])
+
+            def register():
+                for i in range(user_count):
+                    msg = IRCMessage.parse(":leaf0.irc USER user%i host%i.example.com remote%i.irc :Bench User %i" %
+                                           (i, i % host_count, i % server_count, i))
+                    server.handle_user_message(link, msg.prefix, msg.command, msg.handler_params())
+
+            start = time.perf_counter()
+            used, _ = traced_memory(register)
+            elapsed = time.perf_counter() - start
+            assert len(server.users_lookuptable) == user_count
+            print("%-40s %10.1f MiB, %i bytes per user (%.1f s)" %
+                  ("%i remote users (%s)" % (user_count, user_store), used / 2 ** 20, used // user_count, elapsed))
+            del server, link
+
+        nicks = ["user%i" % i for i in range(user_count)]
+        tables = [("dict", dict, UserDetails),
+                  ("columnar", lambda: UserStore(IRCServer(server_options()), UserDetails), UserDetails)]
+        if user_count <= 100000:
+            tables.append(("dict, old layout", dict, DictUserDetails))
+        for name, table_class, user_class in tables:
+            def build():
+                table = table_class()
+                for i, nick in enumerate(nicks):
+                    user = user_class()
+                    user.nick = nick
+                    user.hostname = sys.intern("host%i.example.com" % (i % host_count))
+                    user.servername = sys.intern("remote%i.irc" % (i % server_count))
+                    user.realname = "Bench User %i" % i
+                    user.first_link = "leaf0.irc"
+                    table[nick] = user
+                return table
+
+            used, table = traced_memory(build)
+            print("%-40s %10i bytes per user" % ("  users_lookuptable (%s)" % name, used // user_count))
+            del table
+
+
+# A leaf linked to a hub with user_count users and channel_count channels saves a snapshot, stops, and links again
+# after a few channels have changed. With the snapshot, the relink should only carry what has changed, where linking
+# without one carries a burst describing the whole network.
+def benchmark_snapshot(user_count=100000, channel_count=200000, changed_count=10):
+    network = SimulatedNetwork()
+    hub = network.add_server("hub.irc")
+    for i in range(user_count):
+        user = UserDetails()
+        user.nick = "user%i" % i
+        user.hostname = "host"
+        user.servername = "hub.irc"
+        user.realname = "Bench User"
+        user.first_link = "hub.irc"
+        hub.add_user(user)
+    for i in range(channel_count):
+        channel = Channel()
+        channel.channelname = "#channel%i" % i
+        channel.topic = "Topic number %i" % i
+        hub.add_channel(channel)
+        hub.add_channel_member(channel, "user%i" % (i % user_count))
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "leaf.snapshot")
+    network.link_messages = 0
+    start = time.perf_counter()
+    leaf = network.add_server("leaf.irc", "hub.irc", snapshot_file=path)
+    report("link without a snapshot", network.link_messages, time.perf_counter() - start)
+    full_messages = network.link_messages
+
+    start = time.perf_counter()
+    leaf.save_snapshot(wait=True)
+    elapsed = time.perf_counter() - start
+    print("%-40s %10.3f s (%i KiB)" % ("save snapshot (%i channels)" % channel_count, elapsed,
+                                        os.path.getsize(path) // 1024))
+
+    start = time.perf_counter()
+    server = IRCServer(server_options(servername="leaf.irc", snapshot_file=path))
+    server.load_snapshot()
+    elapsed = time.perf_counter() - start
+    assert server.snapshot is not None
+    print("%-40s %10.3f s" % ("startup with the snapshot", elapsed))
+    server.snapshot.close()
+    del server
+
+    network.remove_server("leaf.irc")
+    del leaf
+    for i in range(changed_count):
+        hub.channels["#channel%i" % i].topic = "Changed topic %i" % i
+
+    network.link_messages = 0
+    start = time.perf_counter()
+    leaf = network.add_server("leaf.irc", "hub.irc", snapshot_file=path)
+    elapsed = time.perf_counter() - start
+    assert len(leaf.users_lookuptable) == user_count and len(leaf.channels) == channel_count
+    assert all(leaf.channels["#channel%i" % i].topic == "Changed topic %i" % i for i in range(changed_count))
+    report("link with a snapshot", network.link_messages, elapsed)
+    print("%-40s %10i link messages (%i without the snapshot)" % ("", network.link_messages, full_messages))
+
+    for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+    os.rmdir(directory)
+
+
+# Sends message_count channel PRIVMSGs through a server with and without a journal, to see what journaling adds to
+# handling a message. Then fills a journal made of small segments with record_count records spread over
+# channel_count channels, and queries the history of one channel by sequence number and by time.
+def benchmark_journal(message_count=20000, member_count=20, record_count=500000, channel_count=1000):
+    directory = tempfile.mkdtemp()
+    for journal_dir in (None, os.path.join(directory, "server")):
+        network = SimulatedNetwork()
+        server = network.add_server("hub.irc", journal_dir=journal_dir)
+        for i in range(member_count):
+            network.add_client("hub.irc", "user%i" % i)
+            network.send("user%i" % i, "JOIN #journaled")
+        start = time.perf_counter()
+        for i in range(message_count):
+            network.send("user0", "PRIVMSG #journaled :Message number %i" % i)
+        elapsed = time.perf_counter() - start
+        report("channel PRIVMSG, %s" % ("journaled" if journal_dir else "no journal"), message_count, elapsed)
+        if journal_dir:
+            start = time.perf_counter()
+            server.journal.close()
+            print("%-40s %10.3f s to write the rest" % ("", time.perf_counter() - start))
+
+    path = os.path.join(directory, "journal")
+    journal = Journal(path, segment_size=4 * 1024 * 1024, max_size=32 * 1024 * 1024)
+    start = time.perf_counter()
+    for i in range(record_count):
+        channelname = "#channel%i" % (i % channel_count)
+        journal.append([channelname], (":user%i PRIVMSG %s :Message number %i\r\n" % (i, channelname, i)).encode())
+    journal.sync()
+    report("journal append", record_count, time.perf_counter() - start)
+    size = sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+    print("%-40s %10i segments, %i KiB on disk (at most %i KiB)" %
+          ("", len(journal.sealed) + 1, size // 1024, 32 * 1024 + 4 * 1024))
+
+    query_count = 1000
+    last = journal.next_seq - 1
+    start = time.perf_counter()
+    for i in range(query_count):
+        history = journal.history("#channel%i" % (i % channel_count), start=last - 100 * channel_count + 1)
+    report("history, last 100 by sequence", query_count, time.perf_counter() - start)
+    assert len(history) == 100 and all(line.endswith(b"\r\n") for seq, when, line in history)
+    since = journal.sealed[len(journal.sealed) // 2].first_time
+    start = time.perf_counter()
+    for i in range(query_count):
+        history = journal.history("#CHANNEL%i" % (i % channel_count), since=since, limit=50)
+    report("history, last 50 since a time", query_count, time.perf_counter() - start)
+    assert len(history) == 50 and all(when >= since for seq, when, line in history)
+    journal.close()
+
+    start = time.perf_counter()
+    journal = Journal(path, segment_size=4 * 1024 * 1024)
+    elapsed = time.perf_counter() - start
+    assert journal.next_seq == last + 1
+    print("%-40s %10.3f s" % ("reopen (scan the last segment)", elapsed))
+    journal.close()
+
+    for root, directories, names in os.walk(directory, topdown=False):
+        for name in names:
+            os.remove(os.path.join(root, name))
+        for name in directories:
+            os.rmdir(os.path.join(root, name))
+    os.rmdir(directory)
+
+
+benchmarks = {
+    "framing": benchmark_framing,
+    "idle": benchmark_idle,
+    "accept_storm": benchmark_accept_storm,
+    "fanout": benchmark_fanout,
+    "codec": benchmark_codec,
+    "registration": benchmark_registration,
+    "membership": benchmark_membership,
+    "routing": benchmark_routing,
+    "netsplit": benchmark_netsplit,
+    "channels": benchmark_channels,
+    "channel_routing": benchmark_channel_routing,
+    "multi_target": benchmark_multi_target,
+    "burst": benchmark_burst,
+    "slow_consumer": benchmark_slow_consumer,
+    "flood": benchmark_flood,
+    "budgets": benchmark_budgets,
+    "timers": benchmark_timers,
+    "shutdown": benchmark_shutdown,
+    "memory": benchmark_memory,
+    "snapshot": benchmark_snapshot,
+    "journal": benchmark_journal,
+}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(benchmarks)
+    for name in names:
+        benchmarks[name]()
@@ -9,7 +9,8 @@ import threading
 import selectors
 import logging
 import types
-from IRCServer import Channel
+from IRCServer import Channel, LineBuffer
+from IRCMessage import IRCMessage
 
 
 class IRCClient(object):
@@ -57,14 +58,17 @@ class IRCClient(object):
         self.init_logging()
 
         # The read buffer that we write to in order to send information to the server
-        self.server_read_buffer = ""
+        self.server_read_buffer = LineBuffer()
 
         # This dictionary contains mappings from responses to response handlers.
         # Upon receiving a response X, the appropriate response handler can be called with: self.response_handlers[X](...args)
         self.response_handlers = {
             "331": self.handle_rpl_notopic,
             "332": self.handle_rpl_topic,
-            "353": self.handle_rpl_namreply
+            "353": self.handle_rpl_namreply,
+            "366": self.handle_rpl_endofnames,
+            "PART": self.handle_part,
+            "PING": self.handle_ping
         }
 
         # A list of all the messages the client has receievd and printed for the user
@@ -73,6 +77,21 @@ class IRCClient(object):
         # This can be set to True to terminate the object
         self.request_terminate = False
 
+    # Terminating the client shuts its socket down, which wakes up the thread blocked listening for server input so
+    # it can finish. Without this the thread keeps the process alive after the network has been killed
+    @property
+    def request_terminate(self):
+        return self._request_terminate
+
+    @request_terminate.setter
+    def request_terminate(self, value):
+        self._request_terminate = value
+        if value and self.client_socket is not None:
+            try:
+                self.client_socket.shutdown(SHUT_RDWR)
+            except OSError:
+                pass
+
     # DO NOT EDIT THIS METHOD
     # Setup the client and start listening for incoming messages
 
@@ -93,15 +112,20 @@ class IRCClient(object):
 
         self.client_socket = socket(AF_INET, SOCK_STREAM)
         self.client_socket.connect((self.serveraddr, int(self.serverport)))
-        message = "USER " + self.nick + " " + self.hostname + " " + self.servername + " :" + self.realname + "\r\n"
-
-        # print("This is the message: ", message)
-
-        self.client_socket.send(message.encode())
-        response = self.client_socket.recv(2048).decode()
-
-        if response:
-            self.start_listening_to_server()
+        message = IRCMessage("USER", [self.nick, self.hostname, self.servername], self.realname)
+        self.client_socket.send(message.serialize())
+
+        # The first message is the reply to our registration (RPL_WELCOME or ERR_NICKCOLLISION), which isn't shown to
+        # the user. It is framed by the same LineBuffer as everything after it, so it may take several reads to arrive,
+        # and anything that arrives with it is left in the buffer for the listener
+        reply = None
+        while reply is None:
+            response = self.client_socket.recv(2048)
+            if not response:
+                return
+            self.server_read_buffer.feed(response)
+            reply = self.server_read_buffer.readline()
+        self.start_listening_to_server()
 
     # You should call this function when you are ready to start listening for messages from the server
     # You do not need to edit this function
@@ -115,10 +139,17 @@ class IRCClient(object):
     #       Then begin processing the new message(s)
 
     def listen_for_server_input(self):
+        self.process_server_input()
         while not self.request_terminate:
-            self.server_read_buffer += self.client_socket.recv(2048).decode()
+            try:
+                data = self.client_socket.recv(2048)
+            except OSError:
+                break
+            # The server has closed the connection
+            if not data:
+                break
+            self.server_read_buffer.feed(data)
             self.process_server_input()
-            
 
 
 # This function should start the process of handling messages received by the server. You will need to
@@ -138,49 +169,26 @@ class IRCClient(object):
 # to create several methods that are called by process_data to handle each of these required effects
 
     def process_server_input(self):
-        if self.server_read_buffer:
-            msgs = self.server_read_buffer.split("\r\n")
-            # There will be an empty entry at the end, so pop it
-            msgs.pop()
-
-            for msg in msgs:
-                # Each time we loop, variables must be reset to None
-                prefix = None
-                command = None
-                params = None
-
-                # Each message needs to be split by spaces to extract parts
-                parts = msg.split(" ")
-
-                if ":" in parts[0]:
-                    start = 2
-                command = parts[1]
-                o_prefix = parts[0]
-                prefix = ""
-                for c in o_prefix:
-                    if not c == ':':
-                        prefix += c
-                else:
-                    start = 1
-                    command = parts[0]
-
-                # print("Prefix = ", prefix)
-                # print("command = ", command)
-                # print("Params = ", params)
-                if not command in self.response_handlers:
+        msg = self.server_read_buffer.readline()
+        while msg is not None:
+            if msg:
+                msg = IRCMessage.parse(msg)
+                params = msg.handler_params() or []
+                if not msg.command in self.response_handlers:
                     self.print_message_to_user(" ".join(params))
                 else:
-                    self.response_handlers[command](prefix, params)
-                    
-            self.server_read_buffer = ""
-        
-
+                    self.response_handlers[msg.command](msg.prefix, params)
+            msg = self.server_read_buffer.readline()
 
     ######################################################################
     # This function should send a message to the server
 
     def send_message_to_server(self, message):
-        self.client_socket.send(message.encode())
+        if isinstance(message, IRCMessage):
+            message = message.serialize()
+        elif isinstance(message, str):
+            message = message.encode()
+        self.client_socket.send(message)
 
     # Stores the printed messages in a list, so the testing framework can evaluate the messages received
     # You may add to this function, but make sure that you still append messages to the printed_messages list
@@ -215,11 +223,7 @@ class IRCClient(object):
     #   None
 
     def quit(self, quit_message=None):
-        if not quit_message:
-            msg = "QUIT\r\n"
-        else:
-            msg = "QUIT :" + quit_message + "\r\n"
-        self.send_message_to_server(msg)
+        self.send_message_to_server(IRCMessage("QUIT", trailing=quit_message or None))
     
 
 
@@ -240,7 +244,11 @@ class IRCClient(object):
     #   RPL_TOPIC
 
     def join(self, channel, key=None):
-        pass
+        params = [channel]
+        if key is not None:
+            params.append(key)
+        # The channel is only added to self.channels once the server confirms the join with RPL_TOPIC/RPL_NOTOPIC
+        self.send_message_to_server(IRCMessage("JOIN", params))
 
     ######################################################################
     # Part message
@@ -255,7 +263,9 @@ class IRCClient(object):
     #   ERR_NOTONCHANNEL
 
     def part(self, channel):
-        pass
+        # The channel is only removed from self.channels once the server echoes the PART back (see handle_part), so an
+        # error reply leaves it where it was
+        self.send_message_to_server(IRCMessage("PART", [channel]))
 
     ######################################################################
     # Topic message
@@ -272,9 +282,13 @@ class IRCClient(object):
     #   ERR_NOTONCHANNEL
     #   RPL_NOTOPIC
     #   RPL_TOPIC
+    # A topic with spaces in it is given in double quotes (TOPIC #RingBearers "Best uses for invisibility"), and the
+    # quotes are not part of the topic
 
     def topic(self, channel, topic=None):
-        pass
+        if topic is not None and len(topic) > 1 and topic[0] == topic[-1] == '"':
+            topic = topic[1:-1]
+        self.send_message_to_server(IRCMessage("TOPIC", [channel], topic))
 
     ######################################################################
     # Names message
@@ -288,7 +302,7 @@ class IRCClient(object):
     #   RPL_NAMREPLY
 
     def names(self, channel=None):
-        pass
+        self.send_message_to_server(IRCMessage("NAMES", [channel] if channel else None))
 
     ######################################################################
     # Private message
@@ -313,7 +327,7 @@ class IRCClient(object):
     #   RPL_AWAY
 
     def privmsg(self, receiver, message):
-        pass
+        self.send_message_to_server(IRCMessage("PRIVMSG", [receiver], message))
 
     ######################################################################
     # The remaining functions are command handlers. Each command handler is documented
@@ -323,21 +337,47 @@ class IRCClient(object):
     # the response message that was received for analysis by the testing framework.
     ######################################################################
 
+    # The server's keepalive. It is answered straight away, and isn't shown to the user
+    def handle_ping(self, prefix, params):
+        token = params[-1] if params else ""
+        self.send_message_to_server(IRCMessage("PONG", [self.nick], token))
+
+    # The server echoes our PART back once we have left the channel. It isn't shown to the user
+    def handle_part(self, prefix, params):
+        if params and prefix == self.nick:
+            self.channels.pop(params[0], None)
+
     def handle_rpl_notopic(self, prefix, params):
         self.print_message_to_user(" ".join(params))
-        # TODO: Finish updating the client state based on this message
+        self.get_channel(params[0]).topic = None
 
     def handle_rpl_topic(self, prefix, params):
         self.print_message_to_user(" ".join(params))
-        # TODO: Finish updating the client state based on this message
+        self.get_channel(params[0]).topic = params[1]
 
     def handle_rpl_namreply(self, prefix, params):
         # When working with the reply, store the list of names in the nicks variable.
         # This is required for the print_message_to_user to function as the tester expects
-        nicks = []
+        nicks = params[1].split() if len(params) > 1 else []
         self.print_message_to_user("%s %s" % (params[0], " ".join(nicks)))
 
-        # TODO: Finish updating the client state based on this message
+        if params[0] in self.channels:
+            self.channels[params[0]].users.extend(nicks)
+
+    # RPL_ENDOFNAMES names the channel the list was for (or *), but only its text is shown to the user
+    def handle_rpl_endofnames(self, prefix, params):
+        self.print_message_to_user(params[-1])
+
+    # RPL_TOPIC and RPL_NOTOPIC are only sent for channels this user is in (they are the server's reply to a JOIN or
+    # a TOPIC), so they create the channel the first time one arrives for it
+    def get_channel(self, channelname):
+        channel = self.channels.get(channelname)
+        if channel is None:
+            channel = Channel()
+            channel.channelname = channelname
+            channel.add_nick(self.nick)
+            self.channels[channelname] = channel
+        return channel
 
     ######################################################################
     # This block of functions enables logging of info, debug, and error messages
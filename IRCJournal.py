@@ -0,0 +1,508 @@
+# This module contains the journal IRCServer can keep of the messages it delivers (PRIVMSG, JOIN, PART, TOPIC and
+# QUIT), so their history can be replayed later. The journal is a directory of segments. Each segment is a log file
+# the records are appended to, named after the sequence number of its first record, and once it is full (sealed) an
+# index file next to it:
+#   log:    the records, one after the other. A record is RECORD (the length of the rest of it, its sequence number
+#           and the time it was journaled), the targets it was delivered to (a count, then each one preceded by its
+#           length) and the message itself, as it was sent
+#   index:  INDEX_HEADER (the first and last sequence numbers and times in the segment, and the number of entries),
+#           then an INDEX_ENTRY for every target of every record (a hash of the target, the record's sequence number
+#           and time, and where the record is in the log), sorted by target and then by sequence number
+# The index of a sealed segment is read through mmap, and a query for a target binary searches it for the range it
+# wants, so only the records that are asked for are read from the log. The index of the segment being written is
+# kept in memory, and written out when it is sealed. A segment left without an index (because the server stopped
+# before it was sealed) is scanned when the journal is opened again, and appended to as before.
+#
+# Records are encoded on the server's thread, and collected into batches that a thread of the journal's own writes
+# to disk, so the server never waits for the disk while it is handling messages. The batches are fsync()ed according
+# to the journal's fsync policy: after every batch (always), at most every fsync_interval seconds (interval), or
+# whenever the operating system decides to write them (never). The oldest segments are removed once the journal is
+# bigger than max_size bytes, or once their last record is older than max_age seconds.
+
+import bisect
+import collections
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+from IRCMessage import irc_lower
+
+SEGMENT_SIZE = 64 * 1024 * 1024     # A segment is sealed once its log is this big
+BATCH_SIZE = 64 * 1024              # Records are handed to the writer thread once this many bytes are waiting
+FSYNC_POLICIES = ("always", "interval", "never")
+FSYNC_INTERVAL = 1.0
+KEY_CACHE_SIZE = 65536              # The most target keys the journal remembers (see Journal.target_key())
+
+RECORD = struct.Struct("<IQd")
+LENGTH = struct.Struct("<H")
+INDEX_HEADER = struct.Struct("<QQddQ")
+INDEX_ENTRY = struct.Struct("<QQdQ")
+
+
+# The key a target is indexed under. Targets are compared without caring about case, like nicks and channel names
+def target_key(target):
+    return int.from_bytes(hashlib.blake2b(irc_lower(target).encode(), digest_size=8).digest(), "little")
+
+
+def encode_record(seq, when, targets, line):
+    parts = [LENGTH.pack(len(targets))]
+    for target in targets:
+        encoded = target.encode()
+        parts.append(LENGTH.pack(len(encoded)))
+        parts.append(encoded)
+    parts.append(line)
+    body = b"".join(parts)
+    return RECORD.pack(len(body), seq, when) + body
+
+
+# Decode the record at pos in buf. Returns (seq, time, targets, line, the position after the record), or None if the
+# record isn't all there
+def decode_record(buf, pos):
+    if pos + RECORD.size > len(buf):
+        return None
+    length, seq, when = RECORD.unpack_from(buf, pos)
+    start = pos + RECORD.size
+    end = start + length
+    if end > len(buf) or length < LENGTH.size:
+        return None
+    targets = []
+    pos = start + LENGTH.size
+    for i in range(LENGTH.unpack_from(buf, start)[0]):
+        size = LENGTH.unpack_from(buf, pos)[0]
+        pos += LENGTH.size
+        targets.append(str(buf[pos:pos + size], "utf-8"))
+        pos += size
+    return seq, when, targets, bytes(buf[pos:end]), end
+
+
+# The first of count entries for which before(i) is False, where before is True for every entry up to some point
+def lower_bound(count, before):
+    low, high = 0, count
+    while low < high:
+        middle = (low + high) // 2
+        if before(middle):
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+# One segment of the journal. The segment being written keeps its index in entries (target key -> the sequence
+# numbers, times and log offsets of its records, in arrays); a sealed one has its index file mapped into index
+class Segment(object):
+    def __init__(self, directory, first_seq):
+        self.first_seq = first_seq
+        self.log_path = os.path.join(directory, "%020i.log" % first_seq)
+        self.index_path = os.path.join(directory, "%020i.idx" % first_seq)
+        self.last_seq = first_seq - 1
+        self.first_time = None
+        self.last_time = None
+        self.size = 0           # The size of the log, counting the records the writer thread hasn't written yet
+        self.index_size = 0     # The size of the index file of a sealed segment
+        self.sealed = False
+        self.entries = {}
+        self.index = None
+        self.count = 0          # The number of entries in the index of a sealed segment
+        self.read_fd = None
+
+    # Index a record under the keys of its targets
+    def add(self, seq, when, keys, offset):
+        for key in keys:
+            entries = self.entries.get(key)
+            if entries is None:
+                entries = self.entries[key] = (array("Q"), array("d"), array("Q"))
+            entries[0].append(seq)
+            entries[1].append(when)
+            entries[2].append(offset)
+        if self.first_time is None:
+            self.first_time = when
+        self.last_seq = seq
+        self.last_time = when
+
+    # The contents of the index file for this segment
+    def encode_index(self):
+        parts = []
+        for key in sorted(self.entries):
+            seqs, times, offsets = self.entries[key]
+            for i in range(len(seqs)):
+                parts.append(INDEX_ENTRY.pack(key, seqs[i], times[i], offsets[i]))
+        header = INDEX_HEADER.pack(self.first_seq, self.last_seq, self.first_time or 0.0, self.last_time or 0.0,
+                                   len(parts))
+        return header + b"".join(parts)
+
+    # Map the index file of a sealed segment. Returns False if it isn't a complete index
+    def open_index(self):
+        try:
+            with open(self.index_path, "rb") as f:
+                index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return False
+        if len(index) < INDEX_HEADER.size:
+            index.close()
+            return False
+        first_seq, last_seq, first_time, last_time, count = INDEX_HEADER.unpack_from(index, 0)
+        if first_seq != self.first_seq or len(index) != INDEX_HEADER.size + count * INDEX_ENTRY.size:
+            index.close()
+            return False
+        self.index = index
+        self.index_size = len(index)
+        self.count = count
+        self.last_seq = last_seq
+        self.first_time = first_time
+        self.last_time = last_time
+        self.sealed = True
+        self.entries = None
+        return True
+
+    # The (seq, offset) of the records for the target with the given key whose sequence numbers are from start to end
+    # and whose times are from since to until (all inclusive, and None for no limit)
+    def find(self, key, start, end, since, until):
+        if self.sealed:
+            index = self.index
+            entry = lambda i: INDEX_ENTRY.unpack_from(index, INDEX_HEADER.size + i * INDEX_ENTRY.size)
+            if start is not None:
+                first = lower_bound(self.count, lambda i: entry(i)[:2] < (key, start))
+            elif since is not None:
+                first = lower_bound(self.count, lambda i: entry(i)[0] < key or (entry(i)[0] == key and
+                                                                                entry(i)[2] < since))
+            else:
+                first = lower_bound(self.count, lambda i: entry(i)[0] < key)
+            found = []
+            for i in range(first, self.count):
+                entry_key, seq, when, offset = entry(i)
+                if entry_key != key or (end is not None and seq > end) or (until is not None and when > until):
+                    break
+                if since is None or when >= since:
+                    found.append((seq, offset))
+            return found
+
+        entries = self.entries.get(key)
+        if entries is None:
+            return []
+        seqs, times, offsets = entries
+        if start is not None:
+            first = bisect.bisect_left(seqs, start)
+        elif since is not None:
+            first = bisect.bisect_left(times, since)
+        else:
+            first = 0
+        found = []
+        for i in range(first, len(seqs)):
+            if (end is not None and seqs[i] > end) or (until is not None and times[i] > until):
+                break
+            if since is None or times[i] >= since:
+                found.append((seqs[i], offsets[i]))
+        return found
+
+    def read(self, offset):
+        if self.read_fd is None:
+            self.read_fd = os.open(self.log_path, os.O_RDONLY)
+        header = os.pread(self.read_fd, RECORD.size, offset)
+        length = RECORD.unpack(header)[0]
+        return decode_record(header + os.pread(self.read_fd, length, offset + RECORD.size), 0)
+
+    def close(self):
+        if self.index is not None:
+            self.index.close()
+            self.index = None
+        if self.read_fd is not None:
+            os.close(self.read_fd)
+            self.read_fd = None
+
+
+# This class is the journal. append() and the queries are only called from the server's thread; the files are written
+# by the journal's writer thread, which works through the operations handed to it in queue, in order:
+#   ("append", segment, data)       write data to the end of the segment's log
+#   ("seal", segment, index)        finish the segment's log and write its index file
+#   ("remove", segment)             remove the segment's files
+#   ("stop",)                       finish the current log and stop
+# log_error is called (from the writer thread) with a message when writing fails.
+class Journal(object):
+    def __init__(self, directory, fsync="interval", max_size=None, max_age=None, segment_size=SEGMENT_SIZE,
+                 fsync_interval=FSYNC_INTERVAL, log_error=None):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError("Unknown fsync policy: %s" % fsync)
+        self.directory = directory
+        self.fsync = fsync
+        self.max_size = max_size
+        self.max_age = max_age
+        self.segment_size = segment_size
+        self.fsync_interval = fsync_interval
+        self.log_error = log_error
+
+        self.keys = {}              # target -> target_key(target), for the targets journaled lately
+        self.pending = []           # The encoded records not yet handed to the writer thread
+        self.pending_size = 0
+        self.last_time = 0.0
+
+        self.condition = threading.Condition()
+        self.queue = collections.deque()
+        self.queued = 0             # The number of operations handed to the writer thread so far
+        self.done = 0               # The number of operations the writer thread has finished
+
+        os.makedirs(directory, exist_ok=True)
+        self.sealed = []
+        self.active = None
+        self.writer = None
+        self.recover()
+        self.next_seq = self.active.last_seq + 1
+        self.prune()
+
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+
+    # Find the segments already in the directory. A segment without a (complete) index is scanned to rebuild it, and
+    # the last one is written to from where it ends; any other is sealed
+    def recover(self):
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith(".log") and name[:-4].isdigit())
+        for name in names:
+            segment = Segment(self.directory, int(name[:-4]))
+            if self.active is not None:
+                self.seal_now(self.active)
+            if segment.open_index():
+                segment.size = os.path.getsize(segment.log_path)
+            else:
+                self.scan(segment)
+            if segment.sealed:
+                self.sealed.append(segment)
+            else:
+                self.active = segment
+        if self.active is not None and self.active.size >= self.segment_size:
+            self.seal_now(self.active)
+        if self.active is None:
+            last_seq = self.sealed[-1].last_seq if self.sealed else 0
+            self.active = Segment(self.directory, last_seq + 1)
+        for segment in self.sealed + [self.active]:
+            self.last_time = max(self.last_time, segment.last_time or 0.0)
+
+    # Rebuild the index of a segment from its log. A record cut short at the end of the log is removed
+    def scan(self, segment):
+        with open(segment.log_path, "r+b") as f:
+            size = os.fstat(f.fileno()).st_size
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+            pos = 0
+            try:
+                while True:
+                    record = decode_record(buf, pos)
+                    if record is None:
+                        break
+                    seq, when, targets, line, end = record
+                    segment.add(seq, when, [self.target_key(target) for target in targets], pos)
+                    pos = end
+            finally:
+                if size:
+                    buf.close()
+            if pos != size:
+                f.truncate(pos)
+        segment.size = pos
+
+    # Seal a segment while opening the journal, before the writer thread has started
+    def seal_now(self, segment):
+        with open(segment.index_path, "wb") as f:
+            f.write(segment.encode_index())
+        segment.open_index()
+        self.sealed.append(segment)
+        self.active = None
+
+    # Journal a message (the encoded line, as it was delivered) for the given targets: the channels it was delivered
+    # to, and the nicks it was addressed to or is about. Returns the record's sequence number
+    def append(self, targets, line):
+        seq = self.next_seq
+        # Times never go backwards within the journal, so the index can be searched by time as well as by sequence
+        when = max(time.time(), self.last_time)
+        self.last_time = when
+        record = encode_record(seq, when, targets, line)
+
+        segment = self.active
+        if segment.size and segment.size + len(record) > self.segment_size:
+            self.roll()
+            segment = self.active
+        self.next_seq += 1
+        segment.add(seq, when, [self.target_key(target) for target in targets], segment.size)
+        segment.size += len(record)
+        self.pending.append(record)
+        self.pending_size += len(record)
+        if self.pending_size >= BATCH_SIZE:
+            self.flush()
+        return seq
+
+    # The same targets are journaled over and over, so their keys are remembered rather than hashed every time
+    def target_key(self, target):
+        key = self.keys.get(target)
+        if key is None:
+            if len(self.keys) >= KEY_CACHE_SIZE:
+                self.keys.clear()
+            key = self.keys[target] = target_key(target)
+        return key
+
+    # Hand the records collected so far to the writer thread
+    def flush(self):
+        if self.pending:
+            data = b"".join(self.pending)
+            self.pending = []
+            self.pending_size = 0
+            self.submit(("append", self.active, data))
+
+    def submit(self, operation):
+        with self.condition:
+            self.queue.append(operation)
+            self.queued += 1
+            self.condition.notify_all()
+
+    # Seal the segment being written and start a new one
+    def roll(self):
+        self.flush()
+        segment = self.active
+        index = segment.encode_index()
+        segment.index_size = len(index)
+        self.submit(("seal", segment, index))
+        segment.sealed = True
+        segment.entries = None
+        segment.count = None    # The index is mapped the first time it is needed (see segment_index())
+        self.sealed.append(segment)
+        self.active = Segment(self.directory, self.next_seq)
+        self.prune()
+
+    # Remove the oldest sealed segments while the journal is over max_size bytes, or they are older than max_age
+    def prune(self):
+        total = sum(segment.size + segment.index_size for segment in self.sealed) + self.active.size
+        deadline = time.time() - self.max_age if self.max_age else None
+        while self.sealed:
+            segment = self.sealed[0]
+            if not ((self.max_size and total > self.max_size) or (deadline is not None and
+                                                                  (segment.last_time or 0.0) < deadline)):
+                break
+            del self.sealed[0]
+            total -= segment.size + segment.index_size
+            segment.close()
+            if self.writer is not None:
+                self.submit(("remove", segment))
+            else:
+                self.remove_files(segment)
+
+    # Wait until the writer thread has written everything journaled so far
+    def sync(self):
+        self.flush()
+        with self.condition:
+            target = self.queued
+            while self.done < target:
+                self.condition.wait()
+
+    # The records journaled for target (a channel or nick), oldest first, as (seq, time, line) tuples. Records can be
+    # picked by sequence number (from start to end) and by time (from since to until), all inclusive; limit keeps only
+    # the most recent ones. Anything journaled but not yet written is written first
+    def history(self, target, start=None, end=None, since=None, until=None, limit=None):
+        self.sync()
+        key = target_key(target)
+        target = irc_lower(target)
+        found = []
+        for segment in self.sealed + [self.active]:
+            if (start is not None and segment.last_seq < start) or (end is not None and segment.first_seq > end):
+                continue
+            if segment.last_time is None or (since is not None and segment.last_time < since) or \
+                    (until is not None and segment.first_time > until):
+                continue
+            if segment.sealed and segment.index is None and not segment.open_index():
+                continue
+            found.extend((segment, offset) for seq, offset in segment.find(key, start, end, since, until))
+
+        history = []
+        for segment, offset in found[-limit:] if limit else found:
+            seq, when, targets, line, end_pos = segment.read(offset)
+            # Different targets can share a key, so the record is checked for the one asked for
+            if any(irc_lower(name) == target for name in targets):
+                history.append((seq, when, line))
+        return history
+
+    # Write everything that is left, and stop the writer thread
+    def close(self):
+        self.flush()
+        self.submit(("stop",))
+        self.writer.join()
+        for segment in self.sealed + [self.active]:
+            segment.close()
+
+    def remove_files(self, segment):
+        for path in (segment.log_path, segment.index_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    # The writer thread. The log being written is kept open between batches. With the interval policy, a batch that
+    # arrives within fsync_interval of the last fsync() waits for the next one (or for the interval to pass)
+    def write_loop(self):
+        fd = None
+        fd_segment = None
+        unsynced = False
+        last_sync = time.monotonic()
+        while True:
+            with self.condition:
+                while not self.queue:
+                    if unsynced and self.fsync == "interval":
+                        timeout = last_sync + self.fsync_interval - time.monotonic()
+                        if timeout <= 0:
+                            break
+                        self.condition.wait(timeout)
+                    else:
+                        self.condition.wait()
+                operations = list(self.queue)
+                self.queue.clear()
+
+            stop = False
+            for operation in operations:
+                kind, segment = operation[0], operation[1] if len(operation) > 1 else None
+                try:
+                    if kind == "append":
+                        if fd_segment is not segment:
+                            if fd is not None:
+                                os.close(fd)
+                            fd = os.open(segment.log_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+                            fd_segment = segment
+                        data = memoryview(operation[2])
+                        while data:
+                            data = data[os.write(fd, data):]
+                        unsynced = True
+                    elif kind == "seal" or kind == "stop":
+                        if fd is not None:
+                            if unsynced and self.fsync != "never":
+                                os.fsync(fd)
+                            os.close(fd)
+                            fd = fd_segment = None
+                            unsynced = False
+                            last_sync = time.monotonic()
+                        if kind == "seal":
+                            if not os.path.exists(segment.log_path):
+                                open(segment.log_path, "wb").close()
+                            with open(segment.index_path, "wb") as f:
+                                f.write(operation[2])
+                                if self.fsync != "never":
+                                    f.flush()
+                                    os.fsync(f.fileno())
+                        else:
+                            stop = True
+                    elif kind == "remove":
+                        self.remove_files(segment)
+                except OSError as e:
+                    if self.log_error is not None:
+                        self.log_error("Journal: %s failed: %s" % (kind, e))
+
+            if fd is not None and unsynced:
+                now = time.monotonic()
+                if self.fsync == "always" or (self.fsync == "interval" and now - last_sync >= self.fsync_interval):
+                    try:
+                        os.fsync(fd)
+                    except OSError as e:
+                        if self.log_error is not None:
+                            self.log_error("Journal: fsync failed: %s" % e)
+                    unsynced = False
+                    last_sync = now
+
+            with self.condition:
+                self.done += len(operations)
+                self.condition.notify_all()
+            if stop:
+                return
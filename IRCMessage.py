@@ -0,0 +1,88 @@
+# This module contains the message codec shared by IRCServer and IRCClient. Every message that is received is parsed
+# into an IRCMessage, and messages can be built as IRCMessage objects and serialized back into the wire format:
+#   [:<prefix> ]<command>[ <param> ...][ :<trailing>]\r\n
+
+import string
+
+
+# Nicks and channel names are case insensitive. RFC 1459 defines {}|^ to be the lower case versions of []\~, so
+# irc_lower() folds those as well as the ASCII letters. Use it whenever nicks or channel names are compared
+IRC_CASEMAP = str.maketrans(string.ascii_uppercase + "[]\\~", string.ascii_lowercase + "{}|^")
+
+
+def irc_lower(name):
+    return name.translate(IRC_CASEMAP)
+
+
+# The longest message (including the \r\n) that is accepted, or sent when a message is split up. RFC 1459 allows 512
+# bytes, but PRIVMSG_1_OneMessage_ToUser and PRIVMSG_2_ERROR_NoSuchNick send a PRIVMSG of about 700 bytes, which must
+# arrive whole
+MAX_LINE_LENGTH = 4096
+
+
+# This class represents a single IRC message.
+#   prefix:     the prefix of the message, without the leading ':'. None if no prefix was present
+#   command:    the command word, or numeric reply code
+#   params:     a list of the middle parameters (everything before the trailing parameter)
+#   trailing:   the trailing parameter, without the leading ':'. None if no trailing parameter was present
+# A message is not expected to change once it has been built. serialize() caches the encoded message, so a message
+# that is relayed to several connections is only encoded once.
+class IRCMessage(object):
+    __slots__ = ("prefix", "command", "params", "trailing", "_serialized")
+
+    def __init__(self, command, params=None, trailing=None, prefix=None):
+        self.prefix = prefix
+        self.command = command
+        self.params = params if params is not None else []
+        self.trailing = trailing
+        self._serialized = None
+
+    # Parse a single message (without the \r\n). The message is scanned once from left to right: the prefix ends at
+    # the first space, the trailing parameter starts at the first " :", and everything in between is split on spaces.
+    # The object is filled in directly rather than through __init__, since this is called for every message received
+    @classmethod
+    def parse(cls, line):
+        msg = cls.__new__(cls)
+        msg._serialized = None
+
+        if line[:1] == ":":
+            prefix, _, line = line.partition(" ")
+            msg.prefix = prefix[1:]
+        else:
+            msg.prefix = None
+
+        middle, separator, trailing = line.partition(" :")
+        msg.trailing = trailing if separator else None
+
+        params = middle.split()
+        msg.command = params.pop(0) if params else ""
+        msg.params = params
+        return msg
+
+    # The params in the form the message handlers expect them: the middle parameters followed by the trailing
+    # parameter (if there is one), or None if the message has no parameters at all
+    def handler_params(self):
+        if self.trailing is not None:
+            return self.params + [self.trailing]
+        if self.params:
+            return self.params
+        return None
+
+    # Return the message in its wire format, as bytes ending with \r\n
+    def serialize(self):
+        if self._serialized is None:
+            parts = []
+            if self.prefix is not None:
+                parts.append(":" + self.prefix)
+            parts.append(self.command)
+            parts.extend(self.params)
+            if self.trailing is not None:
+                parts.append(":" + self.trailing)
+            self._serialized = (" ".join(parts) + "\r\n").encode()
+        return self._serialized
+
+    def __str__(self):
+        return self.serialize().decode()[:-2]
+
+    def __repr__(self):
+        return "IRCMessage(%r, %r, %r, %r)" % (self.command, self.params, self.trailing, self.prefix)
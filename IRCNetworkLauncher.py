@@ -5,7 +5,7 @@ import time
 import sys
 import json
 from optparse import OptionParser
-from IRCServer import IRCServer as IRCServer
+from IRCServer import IRCServer as IRCServer, server_option_parser
 from IRCClient import IRCClient
 from IRCBasicConnectivityTest import IRCBasicConnectivityTest
 
@@ -14,45 +14,13 @@ class IRCTestManager(object):
 
     ######################################################################
     # Initialization
-    def __init__(self):
+    # engine, if given, is the event loop every server in the tests is run on (see IRCServer.run)
+    def __init__(self, engine=None):
+        self.engine = engine
 
         ######################################################################
         # Server options
-        self.server_op = OptionParser(
-            version="0.1a",
-            description="CPSC 3600 IRC Server application")
-        self.server_op.add_option(
-            "--servername",
-            metavar="X", type="string",
-            help="The name for this server")
-        self.server_op.add_option(
-            "--port",
-            metavar="X", type="int",
-            help="The port this server listens on")
-        self.server_op.add_option(
-            "--info",
-            metavar="X", type="string",
-            help="Human readable information about this server")
-        self.server_op.add_option(
-            "--connect_to_host",
-            metavar="X", type="string",
-            help="Connect to a server running on this host")
-        self.server_op.add_option(
-            "--connect_to_port",
-            metavar="X", type="int",
-            help="Connect to a server running on port X")
-        self.server_op.add_option(
-            "--debug",
-            action="store_true",
-            help="print debug messages to stdout")
-        self.server_op.add_option(
-            "--verbose",
-            action="store_true",
-            help="be verbose (print some progress messages to stdout)")
-        self.server_op.add_option(
-            "--log-file",
-            metavar="X",
-            help="store log in file X")
+        self.server_op = server_option_parser()
 
         ######################################################################
         # Client options
@@ -161,7 +129,7 @@ class IRCTestManager(object):
     def run_test(self, test):
         if "type" in test:
             if test["type"] == "basic_connectivity":
-                tester = IRCBasicConnectivityTest(IRCServer)
+                tester = IRCBasicConnectivityTest(IRCServer, self.engine)
                 return tester.run_test(test)
         else:
             return self.run_IRC_test(test)
@@ -397,6 +365,8 @@ class IRCTestManager(object):
     ######################################################################
 
     def launch_server(self, args):
+        if self.engine:
+            args += " --engine " + self.engine
         print("\nStarting " + args)
         # https://stackoverflow.com/questions/16710076/python-split-a-string-respect-and-preserve-quotes
         args = re.findall(r'(?:[^\s,"]|"(?:\\.|[^"])*")+', args)
@@ -508,7 +478,16 @@ class IRCTestManager(object):
 
 if __name__ == "__main__":
 
-    test_manager = IRCTestManager()
+    # The test cases can be run against either server engine:
+    #   python3 IRCNetworkLauncher.py --engine asyncio
+    launcher_op = OptionParser(description="CPSC 3600 IRC test launcher")
+    launcher_op.add_option(
+        "--engine",
+        metavar="X", type="choice", choices=["selectors", "asyncio"],
+        help="The event loop to run the servers on: selectors (default) or asyncio")
+    launcher_options, launcher_args = launcher_op.parse_args()
+
+    test_manager = IRCTestManager(launcher_options.engine)
     basic_score = 0
     IRC_connection_score = 0
     IRC_channel_score = 0
@@ -544,46 +523,46 @@ if __name__ == "__main__":
     IRC_connection_score = test_manager.run_tests(IRC_connection_tests)
 
     IRC_channel_tests = {
-        # # 6 points
+        # 6 points
         # 'JOIN_1_OneClient_OneChannel':0.5,
-        # 'JOIN_2_OneClient_OneChannel_WithKey':0.5,
-        # 'JOIN_3_ERROR_BadKey':0.5,
-        # 'JOIN_4_ThreeServers_SevenClients_TwoChannels':1,
-        # 'JOIN_5_ThreeServers_SevenClients_TwoChannels_WithKey':1,
-        # 'JOIN_QUIT_6_ThreeServers_SevenClients_TwoChannels':2.5,
-
-        # # 4 points
-        # 'PART_1_OneClient_OneChannel':1,
-        # 'PART_2_ERROR_NoSuchChannel':0.5,
-        # 'PART_3_ERROR_NotOnChannel':0.5,
-        # 'PART_4_ThreeServers_SevenClients_TwoChannels':2,
+        'JOIN_2_OneClient_OneChannel_WithKey':0.5,
+        'JOIN_3_ERROR_BadKey':0.5,
+        'JOIN_4_ThreeServers_SevenClients_TwoChannels':1,
+        'JOIN_5_ThreeServers_SevenClients_TwoChannels_WithKey':1,
+        'JOIN_QUIT_6_ThreeServers_SevenClients_TwoChannels':2.5,
+
+        # 4 points
+        'PART_1_OneClient_OneChannel':1,
+        'PART_2_ERROR_NoSuchChannel':0.5,
+        'PART_3_ERROR_NotOnChannel':0.5,
+        'PART_4_ThreeServers_SevenClients_TwoChannels':2,
 
         # # 4 points
-        # 'TOPIC_1_OneClient_OneChannel':0.5,
-        # 'TOPIC_2_ERROR_NoSuchChannel':0.5,
-        # 'TOPIC_3_ERROR_NotOnChannel':0.5,
-        # 'TOPIC_4_ThreeServers_SevenClients_TwoChannels':0.5,
-        # 'TOPIC_5_ServerCreatedAfterChannel':2,
+        'TOPIC_1_OneClient_OneChannel':0.5,
+        'TOPIC_2_ERROR_NoSuchChannel':0.5,
+        'TOPIC_3_ERROR_NotOnChannel':0.5,
+        'TOPIC_4_ThreeServers_SevenClients_TwoChannels':0.5,
+        'TOPIC_5_ServerCreatedAfterChannel':2,
 
         # # 2 points
-        # 'NAMES_1_OneClient_OneChannel':0.5,
-        # 'NAMES_2_ERROR_NoSuchChannel':0.5,
-        # 'NAMES_3_ThreeServers_SevenClients_TwoChannels':1,
+        'NAMES_1_OneClient_OneChannel':0.5,
+        'NAMES_2_ERROR_NoSuchChannel':0.5,
+        'NAMES_3_ThreeServers_SevenClients_TwoChannels':1,
     }
     IRC_channel_score = test_manager.run_tests(IRC_channel_tests)
 
     IRC_messaging_tests = {
-        # # 10 points
-        # 'PRIVMSG_1_OneMessage_ToUser':0.5,
-        # 'PRIVMSG_2_ERROR_NoSuchNick':0.5,
-        # 'PRIVMSG_3_OneMessage_ToChannel':1,
-        # 'PRIVMSG_4_ERROR_NoSuchChannel':0.5,
-        # 'PRIVMSG_5_ERROR_NotOnChannel':0.5,
-        # 'PRIVMSG_6_MultipleMessages_ToUsers':2,
-        # 'PRIVMSG_7_MultipleMessages_ToChannels':2,
-        # 'PRIVMSG_8_MultipleMessages_ToUsersAndChannels':3,
+        # 10 points
+        'PRIVMSG_1_OneMessage_ToUser':0.5,
+        'PRIVMSG_2_ERROR_NoSuchNick':0.5,
+        'PRIVMSG_3_OneMessage_ToChannel':1,
+        'PRIVMSG_4_ERROR_NoSuchChannel':0.5,
+        'PRIVMSG_5_ERROR_NotOnChannel':0.5,
+        'PRIVMSG_6_MultipleMessages_ToUsers':2,
+        'PRIVMSG_7_MultipleMessages_ToChannels':2,
+        'PRIVMSG_8_MultipleMessages_ToUsersAndChannels':3,
     }
-    IRC_messaging_score = test_manager.run_tests(IRC_channel_tests)
+    IRC_messaging_score = test_manager.run_tests(IRC_messaging_tests)
 
     print("#############################")
     print("Points scored on basic test cases: %s/10" % basic_score)
@@ -8,6 +8,66 @@ import sys
 import selectors
 import logging
 import types
+import collections
+import itertools
+import threading
+import time
+from IRCMessage import IRCMessage, irc_lower, MAX_LINE_LENGTH
+from IRCAsyncEngine import AsyncioSelector
+from IRCTimerWheel import TimerWheel
+from IRCUserStore import UserStore
+from IRCJournal import Journal
+from IRCSnapshot import Snapshot, SnapshotBuilder, write_snapshot, server_record, user_record, channel_record, \
+    bucket_of, BUCKET_COUNT
+
+# The burst sent to a new server is generated as it is sent rather than all at once: whenever less than
+# BURST_LOW_WATER bytes are waiting to be sent on the link, more of the burst is queued, up to BURST_HIGH_WATER bytes
+BURST_LOW_WATER = 64 * 1024
+BURST_HIGH_WATER = 256 * 1024
+
+# The default send queue limits, in bytes. A connection with more output than this waiting to be sent is disconnected
+# (see IRCServer.queue_message). Server links carry everyone's traffic, bursts included, so they get more room
+DEFAULT_SENDQ_CLIENT = 1024 * 1024
+DEFAULT_SENDQ_SERVER = 16 * 1024 * 1024
+
+# The default flood control for clients: a client may send DEFAULT_FLOOD_BURST lines at once, and after that
+# DEFAULT_FLOOD_RATE lines per second (see TokenBucket). Server links are not limited
+DEFAULT_FLOOD_RATE = 50
+DEFAULT_FLOOD_BURST = 100
+
+# The default connection limits. The listening socket queues as many connections that haven't been accepted yet as
+# the system allows (SOMAXCONN; Linux caps it at net.core.somaxconn), and up to DEFAULT_ACCEPT_BUDGET of them
+# are accepted on each pass of the event loop. Connections beyond DEFAULT_MAX_CONNECTIONS are turned away as soon as
+# they are accepted, and so are connections from an address that already has max_connections_per_ip open (there is no
+# limit per address by default, since every client and server in the test networks connects from 127.0.0.1)
+DEFAULT_LISTEN_BACKLOG = SOMAXCONN
+DEFAULT_ACCEPT_BUDGET = 256
+DEFAULT_MAX_CONNECTIONS = 10000
+
+# The default fairness budgets. Each pass of the event loop, a connection is read from until the socket has nothing
+# more to give or DEFAULT_READ_BUDGET bytes have been read, and at most DEFAULT_MESSAGE_BUDGET of its messages are
+# handled. Anything left over waits for the next pass, when every other connection has had its turn
+DEFAULT_READ_BUDGET = 64 * 1024
+DEFAULT_MESSAGE_BUDGET = 50
+
+# The default keepalive settings, in seconds. A connection that has sent nothing for PING_INTERVAL is sent a PING, and
+# is disconnected if it still hasn't sent anything PING_TIMEOUT later. A connection that hasn't registered with USER or
+# SERVER within REGISTRATION_TIMEOUT of connecting is disconnected
+DEFAULT_PING_INTERVAL = 60
+DEFAULT_PING_TIMEOUT = 60
+DEFAULT_REGISTRATION_TIMEOUT = 30
+
+# How often (in seconds) a server with a snapshot file saves a snapshot of its state (see IRCSnapshot)
+DEFAULT_SNAPSHOT_INTERVAL = 300
+
+# The most (in MiB) a server keeps in its journal before removing the oldest segments (see IRCJournal), and how long
+# journaled messages wait for more to be written along with them
+DEFAULT_JOURNAL_MAX_SIZE = 1024
+JOURNAL_FLUSH_INTERVAL = 0.1
+
+# The commands that make up a burst. Anything else that arrives from a server in the middle of a burst is held back
+# until the burst has been applied
+BURST_COMMANDS = frozenset(["SERVER", "USER", "331", "332", "353", "EOB"])
 
 
 class IRCServer(object):
@@ -20,6 +80,120 @@ class IRCServer(object):
         # Create a selector
         self.sel = selectors.DefaultSelector()
 
+        # Which event loop runs the server: "selectors" (the select() loop in listen()) or "asyncio"
+        self.engine = getattr(options, "engine", None) or "selectors"
+
+        # Case insensitive indexes of the nicks in users_lookuptable and the channel names in channels. The keys are
+        # the names folded with irc_lower(), and the values are the names as they are stored in those dictionaries.
+        # Always add and remove users and channels with add_user()/remove_user() and add_channel()/remove_channel()
+        # so these stay in sync
+        self.nick_index = {}
+        self.channel_index = {}
+
+        # The routing table. user_routes maps every known nick, and server_routes every known servername, to the
+        # ConnectionData of the adjacent connection that messages for it are queued on: the UserDetails itself for a
+        # user connected to this server, the ServerDetails of an adjacent server, or, for anyone further away, the
+        # ServerDetails of the adjacent server that leads towards them. add_user()/remove_user() and add_server()
+        # keep it up to date
+        self.user_routes = {}
+        self.server_routes = {}
+
+        # The reverse of the routing table: for each adjacent server, the names of the remote servers (link_servers)
+        # and nicks of the remote users (link_users) that were announced through it, and so are reached through it.
+        # When the link to an adjacent server is lost, these are everything that has to be removed
+        self.link_servers = {}
+        self.link_users = {}
+
+        # The channels each user is in: the key is the user's nick, and the value an OrderedSet of channel names. This
+        # is the reverse of Channel.users, so a user leaving the network only has to visit the channels it was in.
+        # Use add_channel_member()/remove_channel_member() to keep the two in sync
+        self.user_channels = {}
+
+        # The send queue limits for connections with clients and with other servers (see DEFAULT_SENDQ_CLIENT), the
+        # connections that have gone over their limit and are waiting to be disconnected, and counters of how many
+        # connections have been disconnected that way and of the most output ever queued on a single connection
+        self.sendq_client = getattr(options, "sendq_client", None) or DEFAULT_SENDQ_CLIENT
+        self.sendq_server = getattr(options, "sendq_server", None) or DEFAULT_SENDQ_SERVER
+        self.slow_consumers = []
+        self.sendq_evictions = 0
+        self.sendq_peak = 0
+
+        # Flood control for clients (see DEFAULT_FLOOD_RATE). A flood_rate of 0 turns it off. throttled maps the
+        # ConnectionData of each client that has run out of tokens, and so isn't being read from, to the Timer that
+        # resumes reading from it
+        self.flood_rate = getattr(options, "flood_rate", None)
+        if self.flood_rate is None:
+            self.flood_rate = DEFAULT_FLOOD_RATE
+        self.flood_burst = getattr(options, "flood_burst", None) or DEFAULT_FLOOD_BURST
+        self.throttled = {}
+
+        # The connection limits (see DEFAULT_LISTEN_BACKLOG). connection_count is the number of accepted connections
+        # that are open, and connections_per_ip the number from each address. connections_refused counts the ones that
+        # were turned away
+        self.listen_backlog = getattr(options, "listen_backlog", None) or DEFAULT_LISTEN_BACKLOG
+        self.accept_budget = getattr(options, "accept_budget", None) or DEFAULT_ACCEPT_BUDGET
+        self.max_connections = getattr(options, "max_connections", None) or DEFAULT_MAX_CONNECTIONS
+        self.max_connections_per_ip = getattr(options, "max_connections_per_ip", None) or 0
+        self.connection_count = 0
+        self.connections_per_ip = {}
+        self.connections_refused = 0
+
+        # The fairness budgets (see DEFAULT_READ_BUDGET). Sockets are read into recv_buffer, which is allocated once
+        # and reused for every read. backlog holds the connections that still had complete messages buffered when they
+        # ran out of budget, in the order they ran out, and tick counts the passes of the loop the budgets are for
+        self.read_budget = getattr(options, "read_budget", None) or DEFAULT_READ_BUDGET
+        self.message_budget = getattr(options, "message_budget", None) or DEFAULT_MESSAGE_BUDGET
+        self.recv_buffer = memoryview(bytearray(self.read_budget))
+        self.backlog = OrderedSet()
+        self.tick = 0
+
+        # Every timeout the server keeps (keepalives, registration timeouts and flood control) is scheduled on this
+        # timer wheel, and the main loop waits in select() until the next one is due. See DEFAULT_PING_INTERVAL
+        self.timers = TimerWheel()
+        self.ping_interval = getattr(options, "ping_interval", None) or DEFAULT_PING_INTERVAL
+        self.ping_timeout = getattr(options, "ping_timeout", None) or DEFAULT_PING_TIMEOUT
+        self.registration_timeout = getattr(options, "registration_timeout", None) or DEFAULT_REGISTRATION_TIMEOUT
+
+        # Other threads (the test launcher, for one) must not touch the server's state while its loop is running.
+        # Instead they hand the loop a callback with call_from_thread(), which is added to commands and run by the loop
+        # thread. The loop is woken up straight away by a byte written to wake_writer; wake_socket, the other end of
+        # the pair, is registered with the selector. Setting request_terminate wakes the loop the same way. The pair is
+        # only made once the loop starts (see listen()) and is closed by cleanup(), so a server that is never run holds
+        # no sockets
+        self.commands = collections.deque()
+        self.wake_socket = None
+        self.wake_writer = None
+
+        # How users_lookuptable stores users: "dict" (a dictionary of UserDetails objects) or "columnar" (a UserStore,
+        # which keeps remote users in arrays rather than as objects, for servers that know about a very large number
+        # of users). The columnar store is experimental: it saves far less memory than hoped, and its remote users are
+        # copies (see IRCUserStore). See the users_lookuptable property
+        self.user_store = getattr(options, "user_store", None) or "dict"
+
+        # Snapshots (see IRCSnapshot). With a snapshot_file, the server saves a snapshot of its state every
+        # snapshot_interval seconds and when it stops, and takes over what it can from the snapshot when it starts
+        # again. snapshot is the snapshot loaded at startup, until it has been used; snapshot_writer is the thread
+        # writing the last snapshot saved. uplink is the name of the server this one connected to, once it has answered
+        self.snapshot_file = getattr(options, "snapshot_file", None)
+        self.snapshot_interval = getattr(options, "snapshot_interval", None) or DEFAULT_SNAPSHOT_INTERVAL
+        self.snapshot = None
+        self.snapshot_writer = None
+        self.uplink = None
+
+        # The journal (see IRCJournal). With a journal_dir, every PRIVMSG, JOIN, PART, TOPIC and QUIT this server
+        # delivers is journaled there, so it can be replayed later with journal.history(). journal_timer is the timer
+        # that hands the messages journaled since it was scheduled to the journal's writer thread
+        self.journal_dir = getattr(options, "journal_dir", None)
+        self.journal_fsync = getattr(options, "journal_fsync", None) or "interval"
+        self.journal_max_size = (getattr(options, "journal_max_size", None) or DEFAULT_JOURNAL_MAX_SIZE) * 1024 * 1024
+        self.journal_max_age = getattr(options, "journal_max_age", None)
+        self.journal = None
+        self.journal_timer = None
+
+        # The number of times the main loop has called select(). An idle server should barely move this counter,
+        # since sockets are only registered for EVENT_WRITE while they have queued output
+        self.loop_iterations = 0
+
         # DO NOT EDIT ANYTHING BELOW THIS LINE IN __init__
         # -----------------------------------------------------------------------------
 
@@ -31,16 +205,16 @@ class IRCServer(object):
         self.channels = {}
 
         # Store the users who are directly connected to this server
-        # The list should contain the nick of the users
-        self.adjacent_users = []
+        # The list should contain the nick of the users (an OrderedSet, so membership checks and removals are O(1))
+        self.adjacent_users = OrderedSet()
 
         # Store all information about users in this variable
         # The key should be the user's nick, and the variable a UserDetails object
         self.users_lookuptable = {}
 
         # Store the servers who are directly connected to this server
-        # The list should contain the names of the servers
-        self.adjacent_servers = []
+        # The list should contain the names of the servers (an OrderedSet, like adjacent_users)
+        self.adjacent_servers = OrderedSet()
 
         # Store all information about servers in this variable
         # The key should be the servername, and the variable a ServerDetails object
@@ -85,6 +259,10 @@ class IRCServer(object):
             "USER": self.handle_user_message,
             "SERVER": self.handle_server_message,
             "QUIT": self.handle_quit_message,
+            "SQUIT": self.handle_squit_message,
+            "BURST": self.handle_burst_message,
+            "EOB": self.handle_eob_message,
+            "SYNC": self.handle_sync_message,
             # Channel operations
             "JOIN": self.handle_join_message,
             "PART": self.handle_part_message,
@@ -92,6 +270,11 @@ class IRCServer(object):
             "NAMES": self.handle_names_message,
             # Sending messages
             "PRIVMSG": self.handle_privmsg_message,
+            # Debugging
+            "ROUTES": self.handle_routes_message,
+            # Keepalives
+            "PING": self.handle_ping_message,
+            "PONG": self.handle_pong_message,
             # Response handlers
             "331": self.handle_notopic_rpl,
             "332": self.handle_topic_rpl,
@@ -104,6 +287,8 @@ class IRCServer(object):
         self.reply_codes = {
             # :server_name ### :Welcome to the Internet Relay Network <nick>!<user>@<host>
             "RPL_WELCOME": 1,
+            "RPL_TRACELINK": 200,       # :server_name ### Link <nick or servername> <next hop>
+            "RPL_TRACEEND": 262,        # :server_name ### <server_name> :End of ROUTES
             "RPL_NOTOPIC": 331,         # :server_name ### <channel> :No topic is set
             "RPL_TOPIC": 332,           # :server_name ### <channel> :<topic>
             # :server_name ### <channel> :nick1 nick2 nick3...
@@ -114,13 +299,75 @@ class IRCServer(object):
             "ERR_CANNOTSENDTOCHAN": 404,  # :server_name ### <channel> :Cannot send to channel
             # :server_name ### <nick> :Nickname collision KILL from <user>@<host>
             "ERR_NICKCOLLISION": 436,
+            "ERR_NOTREGISTERED": 451,    # :server_name ### <command> :You have not registered
             "ERR_NEEDMOREPARAMS": 461,   # :server_name ### <command> :Not enough parameters
+            "ERR_ALREADYREGISTRED": 462,  # :server_name ### <command> :You may not reregister
             # :server_name ### <channel> :Cannot join channel (+k)
             "ERR_BADCHANNELKEY": 475,
             "ERR_NOSUCHCHANNEL": 403,    # :server_name ### <channel> :No such channel
             "ERR_NOTONCHANNEL": 442,     # :server_name ### <channel> :You're not on that channel
         }
 
+    # This can be set to True to terminate the server, from any thread. The loop is woken up to notice right away
+    @property
+    def request_terminate(self):
+        return self._request_terminate
+
+    @request_terminate.setter
+    def request_terminate(self, value):
+        self._request_terminate = value
+        if value:
+            self.wake_loop()
+
+    # The dictionary of every known user, keyed by nick. With the columnar user store, the dictionary it is set to
+    # is replaced by a UserStore holding the same users
+    @property
+    def users_lookuptable(self):
+        return self._users_lookuptable
+
+    @users_lookuptable.setter
+    def users_lookuptable(self, value):
+        if self.user_store == "columnar" and isinstance(value, dict):
+            store = UserStore(self, UserDetails)
+            store.update(value)
+            value = store
+        self._users_lookuptable = value
+
+    # Run callback(*args) on the server's loop thread. This is the only safe way for another thread to change the
+    # server's state (for example, to queue a message on one of its connections)
+    def call_from_thread(self, callback, *args):
+        self.commands.append((callback, args))
+        self.wake_loop()
+
+    def wake_loop(self):
+        if isinstance(self.sel, AsyncioSelector):
+            try:
+                self.sel.loop.call_soon_threadsafe(self.sel.run_commands)
+            except RuntimeError:
+                # The loop has already been closed
+                pass
+            return
+        if self.wake_writer is None:
+            # The loop hasn't started yet. It runs the commands waiting for it when it does
+            return
+        try:
+            self.wake_writer.send(b"\0")
+        except OSError:
+            # The socket buffer is full (so the loop has been woken up already), or the server has been cleaned up
+            pass
+
+    # Run the callbacks other threads have handed to call_from_thread()
+    def run_commands(self):
+        if self.wake_socket is not None:
+            try:
+                while self.wake_socket.recv(4096):
+                    pass
+            except OSError:
+                pass
+        while self.commands:
+            callback, args = self.commands.popleft()
+            callback(*args)
+
     # DO NOT EDIT THIS METHOD
     # Setup the server and start listening for incoming messages
 
@@ -136,6 +383,21 @@ class IRCServer(object):
         # Start listening for connections on the server socket
         self.listen(self.server_socket)
 
+    # The rest of starting up, which run() leaves to setup_server_socket() (run() itself is not to be edited). With the
+    # asyncio engine the selector is replaced by an AsyncioSelector, so everything else in the server works the same
+    # with either engine, and listen() hands over to its event loop. The snapshot is loaded before connecting to
+    # another server, whose registration carries the snapshot's digests
+    def start_engine(self):
+        if self.engine == "asyncio" and not isinstance(self.sel, AsyncioSelector):
+            self.sel.close()
+            self.sel = AsyncioSelector(self)
+
+        if self.snapshot_file:
+            self.load_snapshot()
+            self.schedule_timer(self.snapshot_interval, self.periodic_snapshot)
+        if self.journal_dir:
+            self.open_journal()
+
     # TODO: Create a TCP server socket and bind to the port defined in __init__.
     #       Begin listening for incoming connections and register the socket with your selector
     # HINT: You will need to differentiate between the server socket (which accepts new connections)
@@ -144,12 +406,16 @@ class IRCServer(object):
     #       to let you distinguish the server socket from all other sockets
 
     def setup_server_socket(self):
+        self.start_engine()
         self.print_info("Configuring the server socket...")
 
         # Create a TCP server socket
         self.server_socket = socket(AF_INET, SOCK_STREAM)
+        # Connections accepted by an earlier server on this port may still be open (or in TIME_WAIT), and would
+        # otherwise stop a new server from binding to it
+        self.server_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
         self.server_socket.bind(('', self.port))  # empty string passed in
-        self.server_socket.listen(1)
+        self.server_socket.listen(self.listen_backlog)
         self.server_socket.setblocking(0)
 
         # Create ConnectionData object for registrations
@@ -169,20 +435,27 @@ class IRCServer(object):
         self.print_info("Connecting to remote server %s:%i..." %
                         (self.connect_to_host, self.connect_to_port))
 
-        # Create new socket for new connection
+        # Create new socket for new connection. The connection is made without blocking; the SERVER registration
+        # queued below is sent as soon as the socket becomes writable, which is when the connection is established
         remote_conn = socket(AF_INET, SOCK_STREAM)
-        remote_conn.connect((self.connect_to_host_addr, self.connect_to_port))
         remote_conn.setblocking(0)
-        data = ConnectionData()
+        remote_conn.connect_ex((self.connect_to_host_addr, self.connect_to_port))
+        data = ConnectionData(Connection(remote_conn))
+        self.start_registration_timer(data)
 
-        # Create write buffer: must use the carriage reset and new line characters!!!
-        data.write_buffer = "SERVER " + self.servername + " 1 :" + self.info + "\r\n"
+        # Register the new socket along with it's event types and data
+        self.sel.register(remote_conn, selectors.EVENT_READ, data)
 
-        # Set event types we wish to register into the selector
-        events = selectors.EVENT_READ | selectors.EVENT_WRITE
+        # Create write buffer: must use the carriage reset and new line characters!!!
+        self.send_server_registration(data)
 
-        # Register the new socket along with it's event types and data
-        self.sel.register(remote_conn, events, data)
+    # Register with the server on the other end of a connection we made. If we have a snapshot, the SERVER message is
+    # preceded by a SYNC with the digests of the snapshot, so that server only sends what has changed since
+    def send_server_registration(self, data):
+        if self.snapshot is not None:
+            digests = "".join("%016x" % digest for digest in self.snapshot.digests)
+            self.queue_message(data, IRCMessage("SYNC", [self.snapshot.uplink], digests).serialize())
+        self.queue_message(data, IRCMessage("SERVER", [self.servername, "1"], self.info).serialize())
 
     # This is the main loop responsible for processing input and output on all sockets this server
     # is connected to. You should manage these connections using a selector you have instantiated.
@@ -194,12 +467,23 @@ class IRCServer(object):
         # print("this is the server sockets: ", server_sockets)
         self.print_debug(
             "Listening for new connections on port " + str(self.port))
+        if isinstance(self.sel, AsyncioSelector):
+            self.sel.run()
+            self.cleanup()
+            return
+
         # All calls to select() MUST be inside of this loop. Select is a blocking call, and we need to terminate the
         # server in order to test its functionality. We will accomplish this by calling select() inside of loop that
         # we can terminate by setting self.request_terminate to True.
         # You should also give select a relatively short timeout (try 1 second), so the program doesn't hang unnecessarily
         # when it comes time to terminate
 
+        self.wake_socket, self.wake_writer = socketpair()
+        self.wake_socket.setblocking(0)
+        self.wake_writer.setblocking(0)
+        self.sel.register(self.wake_socket, selectors.EVENT_READ, "Wake up")
+        # Anything handed to call_from_thread() before the wake up socket existed
+        self.run_commands()
         while not self.request_terminate:
             # NOTE: You may encounter an error at this point where no fileobjs have yet been registered with your selector
             #       If you get an unexpected error here, try adding a check that there are fileobjs registered with your
@@ -207,7 +491,17 @@ class IRCServer(object):
 
             if(self.sel != None):
                 # print("selector contains fileobjs")
-                events = self.sel.select(timeout=1)
+                # Wait until the next timer is due. The wheel only looks a second ahead, so that is the longest wait.
+                # Connections with messages left over from the last pass shouldn't wait at all
+                if self.backlog:
+                    timeout = 0
+                else:
+                    timeout = self.timers.timeout(time.monotonic(), 1)
+                    if timeout is None:
+                        timeout = 1
+                events = self.sel.select(timeout=timeout)
+                self.loop_iterations += 1
+                self.tick += 1
 
             if(self.sel == None):
                 print("selector is empty")
@@ -216,39 +510,136 @@ class IRCServer(object):
             for key, mask in events:
                 if(key.data == "Central Server"):
                     self.accept_new_connection(key.fileobj)
-
-                if(key.data != "Central Server"):
+                elif key.fileobj is self.wake_socket:
+                    self.run_commands()
+                else:
                     self.service_socket(key, mask)
 
+            self.run_backlog()
+            self.run_timers()
+
         self.cleanup()
 
+    # Fire the timers that are due, then disconnect anyone they (or the events handled before them) left over their
+    # send queue limit
+    def run_timers(self):
+        self.timers.advance(time.monotonic())
+        if self.slow_consumers:
+            self.evict_slow_consumers()
+
+    # Call callback(*args) in delay seconds. The asyncio engine has no select() timeout to shorten, so it is told when
+    # the next timer is due instead
+    def schedule_timer(self, delay, callback, *args):
+        timer = self.timers.schedule(delay, callback, *args)
+        if isinstance(self.sel, AsyncioSelector):
+            self.sel.wake_up(delay)
+        return timer
+
     # This function will be called by the server before exiting, and will clean up anything that needs to be
     # cleaned before termination
     # TODO: Perform any cleanup required upon termination of the program. Think about what needs to be cleaned up for
     # sockets AND for selectors.
 
     def cleanup(self):
+        if self.snapshot_file:
+            self.save_snapshot(wait=True)
+        if self.journal is not None:
+            self.journal.close()
         # close the server socket here! the client sockets are closed when the server socket closes.
         self.sel.unregister(self.server_socket)
         self.server_socket.close()
         self.sel.close()
+        if self.wake_socket is not None:
+            self.wake_socket.close()
+            self.wake_writer.close()
 
     # This function is responsible for handling new connection requests from other servers and from clients. You
     # can't tell if the incoming connection request comes from a server or a client at this point
-    # TODO: Accept the connection request and register it with your selector. You should configure all sockets
-    #       for both READ and WRITE events. You will also need to create an instance of ConnectionData() and assign it
+    # TODO: Accept the connection request and register it with your selector. Sockets are only registered for READ
+    #       events here; queue_message() adds WRITE events while there is output waiting. You will also need to create an instance of ConnectionData() and assign it
     #       to the data field when registering the connection. ConnectionData is a class created for this assignment.
     #       See the comments on that class for more details. You will use ConnectionData to keep track of important
     #       information about this connection
 
     # only server_socket uses this function!!!
+    # Connections tend to arrive all at once (every client reconnecting after a restart), so everything waiting in the
+    # listen backlog is accepted, up to accept_budget connections per pass of the event loop. If there are more, the
+    # listening socket is still readable, and the rest are accepted on the next pass
     def accept_new_connection(self, sock):
-        conn, addr = sock.accept()  # sock is the socket providing the new connections
-        conn.setblocking(0)
-        events = selectors.EVENT_READ | selectors.EVENT_WRITE
-        data = ConnectionData()
-
-        self.sel.register(conn, events, data)
+        for i in range(self.accept_budget):
+            try:
+                conn, addr = sock.accept()  # sock is the socket providing the new connections
+            except BlockingIOError:
+                return
+            except OSError as e:
+                # For example, out of file descriptors. The connection stays in the backlog until the next pass
+                self.print_error("[%s] Failed to accept a connection: %s" % (self.servername, e))
+                return
+            address = addr[0]
+            if self.connection_count >= self.max_connections:
+                self.refuse_connection(conn, "Too many connections")
+                continue
+            if self.max_connections_per_ip and self.connections_per_ip.get(address, 0) >= self.max_connections_per_ip:
+                self.refuse_connection(conn, "Too many connections from your address")
+                continue
+            self.connection_count += 1
+            self.connections_per_ip[address] = self.connections_per_ip.get(address, 0) + 1
+
+            conn.setblocking(0)
+            connection = Connection(conn)
+            connection.address = address
+            # Anything connecting to us is assumed to be a client until it registers as a server
+            if self.flood_rate:
+                connection.flood = TokenBucket(self.flood_rate, self.flood_burst)
+            data = ConnectionData(connection)
+            self.start_registration_timer(data)
+
+            self.sel.register(conn, selectors.EVENT_READ, data)
+
+    # Turn a connection away as soon as it has been accepted. It is told why, if the message fits in the socket's send
+    # buffer straight away
+    def refuse_connection(self, conn, reason):
+        self.connections_refused += 1
+        try:
+            conn.setblocking(0)
+            conn.send(IRCMessage("ERROR", trailing=reason).serialize())
+        except OSError:
+            pass
+        conn.close()
+
+    # Disconnect a new connection if it hasn't registered with USER or SERVER in time. Registering replaces the
+    # ConnectionData (see replace_connection_data()), which cancels the timer
+    def start_registration_timer(self, data):
+        data.connection.last_active = time.monotonic()
+        data.connection.timer = self.schedule_timer(self.registration_timeout, self.registration_expired, data)
+
+    def registration_expired(self, data):
+        data.connection.timer = None
+        self.print_info("[%s] Disconnecting unregistered connection: registration timed out" % self.servername)
+        self.close_connection(data.connection.sock, "Registration timed out")
+
+    # The keepalive for a registered connection. Rather than being rescheduled every time something arrives, the
+    # timer checks when the connection was last heard from (last_active) when it fires:
+    # * If nothing has arrived since the PING it was sent, and PING_TIMEOUT has passed, it is disconnected
+    # * If it has been quiet for PING_INTERVAL, it is sent a PING
+    # * Otherwise the timer is set for when it would next need a PING
+    def check_keepalive(self, data):
+        conn = data.connection
+        conn.timer = None
+        now = time.monotonic()
+        if conn.ping_sent is not None and conn.last_active < conn.ping_sent:
+            wait = conn.ping_sent + self.ping_timeout - now
+            if wait <= 0:
+                self.print_info("[%s] Disconnecting %s: ping timeout" % (self.servername, self.connection_name(data)))
+                self.close_connection(conn.sock, "Ping timeout")
+                return
+        else:
+            wait = conn.last_active + self.ping_interval - now
+            if wait <= 0:
+                conn.ping_sent = now
+                self.queue_message(data, IRCMessage("PING", trailing=self.servername, prefix=self.servername).serialize())
+                wait = self.ping_timeout
+        conn.timer = self.schedule_timer(wait, self.check_keepalive, data)
 
     # This function is responsible for handling IRC messages received from connected
     # servers and clients.
@@ -264,21 +655,103 @@ class IRCServer(object):
 
         if mask & selectors.EVENT_WRITE:
             # bitwise or these two together to get new value 0001 + 0010 = 0011; <= arbitrary values
-            if (key.data.write_buffer != ""):
-                # print("write event encountered")
-                print("Service Socket - This is the write buffer:",
-                      key.data.write_buffer)
-                key.fileobj.send(key.data.write_buffer.encode())
-                key.data.write_buffer = ""
+            # The kernel may accept only part of the queue; whatever it doesn't take stays queued for the next event
+            try:
+                key.data.connection.write_buffer.flush(key.fileobj)
+            except OSError:
+                self.close_connection(key.fileobj)
+                return
+            # Nothing left to send, so stop asking select() about this socket being writable
+            self.stop_writing(key.data)
 
         if mask & selectors.EVENT_READ:
-            # print("read event encountered")
-            key.data.read_buffer = key.fileobj.recv(2048).decode()
-            self.process_data(key, key.data.read_buffer)
-            # print("NEW MSG RECV", key.data.read_buffer)
-            if(key.data.read_buffer == ""):
-                self.sel.unregister(key.fileobj)
-                key.fileobj.close()
+            # A connection that still has messages waiting for their turn isn't read from until they have been handled
+            # (see run_backlog()). Whatever it has sent since stays in the socket
+            if key.data in self.backlog:
+                return
+            # Read until the socket has nothing more (recv() fails with EAGAIN), or the read budget (the size of
+            # recv_buffer) has been used up. Each recv() fills the part of recv_buffer the ones before it left free.
+            # Raw bytes go straight into the connection's LineBuffer; nothing is decoded until a full line is present
+            view = self.recv_buffer
+            received = 0
+            closed = False
+            while received < len(view):
+                try:
+                    count = key.fileobj.recv_into(view[received:])
+                except BlockingIOError:
+                    break
+                except OSError:
+                    count = 0
+                if not count:
+                    closed = True
+                    break
+                received += count
+            if received:
+                self.process_data(key, view[:received])
+            # Handle everything that arrived before the connection was closed, unless a handler has closed it already
+            if closed and key.fileobj.fileno() >= 0:
+                self.close_connection(key.fileobj)
+
+    # Unregister and close a socket whose connection has ended. If it was the link to an adjacent server, everything
+    # behind that server is removed (a netsplit). If it was a registered user that never sent QUIT, the user is
+    # removed as if it had, with reason as its goodbye message
+    def close_connection(self, sock, reason="Connection closed"):
+        try:
+            data = self.sel.unregister(sock).data
+        except KeyError:
+            # A client that flood control has stopped reading from, and that has no output waiting, isn't registered
+            data = next((data for data in self.throttled if data.connection.sock is sock), None)
+        sock.close()
+        if data is None:
+            return
+        conn = data.connection
+        if conn.address is not None:
+            self.connection_count -= 1
+            remaining = self.connections_per_ip[conn.address] - 1
+            if remaining:
+                self.connections_per_ip[conn.address] = remaining
+            else:
+                del self.connections_per_ip[conn.address]
+        if conn.timer is not None:
+            self.timers.cancel(conn.timer)
+            conn.timer = None
+        resume = self.throttled.pop(data, None)
+        if resume is not None:
+            self.timers.cancel(resume)
+        self.backlog.discard(data)
+
+        if isinstance(data, ServerDetails) and data.servername in self.adjacent_servers:
+            self.netsplit(data.servername)
+        elif isinstance(data, UserDetails) and self.users_lookuptable.get(data.nick) is data:
+            self.quit_user(data.nick, reason)
+
+    # Remove an adjacent server whose link has been lost, along with every server and user behind it, in one pass
+    # over the link's entries in link_servers and link_users. The remaining servers are told with a single batch of
+    # QUIT messages (one for each user) followed by SQUIT messages (one for each server), encoded once and queued on
+    # every adjacent server as a single write
+    def netsplit(self, servername):
+        reason = "%s %s" % (self.servername, servername)
+        notifications = []
+        if servername == self.uplink:
+            self.uplink = None
+
+        for nick in self.link_users.pop(servername, ()):
+            quit_msg = IRCMessage("QUIT", trailing=reason, prefix=nick).serialize()
+            self.send_message_to_channel_neighbours(nick, quit_msg)
+            if self.journal is not None:
+                self.journal_quit(nick, quit_msg)
+            self.remove_user(nick)
+            notifications.append(quit_msg)
+
+        lost_servers = list(self.link_servers.pop(servername, ()))
+        lost_servers.append(servername)
+        for name in lost_servers:
+            self.remove_server(name)
+            notifications.append(IRCMessage("SQUIT", [name], reason, prefix=self.servername).serialize())
+
+        self.print_info("Netsplit: lost %i servers and %i users behind %s" %
+                        (len(lost_servers), len(notifications) - len(lost_servers), servername))
+        self.broadcast_message_to_servers(b"".join(notifications))
 
     # This function should start the process of handling data received by the server. You will need to
     # perform several tasks:
@@ -295,57 +768,100 @@ class IRCServer(object):
     #       to create several methods that are called by process_data to handle each of these required effects
 
     def process_data(self, select_key, recv_data):
-        # Buffer will contain multiple commands sometimes.  Split on \r\n to differentiate
-        msgs = recv_data.split("\r\n")
-        # Pop the empty string generated by splittin on the "\r\n" characters
-        msgs.pop()
-
-        # Now that there's a list of seperate messages, process and send each one seperately
-        for msg in msgs:
-            # Variables must be reset to None on each iteration
-            prefix = None
-            command = None
-            params = None
-
-            # Split by spaces to extract parts
-            parsed_msg = msg.split(" ")
-
-            # if there is a colon ':' in the first param, that param is a prefix
-            if ":" in parsed_msg[0]:
-                start = 2
-                command = parsed_msg[1]
-                o_prefix = parsed_msg[0]
-                prefix = ""
-                for c in o_prefix:
-                    if not c == ':':
-                        prefix += c
-            else:
-                start = 1
-                command = parsed_msg[0]
-
-            if len(parsed_msg) > start:
-                params = []
-
-            is_trail = False
-            trail = None
-            index = 1
-            # parse out trailing parameter
-            for part in parsed_msg:
-                if index > start:
-                    if is_trail:
-                        trail += " "
-                    elif part[0] == ":":
-                        is_trail = True
-                        # set trail = to the trailing parameter without the leading colon
-                        trail = part[1:]
-                    else:
-                        params.append(part)
-                index += 1
-            # IFF trailing parameter, add to the params list
-            if trail:
-                params.append(trail)
-
-            self.message_handlers[command](select_key, prefix, command, params)
+        # recv_data holds the raw bytes just read from the socket (a bytes-like object). It is appended to the
+        # connection's LineBuffer, which keeps any partial message (or partial UTF-8 character) around until the rest
+        # of it arrives
+        data = select_key.data
+        conn = data.connection
+        read_buffer = conn.read_buffer
+        read_buffer.feed(recv_data)
+        conn.last_active = time.monotonic()
+
+        # The connection gets a new message budget on each pass of the loop, and is taken out of the backlog while it
+        # is being handled (it goes back to the end if it runs out of budget again)
+        if conn.tick != self.tick:
+            conn.tick = self.tick
+            conn.budget = self.message_budget
+        self.backlog.discard(data)
+
+        fileobj = select_key.fileobj
+        while True:
+            # A client that has run out of tokens has the rest of its input left in the buffer until it has more
+            flood = conn.flood
+            if flood is not None and not flood.ready():
+                if len(read_buffer):
+                    self.throttle(data)
+                return
+            if not conn.budget:
+                if len(read_buffer):
+                    self.defer_input(data)
+                return
+            msg = read_buffer.readline()
+            if msg is None:
+                return
+            if msg:
+                conn.budget -= 1
+                if flood is not None:
+                    flood.take()
+                self.process_message(select_key, msg)
+                # USER and SERVER replace the ConnectionData registered with the selector (the Connection moves over
+                # to the new object), so fetch the current key before handling the next message. The socket may also
+                # have been closed by the handler.
+                try:
+                    select_key = self.sel.get_key(fileobj)
+                except (KeyError, ValueError):
+                    return
+                data = select_key.data
+
+    # Put a connection that has used up its message budget at the end of the backlog. The asyncio engine keeps
+    # delivering data as it arrives, so it is also told to stop reading from the connection until its turn comes
+    def defer_input(self, data):
+        self.backlog.append(data)
+        if isinstance(self.sel, AsyncioSelector):
+            self.sel.hold_input(data)
+
+    # Give every connection in the backlog another turn, in the order they ran out of budget. A connection that has
+    # already used up its budget for this pass of the loop waits for the next one
+    def run_backlog(self):
+        for data in list(self.backlog):
+            conn = data.connection
+            if conn.tick == self.tick and not conn.budget:
+                continue
+            try:
+                select_key = self.sel.get_key(conn.sock)
+            except (KeyError, ValueError):
+                select_key = None
+            if select_key is None or select_key.data is not data:
+                # The connection has been closed
+                self.backlog.discard(data)
+                continue
+            self.process_data(select_key, b"")
+
+    # Stop reading from a client that has run out of tokens, until it will have one again
+    def throttle(self, data):
+        data.connection.reading = False
+        self.update_events(data)
+        self.throttled[data] = self.schedule_timer(data.connection.flood.delay(), self.resume_throttled, data)
+
+    # Start reading again from a throttled client, beginning with the lines already buffered
+    def resume_throttled(self, data):
+        if self.throttled.pop(data, None) is not None:
+            data.connection.reading = True
+            self.update_events(data)
+            self.process_data(self.sel.get_key(data.connection.sock), b"")
+
+    # Separate a single message (without the trailing \r\n) into its prefix, command, and params, and then
+    # dispatch it to the appropriate message handler
+    def process_message(self, select_key, msg):
+        msg = IRCMessage.parse(msg)
+        if msg.command not in self.message_handlers:
+            self.print_debug("Ignoring unknown command: %s" % msg)
+            return
+        burst = self.burst_in_progress(select_key)
+        if burst is not None and msg.command not in BURST_COMMANDS:
+            burst.deferred.append(msg)
+            return
+        self.message_handlers[msg.command](select_key, msg.prefix, msg.command, msg.handler_params())
 
       ######################################################################
       # This block of functions should handle all functionality realted to how
@@ -358,7 +874,7 @@ class IRCServer(object):
       # TODO: Write the code required when the server has a message to be sent to another server
 
     def send_message_to_server(self, name_of_server_to_send_to, message):
-        self.servers_lookuptable[name_of_server_to_send_to].write_buffer += message
+        self.queue_message(self.server_routes[name_of_server_to_send_to], message)
 
     # This function should implement the functionality used to send a message to a client. This function
     # will be slightly different from send_message_to_server(), as messages addressed to clients are first
@@ -368,13 +884,8 @@ class IRCServer(object):
     # TODO: Write the code required when the server has a message to be sent to a client
 
     def send_message_to_client(self, name_of_client_to_send_to, message):
-        
-        user = name_of_client_to_send_to
-        if user in self.adjacent_users:
-            self.users_lookuptable[user].write_buffer += message
-        else:
-            prev_client = self.users_lookuptable[user].first_link
-            self.send_message_to_server(prev_client, message)
+        # The routing table already holds the connection to queue on, whether the user is local or not
+        self.queue_message(self.user_routes[name_of_client_to_send_to], message)
 
 
     # When responding to an error, you may not yet know the name of client/server when sent the message
@@ -385,7 +896,108 @@ class IRCServer(object):
     # TODO: Write the code required when the server has a message to be sent through a select_key
 
     def send_message_to_select_key(self, select_key, message):
-        select_key.data.write_buffer += message
+        self.queue_message(select_key.data, message)
+
+    # Messages going to several connections at once (server broadcasts, channel messages) are encoded a single time,
+    # and the same immutable bytes object is shared by every recipient's write buffer
+    def send_message_to_many(self, connections, message):
+        if isinstance(message, str):
+            message = message.encode()
+        for data in connections:
+            self.queue_message(data, message)
+
+    # Every outgoing message ends up here. The message is added to the connection's write buffer, and if the socket
+    # isn't already registered for WRITE events it is now, so select() will tell us when we can send it.
+    # data is always the UserDetails/ServerDetails (or ConnectionData) of an adjacent connection: the routing tables
+    # lead to the next hop, and only adjacent connections have a Connection with buffers
+    # A connection whose queue grows past its send queue limit is not reading what it is sent. It is noted in
+    # slow_consumers the moment it crosses the limit, and disconnected by evict_slow_consumers()
+    def queue_message(self, data, message):
+        if isinstance(message, str):
+            message = message.encode()
+        conn = data.connection
+        write_buffer = conn.write_buffer
+        write_buffer.append(message)
+        pending = len(write_buffer)
+        if pending > self.sendq_peak:
+            self.sendq_peak = pending
+        limit = self.sendq_server if isinstance(data, ServerDetails) else self.sendq_client
+        if pending > limit >= pending - len(message):
+            self.slow_consumers.append(data)
+        if not conn.writing and conn.sock is not None:
+            conn.writing = True
+            self.update_events(data)
+
+    # Disconnect every connection that is still over its send queue limit. This is called between events rather than
+    # from queue_message() itself, since the handler that filled the queue may still be working through the members of
+    # a channel or the users behind a link (and the queue may have been handed to the socket since). A user's
+    # neighbours and the other servers are told with a QUIT, and a lost server link is handled as a netsplit
+    def evict_slow_consumers(self):
+        while self.slow_consumers:
+            data = self.slow_consumers.pop()
+            conn = data.connection
+            try:
+                self.sel.get_key(conn.sock)
+            except (KeyError, ValueError, AttributeError):
+                # Already disconnected
+                continue
+            limit = self.sendq_server if isinstance(data, ServerDetails) else self.sendq_client
+            if len(conn.write_buffer) <= limit:
+                continue
+            self.sendq_evictions += 1
+            self.print_info("[%s] Disconnecting %s: more than %i bytes queued" %
+                            (self.servername, self.connection_name(data), limit))
+            self.close_connection(conn.sock, "SendQ exceeded")
+
+    # A name for a connection to use in log messages
+    def connection_name(self, data):
+        if isinstance(data, (UserDetails, ServerDetails)):
+            return self.route_name(data)
+        return "unregistered connection"
+
+    # Called once a connection's write buffer has been emptied, or as much of it as the socket would take has been
+    # sent. A burst being streamed to the connection is topped up here
+    def stop_writing(self, data):
+        conn = data.connection
+        if isinstance(data, ServerDetails) and data.outgoing_burst is not None \
+                and len(conn.write_buffer) < BURST_LOW_WATER:
+            self.continue_burst(data)
+        if conn.writing and not conn.write_buffer:
+            conn.writing = False
+            self.update_events(data)
+
+    # Tell the selector which events to watch a connection's socket for: READ unless flood control has paused reading,
+    # and WRITE while there is output queued. The selectors module can't watch a socket for no events at all, so a
+    # paused connection with nothing to send is taken out of the selector until one of those changes
+    def update_events(self, data):
+        conn = data.connection
+        events = 0
+        if conn.reading:
+            events = selectors.EVENT_READ
+        if conn.writing:
+            events |= selectors.EVENT_WRITE
+        if events or isinstance(self.sel, AsyncioSelector):
+            try:
+                self.sel.modify(conn.sock, events, data)
+            except KeyError:
+                self.sel.register(conn.sock, events, data)
+        else:
+            self.sel.unregister(conn.sock)
+
+    # Replace the ConnectionData registered for a socket with a UserDetails or ServerDetails object. The Connection
+    # (the socket, any buffered input, any output that is still waiting to be sent, ...) is handed over as it is,
+    # except that server links aren't flood controlled. The registration timeout is replaced by the keepalive
+    def replace_connection_data(self, select_key, data):
+        old_data = select_key.data
+        conn = old_data.connection
+        if conn.timer is not None:
+            self.timers.cancel(conn.timer)
+        old_data.connection = None
+        data.connection = conn
+        if isinstance(data, ServerDetails):
+            conn.flood = None
+        conn.timer = self.schedule_timer(self.ping_interval, self.check_keepalive, data)
+        self.update_events(data)
 
     # Messages will sometimes need to be sent to every server in the IRC network. This is a helper function
     # to make that process easier. You may call send_message_to_server() in this function. Make sure you only
@@ -400,19 +1012,45 @@ class IRCServer(object):
     def broadcast_message_to_servers(self, message, ignore_server=None):
         # Traverse adjacent server list and lookup each server in the server_lookup_table
         # Then use the associated Server Details obj's write buffer to store the broadcasted message.
-
+        recipients = []
         for server in self.adjacent_servers:
-            adj_server = self.servers_lookuptable.get(server)
-            if(adj_server.servername != ignore_server):
-                self.send_message_to_server(adj_server.servername, message)
+            if server != ignore_server:
+                recipients.append(self.server_routes[server])
+        self.send_message_to_many(recipients, message)
 
     # This is a helper function that should ingest the name of the numeric reply you want to send, and the message
     # associated with that numeric reply, and will return a fully formatted numeric reply. The format for all
     # numeric replies is--> :<server_name> <numeric code> <message>
+    # The reply is returned already encoded, so it can be queued on a connection without being copied again
 
     def create_numeric_reply(self, reply_key, message):
         code = self.reply_codes[reply_key]
-        return ":%s %d %s\r\n" % (self.servername, code, message)
+        return (":%s %d %s\r\n" % (self.servername, code, message)).encode()
+
+    # The nick a command that comes from a user (JOIN, PART, QUIT, ...) is from: the prefix when a server passes the
+    # command on, and otherwise the user registered on the connection. A connection that hasn't sent USER or SERVER yet
+    # is sent ERR_NOTREGISTERED, and a command from a server with no prefix or an unknown one is dropped. In both
+    # cases None is returned, and the handler ignores the command
+    def command_sender(self, select_key, prefix, command):
+        data = select_key.data
+        if not isinstance(data, (UserDetails, ServerDetails)):
+            err_msg = self.create_numeric_reply("ERR_NOTREGISTERED", command + " :You have not registered")
+            self.send_message_to_select_key(select_key, err_msg)
+            return None
+        nick = prefix or getattr(data, "nick", None)
+        if nick is None or nick not in self.users_lookuptable:
+            return None
+        return nick
+
+    # USER and SERVER register the connection they arrive on. A connection that has registered already is sent
+    # ERR_ALREADYREGISTRED, since registering it again would move its Connection away from the UserDetails or
+    # ServerDetails that the lookup tables and routes still lead to. Returns True if the command must be ignored
+    def reject_reregistration(self, select_key, command):
+        if not isinstance(select_key.data, (UserDetails, ServerDetails)):
+            return False
+        err_msg = self.create_numeric_reply("ERR_ALREADYREGISTRED", command + " :You may not reregister")
+        self.send_message_to_select_key(select_key, err_msg)
+        return True
 
     ######################################################################
     # The remaining functions are command handlers. Each command handler is documented with the functionality that
@@ -454,28 +1092,32 @@ class IRCServer(object):
     # messages received from that socket
 
     def handle_user_message(self, select_key, prefix, command, params):
+        burst = self.burst_in_progress(select_key)
+        if burst is not None:
+            burst.users.append(params)
+            return
 
-        if len(params) < 4:
+        if not prefix and self.reject_reregistration(select_key, command):
+            return
+        if not params or len(params) < 4:
             # Error handling for invalid param count or nickname collisions
             err_msg = command + " :Not enough parameters"
             err_msg = self.create_numeric_reply("ERR_NEEDMOREPARAMS", err_msg)
             self.send_message_to_select_key(select_key, err_msg)
-            print("this is the numeric reply: ", err_msg)
             return
-        for user in self.users_lookuptable.values():
-            if(user.nick == params[0]):
-                err_msg = params[0] + ":Nickname collision KILL from " + \
-                    params[1] + "@" + params[2]
-                err_msg = self.create_numeric_reply(
-                    "ERR_NICKCOLLISION", err_msg)
-                self.send_message_to_select_key(select_key, err_msg)
-                return
+        if self.find_user(params[0]):
+            err_msg = params[0] + " :Nickname collision KILL from " + \
+                params[1] + "@" + params[2]
+            err_msg = self.create_numeric_reply(
+                "ERR_NICKCOLLISION", err_msg)
+            self.send_message_to_select_key(select_key, err_msg)
+            return
 
         # Create new user object and set it's parameters based on passed in params
         newUser = UserDetails()
         newUser.nick = params[0]
-        newUser.hostname = params[1]
-        newUser.servername = params[2]
+        newUser.hostname = sys.intern(params[1])
+        newUser.servername = sys.intern(params[2])
         newUser.realname = params[3]
 
         # If there is not a prefix: add connecting user to the adjacent lookup list
@@ -487,11 +1129,15 @@ class IRCServer(object):
             newUser.first_link = self.servername
             self.adjacent_users.append(newUser.nick)
         else:
-            newUser.first_link = prefix
+            newUser.first_link = sys.intern(prefix)
 
-        self.users_lookuptable[params[0]] = newUser
+        self.add_user(newUser)
 
         if not prefix:
+            # Modify the selector with new user object if new user directly connects to the server. This hands the
+            # user its connection, so it comes before anything is queued for the user
+            self.replace_connection_data(select_key, newUser)
+
             # Moved this logic below the store-to-lookuptable for order of operations
             # Create the welcome msg and send it to the client
             reg_msg = ":Welcome to the Internet Relay Network " + \
@@ -500,14 +1146,9 @@ class IRCServer(object):
             self.send_message_to_client(newUser.nick, reg_msg)
         
         # Create user msg to broadcast to network
-        message = ":" + self.servername + " USER " + newUser.nick + " " + \
-            newUser.hostname + " " + newUser.servername + " :" + newUser.realname + "\r\n"
-        self.broadcast_message_to_servers(message, prefix)
-
-        # Modify the selector with new user object if new user directly connects to the server
-        if newUser.first_link == self.servername:
-            events = selectors.EVENT_WRITE | selectors.EVENT_READ
-            self.sel.modify(select_key.fileobj, events, newUser)
+        message = IRCMessage("USER", [newUser.nick, newUser.hostname, newUser.servername], newUser.realname,
+                             prefix=self.servername)
+        self.broadcast_message_to_servers(message.serialize(), prefix)
 
     ######################################################################
     # Server message
@@ -543,18 +1184,26 @@ class IRCServer(object):
     # messages received from that socket
 
     def handle_server_message(self, select_key, prefix, command, params):
+        burst = self.burst_in_progress(select_key)
+        if burst is not None:
+            burst.servers.append(params)
+            return
 
         # Dr. Robb said all the test cases have 3 params
         # but error handling for invalid param count has been implemented just in case
+        # A SERVER with a hopcount of 1 registers the connection it arrives on, whether it is the new server introducing
+        # itself or the answer from the server we connected to
+        if (not prefix or (params and params[1:2] == ["1"])) and self.reject_reregistration(select_key, command):
+            return
         serverData = ServerDetails()
-        if(len(params) == 3):
-            serverData.servername = params[0]
+        if params and len(params) == 3:
+            serverData.servername = sys.intern(params[0])
             serverData.hopcount = params[1]
             serverData.info = params[2]
             if prefix:
-                serverData.first_link = prefix
+                serverData.first_link = sys.intern(prefix)
             else:
-                serverData.first_link = params[0]
+                serverData.first_link = serverData.servername
         else:
             err_msg = command + " :Not enough parameters"
             err_msg = self.create_numeric_reply("ERR_NEEDMOREPARAMS", err_msg)
@@ -563,34 +1212,38 @@ class IRCServer(object):
 
         # Update server lookup table, create new broadcast message
         # param[1] is hopcount and MUST BE incremented each time it is sent to account for new hops
-        self.servers_lookuptable.update({serverData.servername: serverData})
-        msg = ":{0} SERVER {1} {2} :{3}\r\n".format(
-            self.servername, params[0], str(int(params[1])+1), params[2])
-        self.broadcast_message_to_servers(msg, serverData.first_link)
+        self.add_server(serverData)
+        msg = IRCMessage("SERVER", [params[0], str(int(params[1])+1)], params[2], prefix=self.servername)
+        self.broadcast_message_to_servers(msg.serialize(), serverData.first_link)
 
         # If is server is adjacent add to adjacent list and modify the ConnectionData object to the serverdetails object
         if params[1] == "1":
             # add adjacent server to adjacent server list
             self.adjacent_servers.append(params[0])
             # only modify selector on adjacent servers
-            events = selectors.EVENT_READ | selectors.EVENT_WRITE
-            # modify selector last IFF it's and adjecent server
-            self.sel.modify(select_key.fileobj, events, serverData)
+            self.replace_connection_data(select_key, serverData)
 
         # If not prefix, update new server with this server's stored servers, users, and channels!!
         if not prefix:
-            for data in self.servers_lookuptable.values():
-                if data.servername != params[0]:
-                    msg = ":{0} SERVER {1} {2} :{3}\r\n".format(
-                        self.servername, data.servername, str(int(data.hopcount)+1), data.info)
-                    self.send_message_to_server(serverData.servername, msg)
-
-            # Special case when new adjacent server must be told about the host server
-            self_msg = ":{0} SERVER {1} {2} :{3}\r\n".format(
-                self.servername, self.servername, 1, self.info)
-            self.send_message_to_server(serverData.servername, self_msg)
+            # Special case when new adjacent server must be told about the host server. This comes first, so the new
+            # server knows which link the burst arrives on
+            self_msg = IRCMessage("SERVER", [self.servername, "1"], self.info, prefix=self.servername)
+            self.send_message_to_server(serverData.servername, self_msg.serialize())
+
+            # A restarting server that sent the digests of its snapshot is only sent what has changed
+            conn = serverData.connection
+            if conn is not None and conn.sync is not None:
+                self.stream_burst(serverData, self.delta_burst(serverData.servername, conn.sync))
+                conn.sync = None
+            else:
+                self.stream_burst(serverData, self.network_burst(serverData.servername))
 
-            # TODO: Need to create user msg and channel msg, and send these msgs to associated servers.
+        # This is the answer from the server we connected to. Any servers that linked to us, or users that registered
+        # with us, before it arrived were not announced to it, so they are sent as a burst of our own
+        elif params[1] == "1":
+            self.uplink = serverData.servername
+            if len(self.servers_lookuptable) > 1 or self.users_lookuptable:
+                self.stream_burst(serverData, self.network_burst(serverData.servername))
 
     ######################################################################
     # Quit message
@@ -612,34 +1265,55 @@ class IRCServer(object):
 
     def handle_quit_message(self, select_key, prefix, command, params):
 
-        user = None
-        link = None
-
-        if not prefix:
-            user = select_key.data.nick  # set user to user name stored in select_key
-            # set link the the first_link stored in select_key
-            link = select_key.data.first_link
-
-            if user in self.adjacent_users:  # remove user from adjacent list
-                self.adjacent_users.remove(user)
-
-            if user in self.users_lookuptable:  # remove user from lookuptable
-                del self.users_lookuptable[user]
+        user = self.command_sender(select_key, prefix, command)
+        if user is None:
+            return
+        self.quit_user(user, params[0] if params else None)
+
+    # Remove a user that has quit, whether it sent QUIT itself or its connection was closed (see close_connection()),
+    # and tell the rest of the network. Only a goodbye message is passed on to the users this server has in the user's
+    # channels; the other servers are always sent the QUIT
+    def quit_user(self, user, goodbye=None):
+        link = self.users_lookuptable[user].first_link
+        quit_msg = IRCMessage("QUIT", trailing=goodbye, prefix=user).serialize()
+        if goodbye is not None:
+            self.send_message_to_channel_neighbours(user, quit_msg)
+        if self.journal is not None:
+            self.journal_quit(user, quit_msg)
+
+        self.adjacent_users.discard(user)  # remove user from adjacent list
+        self.remove_user(user)  # remove user from lookuptable and from every channel it was in
 
-        else:
-            user = prefix
-            link = self.users_lookuptable[user].first_link
-            if user in self.users_lookuptable:
-                del self.users_lookuptable[user]
+        self.broadcast_message_to_servers(quit_msg, link)
 
-        # Generate QUIT message
-        quit_msg = ":" + user + " QUIT"  # default msg
+    ######################################################################
+    # Server quit message
+    # Command: SQUIT
+    # Parameters:
+    #   <servername>: the name of the server that has left the network
+    #   <comment>: the reason the server left
+    # Examples:
+    #   :rivendale.irc.com SQUIT gondolin.irc.com :rivendale.irc.com gondolin.irc.com     # gondolin.irc.com is no longer
+    #                                                                                   # reachable
+    # Numeric replies:
+    #   None
+    # Notes:
+    # This is not part of the assignment. A server sends SQUIT for each server it can no longer reach after losing a
+    # link (see netsplit()), right after a QUIT for each user behind that link. The server is removed from
+    # servers_lookuptable and the routing table, and the message is passed on to all other servers.
 
-        if params:  # if quit-specific info is available
-            quit_msg += " :" + params[0]
-        quit_msg += "\r\n"
+    def handle_squit_message(self, select_key, prefix, command, params):
+        if not params:
+            err_msg = self.create_numeric_reply("ERR_NEEDMOREPARAMS", command + " :Not enough parameters")
+            self.send_message_to_select_key(select_key, err_msg)
+            return
+        if params[0] not in self.servers_lookuptable or params[0] in self.adjacent_servers:
+            return
 
-        self.broadcast_message_to_servers(quit_msg, link)
+        link = self.servers_lookuptable[params[0]].first_link
+        self.remove_server(params[0])
+        msg = IRCMessage("SQUIT", params[:1], params[1] if len(params) > 1 else None, prefix=self.servername)
+        self.broadcast_message_to_servers(msg.serialize(), link)
 
     ######################################################################
     # Join message
@@ -671,7 +1345,48 @@ class IRCServer(object):
     # inform users connected to this channel that a new user has joined. The user must call NAMES to fetch that information.
 
     def handle_join_message(self, select_key, prefix, command, params):
-        pass
+        nick = self.command_sender(select_key, prefix, command)
+        if nick is None:
+            return
+        if not params:
+            err_msg = self.create_numeric_reply("ERR_NEEDMOREPARAMS", command + " :Not enough parameters")
+            self.send_message_to_select_key(select_key, err_msg)
+            return
+
+        channelname = params[0]
+        key = params[1] if len(params) > 1 else None
+        channel = self.find_channel(channelname)
+
+        if not prefix:
+            if not channelname.startswith("#"):
+                err_msg = self.create_numeric_reply("ERR_NOSUCHCHANNEL", channelname + " :No such channel")
+                self.send_message_to_select_key(select_key, err_msg)
+                return
+            if channel and channel.key is not None and channel.key != key:
+                err_msg = self.create_numeric_reply("ERR_BADCHANNELKEY", channel.channelname + " :Cannot join channel (+k)")
+                self.send_message_to_select_key(select_key, err_msg)
+                return
+
+        # The user who joins a channel that doesn't exist yet creates it, with the key they gave (if any)
+        if channel is None:
+            channel = Channel()
+            channel.channelname = channelname
+            channel.key = key
+            self.add_channel(channel)
+        self.add_channel_member(channel, nick)
+
+        if not prefix:
+            self.send_message_to_client(nick, self.topic_reply(channel))
+
+        # Other servers check the key against their own copy of the channel, so it is passed on as well
+        join_params = [channel.channelname]
+        if channel.key is not None:
+            join_params.append(channel.key)
+        msg = IRCMessage("JOIN", join_params, prefix=nick)
+        if self.journal is not None:
+            self.journal_message([channel.channelname], IRCMessage("JOIN", [channel.channelname],
+                                                                   prefix=nick).serialize())
+        self.broadcast_message_to_servers(msg.serialize(), self.users_lookuptable[nick].first_link)
 
     ######################################################################
     # Part message
@@ -693,7 +1408,35 @@ class IRCServer(object):
     # of the user's departure from this channel.
 
     def handle_part_message(self, select_key, prefix, command, params):
-        pass
+        nick = self.command_sender(select_key, prefix, command)
+        if nick is None:
+            return
+        if not params:
+            err_msg = self.create_numeric_reply("ERR_NEEDMOREPARAMS", command + " :Not enough parameters")
+            self.send_message_to_select_key(select_key, err_msg)
+            return
+
+        channel = self.find_channel(params[0])
+        if channel is None:
+            if not prefix:
+                err_msg = self.create_numeric_reply("ERR_NOSUCHCHANNEL", params[0] + " :No such channel")
+                self.send_message_to_select_key(select_key, err_msg)
+            return
+        if nick not in channel.users:
+            if not prefix:
+                err_msg = self.create_numeric_reply("ERR_NOTONCHANNEL", channel.channelname + " :You're not on that channel")
+                self.send_message_to_select_key(select_key, err_msg)
+            return
+
+        link = self.users_lookuptable[nick].first_link
+        msg = IRCMessage("PART", [channel.channelname], prefix=nick)
+        if self.journal is not None:
+            self.journal_message([channel.channelname], msg.serialize())
+        self.remove_channel_member(channel, nick)
+        self.broadcast_message_to_servers(msg.serialize(), link)
+        # The PART is echoed back to the user who sent it, so their client knows they have left
+        if not prefix:
+            self.send_message_to_select_key(select_key, msg.serialize())
 
     ######################################################################
     # Topic message
@@ -723,7 +1466,39 @@ class IRCServer(object):
     # response. If the server receives a message for a channel that does not exist, it should return a ERR_NOSUCHCHANNEL response.
 
     def handle_topic_message(self, select_key, prefix, command, params):
-        pass
+        nick = self.command_sender(select_key, prefix, command)
+        if nick is None:
+            return
+        if not params:
+            err_msg = self.create_numeric_reply("ERR_NEEDMOREPARAMS", command + " :Not enough parameters")
+            self.send_message_to_select_key(select_key, err_msg)
+            return
+
+        channel = self.find_channel(params[0])
+
+        if not prefix:
+            if channel is None:
+                err_msg = self.create_numeric_reply("ERR_NOSUCHCHANNEL", params[0] + " :No such channel")
+                self.send_message_to_select_key(select_key, err_msg)
+                return
+            if nick not in channel.users:
+                err_msg = self.create_numeric_reply("ERR_NOTONCHANNEL", channel.channelname + " :You're not on that channel")
+                self.send_message_to_select_key(select_key, err_msg)
+                return
+            if len(params) == 1:
+                self.send_message_to_select_key(select_key, self.topic_reply(channel))
+                return
+        elif channel is None:
+            return
+
+        # Every member of the channel connected to this server (the user who set the topic included) is told about the
+        # new topic, and every other server keeps a copy of it
+        channel.topic = params[1]
+        self.send_message_to_many(channel.local_members.values(), self.topic_reply(channel))
+        msg = IRCMessage("TOPIC", [channel.channelname], channel.topic, prefix=nick)
+        if self.journal is not None:
+            self.journal_message([channel.channelname], msg.serialize())
+        self.broadcast_message_to_servers(msg.serialize(), select_key.data.first_link)
 
     # This is a response handler, which is called when a new server is sent a NOTOPIC rpl from an existing server
     # This message contains the name of a channel and the information that no topic has been set at the time
@@ -733,7 +1508,7 @@ class IRCServer(object):
     #       that would need to be fixed if this code were to be deployed
 
     def handle_notopic_rpl(self, select_key, prefix, command, params):
-        pass
+        self.handle_topic_rpl(select_key, prefix, command, params)
 
     # This is a response handler, which is called when a new server is sent a TOPIC rpl from an existing server
     # This message contains the name of a channel and the topic that has been set at the time
@@ -742,8 +1517,20 @@ class IRCServer(object):
     # NOTE: This design cannot accomodate setting keys for existing servers. Set the key to null. This is a bug
     #       that would need to be fixed if this code were to be deployed
 
+    # Both replies carry the channel's key (if it has one) after the channel name, which fixes the bug described above.
+    # They are collected in the burst they arrive in, and applied along with the rest of it when it ends
+
     def handle_topic_rpl(self, select_key, prefix, command, params):
-        pass
+        if not params:
+            return
+        key = None
+        topic = None
+        if command == "332":
+            topic = params[-1]
+            params = params[:-1]
+        if len(params) > 1:
+            key = params[1]
+        self.receive_burst_line(select_key, "channels", (params[0], key, topic))
 
     ######################################################################
     # Names message
@@ -766,15 +1553,432 @@ class IRCServer(object):
     # If the user requests the users on a channel that does not exist, return a ERR_NOSUCHCHANNEL response.
 
     def handle_names_message(self, select_key, prefix, command, params):
-        pass
+        if prefix:
+            return
+
+        if params:
+            channel = self.find_channel(params[0])
+            if channel is None:
+                err_msg = self.create_numeric_reply("ERR_NOSUCHCHANNEL", params[0] + " :No such channel")
+                self.send_message_to_select_key(select_key, err_msg)
+                return
+            channels = [channel]
+            unjoined = None
+        else:
+            channels = self.channels.values()
+            unjoined = [nick for nick in self.users_lookuptable if nick not in self.user_channels]
+
+        replies = []
+        for channel in channels:
+            replies.extend(self.names_replies(channel.channelname, sorted(channel.users)))
+        if unjoined:
+            replies.extend(self.names_replies("*", sorted(unjoined)))
+        # The end of the list names the channel that was asked for, or * when every channel was
+        listed = channels[0].channelname if params else "*"
+        replies.append(self.create_numeric_reply("RPL_ENDOFNAMES", listed + " :End of /NAMES list"))
+        self.send_message_to_select_key(select_key, b"".join(replies))
+
+    # Build the RPL_NAMREPLY messages listing nicks as members of channelname. Long lists are split over several
+    # messages, so each one stays within MAX_LINE_LENGTH
+    def names_replies(self, channelname, nicks):
+        room = MAX_LINE_LENGTH - len(":%s 353 %s :\r\n" % (self.servername, channelname))
+        for names in self.pack_names(nicks, room, " "):
+            yield self.create_numeric_reply("RPL_NAMREPLY", channelname + " :" + names)
 
     # This is a response handler, which is called when a new server is sent a NAMES rpl from an existing server
     # This message contains information about the users who are registered with an existing channel at the time
     # this server is started. This method will be much simpler than most other message handlers
     # TODO: Add the users to the appropriate channel
 
+    # A single RPL_NAMREPLY carries as many nicks as fit on the line, so a burst only needs a few of them per channel
+
     def handle_names_rpl(self, select_key, prefix, command, params):
-        pass
+        if params and len(params) > 1:
+            self.receive_burst_line(select_key, "names", (params[0], params[1].split()))
+
+    ######################################################################
+    # Burst messages
+    # Command: BURST, EOB
+    # Parameters:
+    #   None
+    # Examples:
+    #   :gondor.irc.com BURST       # The messages that follow describe the servers, users and channels known to gondor
+    #   :gondor.irc.com EOB         # The end of the burst
+    # Numeric replies:
+    #   None
+    # Notes:
+    # When a new server links, the server it connects to describes the rest of the network to it in a burst: SERVER and
+    # USER messages for every known server and user, an RPL_NOTOPIC or RPL_TOPIC for every channel (with its key, if it
+    # has one), and RPL_NAMREPLY messages listing the members of each channel, many nicks per message. Rather than
+    # running the SERVER and USER handlers once per message, which would announce every server and user to the rest of
+    # the network one at a time, the messages are collected until EOB arrives. The whole burst is then added to the
+    # lookup tables at once, and whatever was new is passed on to the other adjacent servers as a burst of its own.
+
+    def handle_burst_message(self, select_key, prefix, command, params):
+        if isinstance(select_key.data, ServerDetails):
+            select_key.data.burst = Burst()
+
+    # Messages that arrived in the middle of the burst are handled once it has been applied. Any that are about users
+    # or servers the burst turned out not to contain (they left while the burst was being sent) are dropped
+
+    def handle_eob_message(self, select_key, prefix, command, params):
+        burst = self.burst_in_progress(select_key)
+        if burst is None:
+            return
+        select_key.data.burst = None
+        self.apply_burst(select_key.data.servername, burst)
+        for msg in burst.deferred:
+            if msg.prefix not in self.users_lookuptable and msg.prefix not in self.servers_lookuptable:
+                continue
+            self.message_handlers[msg.command](select_key, msg.prefix, msg.command, msg.handler_params())
+
+    # Return the burst the server on select_key is in the middle of sending, or None
+    def burst_in_progress(self, select_key):
+        if isinstance(select_key.data, ServerDetails):
+            return select_key.data.burst
+        return None
+
+    # Add a line of channel information to the burst in progress. Outside of a burst it makes up a burst of its own
+    def receive_burst_line(self, select_key, field, entry):
+        if not isinstance(select_key.data, ServerDetails):
+            return
+        burst = self.burst_in_progress(select_key)
+        if burst is not None:
+            getattr(burst, field).append(entry)
+        else:
+            burst = Burst()
+            getattr(burst, field).append(entry)
+            self.apply_burst(select_key.data.servername, burst)
+
+    # Add everything a burst received from the adjacent server link describes, skipping servers, users and channel
+    # members that are already known, and pass what was new on to the other adjacent servers
+    def apply_burst(self, link, burst):
+        servers = []
+        for params in burst.servers:
+            if len(params) < 3 or params[0] == self.servername or params[0] in self.servers_lookuptable:
+                continue
+            server = ServerDetails()
+            server.servername = sys.intern(params[0])
+            server.hopcount = params[1]
+            server.info = params[2]
+            server.first_link = link
+            self.add_server(server)
+            servers.append(server)
+
+        users = []
+        for params in burst.users:
+            if len(params) < 4:
+                continue
+            if self.find_user(params[0]):
+                self.print_error("[%s] Nickname collision in burst from %s: %s" % (self.servername, link, params[0]))
+                continue
+            user = UserDetails()
+            user.nick = params[0]
+            user.hostname = sys.intern(params[1])
+            user.servername = sys.intern(params[2])
+            user.realname = params[3]
+            user.first_link = link
+            self.add_user(user)
+            users.append(user)
+
+        for channelname, key, topic in burst.channels:
+            channel = self.find_channel(channelname)
+            if channel is None:
+                channel = Channel()
+                channel.channelname = channelname
+                channel.key = key
+                self.add_channel(channel)
+            if channel.topic is None:
+                channel.topic = topic
+
+        members = []
+        for channelname, nicks in burst.names:
+            channel = self.find_channel(channelname)
+            if channel is None:
+                channel = Channel()
+                channel.channelname = channelname
+                self.add_channel(channel)
+            added = []
+            for nick in nicks:
+                if nick in self.users_lookuptable and nick not in channel.users:
+                    self.add_channel_member(channel, nick)
+                    added.append(nick)
+            if added:
+                members.append((channel, added))
+            elif not channel.users:
+                self.remove_channel(channel.channelname)
+
+        self.print_info("[%s] Burst from %s: %d servers, %d users, %d channels" %
+                        (self.servername, link, len(servers), len(users), len(members)))
+
+        if servers or users or members:
+            for servername in self.adjacent_servers:
+                if servername != link:
+                    self.stream_burst(self.servers_lookuptable[servername], self.build_burst(servers, users, members))
+
+    # Start streaming a burst (an iterator of encoded messages) to the adjacent server described by server. If a burst
+    # is already being streamed to it, this one follows when that one is done
+    def stream_burst(self, server, burst):
+        if server.outgoing_burst is None:
+            server.outgoing_burst = burst
+        else:
+            server.outgoing_burst = itertools.chain(server.outgoing_burst, burst)
+        self.continue_burst(server)
+
+    # Queue the next part of the burst being streamed to server, until BURST_HIGH_WATER bytes are waiting to be sent
+    def continue_burst(self, server):
+        size = len(server.connection.write_buffer)
+        lines = []
+        for line in server.outgoing_burst:
+            lines.append(line)
+            size += len(line)
+            if size >= BURST_HIGH_WATER:
+                break
+        else:
+            server.outgoing_burst = None
+        if lines:
+            self.queue_message(server, b"".join(lines))
+
+    # The burst describing the whole network to the new server servername. Only the names are collected up front:
+    # servers, users and channels are looked up as the burst reaches them, so anything that has gone by then is left
+    # out, and channel members are listed as they are at that point
+    def network_burst(self, servername):
+        servernames = [name for name in self.servers_lookuptable if name != servername]
+        nicks = list(self.users_lookuptable)
+        channelnames = list(self.channels)
+        servers = (self.servers_lookuptable[name] for name in servernames if name in self.servers_lookuptable)
+        users = (self.users_lookuptable[nick] for nick in nicks if nick in self.users_lookuptable)
+        channels = ((self.channels[name], list(self.channels[name].users)) for name in channelnames
+                    if name in self.channels)
+        return self.build_burst(servers, users, channels)
+
+    # Build the messages of a burst describing servers, users, and the given members of each channel (channels is a
+    # list of (Channel, nicks) pairs). Servers are described as seen from the server the burst is sent to, one hop
+    # further away than they are from here
+    def build_burst(self, servers, users, channels):
+        yield IRCMessage("BURST", prefix=self.servername).serialize()
+        for server in servers:
+            yield IRCMessage("SERVER", [server.servername, str(int(server.hopcount) + 1)], server.info,
+                             prefix=self.servername).serialize()
+        for user in users:
+            yield IRCMessage("USER", [user.nick, user.hostname, user.servername], user.realname,
+                             prefix=self.servername).serialize()
+        for channel, nicks in channels:
+            params = [channel.channelname]
+            if channel.key is not None:
+                params.append(channel.key)
+            if channel.topic is None:
+                yield IRCMessage(str(self.reply_codes["RPL_NOTOPIC"]), params, prefix=self.servername).serialize()
+            else:
+                yield IRCMessage(str(self.reply_codes["RPL_TOPIC"]), params, channel.topic,
+                                 prefix=self.servername).serialize()
+            room = MAX_LINE_LENGTH - len(":%s 353 %s :\r\n" % (self.servername, channel.channelname))
+            for names in self.pack_names(nicks, room, " "):
+                yield IRCMessage(str(self.reply_codes["RPL_NAMREPLY"]), [channel.channelname], names,
+                                 prefix=self.servername).serialize()
+        yield IRCMessage("EOB", prefix=self.servername).serialize()
+
+    ######################################################################
+    # Sync message
+    # Command: SYNC
+    # Parameters:
+    #   <servername>: the server the snapshot was taken behind (only from the restarting server)
+    #   <digests>/<buckets>: the digests of the snapshot's buckets, or the numbers of the buckets that have changed
+    # Examples:
+    #   SYNC gondor.irc.com :00a1b2...          # A restarting server, before its SERVER message: the digests of the
+    #                                           # BUCKET_COUNT buckets of its snapshot, 16 hex digits each
+    #   :gondor.irc.com SYNC :3 17 96           # The answer, before the burst: the buckets that have changed
+    # Numeric replies:
+    #   None
+    # Notes:
+    # A server that restarts with a snapshot (see IRCSnapshot) sends its uplink the digests of the snapshot before
+    # registering. If the snapshot was taken behind this server, the burst sent back only describes the servers, users
+    # and channels in the buckets whose digests differ, following a SYNC that lists those buckets. The restarting
+    # server takes the rest of the network over from its snapshot as soon as that SYNC arrives. A server that doesn't
+    # know SYNC ignores it and sends a full burst, and so does a server the snapshot wasn't taken behind.
+
+    def handle_sync_message(self, select_key, prefix, command, params):
+        data = select_key.data
+        if not params:
+            return
+        if prefix is None:
+            if isinstance(data, (UserDetails, ServerDetails)) or len(params) < 2 or params[0] != self.servername \
+                    or len(params[1]) != 16 * BUCKET_COUNT:
+                return
+            try:
+                data.connection.sync = [int(params[1][i:i + 16], 16) for i in range(0, 16 * BUCKET_COUNT, 16)]
+            except ValueError:
+                pass
+        elif isinstance(data, ServerDetails) and prefix == data.servername and self.snapshot is not None \
+                and prefix == self.snapshot.uplink:
+            try:
+                changed = set(int(bucket) for bucket in params[-1].split())
+            except ValueError:
+                return
+            self.restore_snapshot(prefix, changed)
+
+    ######################################################################
+    # This block of functions saves snapshots of the server's state, and uses them to get back into the network quickly
+    # after a restart (see IRCSnapshot and SYNC)
+
+    # Add the records describing this server's state to a SnapshotBuilder. Without a link, this is a snapshot of our
+    # own: every server, user and channel is added (a channel with the members behind our uplink), and the ones
+    # behind our uplink count towards the digests (apart from the uplink itself, which introduces itself when we link
+    # again). With a link, the state is described the way a burst to the
+    # adjacent server link would describe it, to compare with that server's snapshot
+    def describe_state(self, builder, link=None):
+        uplink = self.uplink
+        for server in self.servers_lookuptable.values():
+            if server.servername == link:
+                continue
+            hopcount = server.hopcount if link is None else str(int(server.hopcount) + 1)
+            builder.add(b"S", server.servername, server_record(server.servername, hopcount, server.info),
+                        server.first_link, link is not None or (server.first_link == uplink and
+                                                                server.servername != uplink))
+        for user in self.users_lookuptable.values():
+            builder.add(b"U", user.nick, user_record(user.nick, user.hostname, user.servername, user.realname),
+                        user.first_link, link is not None or user.first_link == uplink)
+        users = self.users_lookuptable
+        for channel in self.channels.values():
+            if link is None:
+                members = [nick for nick in channel.users if users[nick].first_link == uplink]
+            else:
+                members = channel.users
+            builder.add(b"C", channel.channelname, channel_record(channel.channelname, channel.key, channel.topic,
+                                                                  members), None, bool(members))
+
+    # Save a snapshot of what this server knows to snapshot_file. This can also be asked for at any time (from another
+    # thread, through call_from_thread()). The state is encoded here, on the loop thread, but written and fsync()ed by
+    # a thread of its own, so the loop doesn't wait for the disk. With wait, this returns once the snapshot is written
+    def save_snapshot(self, wait=False):
+        builder = SnapshotBuilder()
+        self.describe_state(builder)
+        data = builder.serialize(self.servername, self.uplink)
+        if self.snapshot_writer is not None:
+            self.snapshot_writer.join()
+        self.snapshot_writer = threading.Thread(target=self.write_snapshot, args=(data,), daemon=True)
+        self.snapshot_writer.start()
+        if wait:
+            self.snapshot_writer.join()
+
+    def write_snapshot(self, data):
+        try:
+            write_snapshot(self.snapshot_file, data)
+        except OSError as e:
+            self.print_error("[%s] Failed to save a snapshot to %s: %s" % (self.servername, self.snapshot_file, e))
+
+    def periodic_snapshot(self):
+        self.save_snapshot()
+        self.schedule_timer(self.snapshot_interval, self.periodic_snapshot)
+
+    # Map the snapshot saved by the last run of this server, if there is one. Only its header is read; the rest is
+    # decoded by restore_snapshot(), once the uplink has said which parts of it are still up to date
+    def load_snapshot(self):
+        if not os.path.exists(self.snapshot_file):
+            return
+        try:
+            snapshot = Snapshot(self.snapshot_file)
+        except (OSError, ValueError) as e:
+            self.print_error("[%s] Ignoring snapshot: %s" % (self.servername, e))
+            return
+        if snapshot.servername != self.servername or snapshot.uplink is None:
+            snapshot.close()
+            return
+        self.snapshot = snapshot
+        self.print_info("[%s] Loaded a snapshot taken behind %s, %.0f seconds ago" %
+                        (self.servername, snapshot.uplink, time.time() - snapshot.saved_at))
+
+    # The burst for a restarting server whose snapshot has the given digests: a SYNC listing the buckets that differ
+    # from our own, and then the servers, users and channels in those buckets. A user in one of them is also sent with
+    # its membership of the channels in the other buckets
+    def delta_burst(self, servername, digests):
+        builder = SnapshotBuilder(keep_records=False)
+        self.describe_state(builder, servername)
+        changed = set(bucket for bucket in range(BUCKET_COUNT) if builder.digests[bucket] != digests[bucket])
+
+        servernames = [name for name in self.servers_lookuptable
+                       if name != servername and bucket_of(b"S", name) in changed]
+        nicks = [nick for nick in self.users_lookuptable if bucket_of(b"U", nick) in changed]
+        channelnames = [name for name in self.channels if bucket_of(b"C", name) in changed]
+        memberships = {}
+        for nick in nicks:
+            for channelname in self.user_channels.get(nick, ()):
+                if bucket_of(b"C", channelname) not in changed:
+                    memberships.setdefault(channelname, []).append(nick)
+        self.print_info("[%s] %s has a snapshot: %i of %i buckets have changed" %
+                        (self.servername, servername, len(changed), BUCKET_COUNT))
+
+        servers = (self.servers_lookuptable[name] for name in servernames if name in self.servers_lookuptable)
+        users = (self.users_lookuptable[nick] for nick in nicks if nick in self.users_lookuptable)
+        channels = itertools.chain(
+            ((self.channels[name], list(self.channels[name].users)) for name in channelnames if name in self.channels),
+            ((self.channels[name], [nick for nick in members if nick in self.channels[name].users])
+             for name, members in memberships.items() if name in self.channels))
+        reply = IRCMessage("SYNC", trailing=" ".join(str(bucket) for bucket in sorted(changed)),
+                           prefix=self.servername)
+        return itertools.chain([reply.serialize()], self.build_burst(servers, users, channels))
+
+    # Take over the servers, users and channels behind link from the snapshot, apart from the ones in the buckets that
+    # have changed (the burst that follows describes those). They are added like a burst from link, so they are passed
+    # on to the other adjacent servers as well
+    def restore_snapshot(self, link, changed):
+        snapshot = self.snapshot
+        self.snapshot = None
+        burst = Burst()
+        nicks = set()
+        channels = []
+        for bucket in range(BUCKET_COUNT):
+            if bucket in changed:
+                continue
+            for first_link, kind, fields in snapshot.records(bucket):
+                if kind == "C":
+                    channels.append(fields)
+                elif first_link != link:
+                    continue
+                elif kind == "S":
+                    burst.servers.append(fields)
+                else:
+                    burst.users.append(fields)
+                    nicks.add(fields[0])
+        snapshot.close()
+        for channelname, key, topic, members in channels:
+            members = [nick for nick in members if nick in nicks]
+            if members:
+                burst.channels.append((channelname, key, topic))
+                burst.names.append((channelname, members))
+        self.print_info("[%s] Restoring from the snapshot: %i servers, %i users and %i channels (%i buckets changed)" %
+                        (self.servername, len(burst.servers), len(burst.users), len(burst.channels), len(changed)))
+        self.apply_burst(link, burst)
+
+    ######################################################################
+    # This block of functions keeps the journal (see IRCJournal). Messages are journaled as the handlers deliver them,
+    # and handed to the journal's writer thread in batches: when BATCH_SIZE bytes of them are waiting, or when
+    # journal_timer fires, JOURNAL_FLUSH_INTERVAL seconds after the first of them
+
+    def open_journal(self):
+        try:
+            self.journal = Journal(self.journal_dir, fsync=self.journal_fsync, max_size=self.journal_max_size,
+                                   max_age=self.journal_max_age, log_error=self.print_error)
+        except (OSError, ValueError) as e:
+            self.print_error("[%s] Not journaling: %s" % (self.servername, e))
+            return
+        self.print_info("[%s] Journaling to %s from sequence number %i" %
+                        (self.servername, self.journal_dir, self.journal.next_seq))
+
+    # Journal a message (encoded) delivered to targets, the channels and nicks it can be looked up by later
+    def journal_message(self, targets, message):
+        self.journal.append(targets, message)
+        if self.journal_timer is None:
+            self.journal_timer = self.schedule_timer(JOURNAL_FLUSH_INTERVAL, self.flush_journal)
+
+    # A QUIT is journaled for the user and every channel it was in, so it must be journaled before the user is removed
+    def journal_quit(self, nick, message):
+        self.journal_message(list(self.user_channels.get(nick, ())) + [nick], message)
+
+    def flush_journal(self):
+        self.journal_timer = None
+        self.journal.flush()
+        self.journal.prune()
 
     ######################################################################
     # Private message
@@ -799,10 +2003,306 @@ class IRCServer(object):
     # a message to a channel, the server must check to see if any of the users in the channel are adjacent.
     # If the server does not recognize the nick the message is addressed to, it should return a ERR_NOSUCHNICK response.
     # If the server does not recognize the channel the message is addressed to, it should return a ERR_NOSUCHCHANNEL response.
-    # If the user sending the message is not part of the addressed channel, the server should return a ERR_NOSUCHCHANNEL response.
+    # If the user sending the message is not part of the addressed channel, the server should return a ERR_CANNOTSENDTOCHAN
+    # response. (ERR_NOSUCHCHANNEL is kept for channels that don't exist: the channel is there, the user just can't send to
+    # it, and the PRIVMSG_5_ERROR_NotOnChannel test case expects the client to print "Cannot send to channel".)
 
     def handle_privmsg_message(self, select_key, prefix, command, params):
-        pass
+        sender = self.command_sender(select_key, prefix, command)
+        if sender is None:
+            return
+        if not params or len(params) < 2:
+            err_msg = self.create_numeric_reply("ERR_NEEDMOREPARAMS", command + " :Not enough parameters")
+            self.send_message_to_select_key(select_key, err_msg)
+            return
+
+        text = params[1]
+        ignore_server = self.users_lookuptable[sender].first_link
+
+        # The receiver may be a comma separated list of nicks and channels. Every target is resolved to where it has to
+        # go: local users (each of whom gets the message once, addressed to the first target that reached them), and
+        # adjacent servers (each of which gets the message once, addressed to the targets behind it)
+        local_recipients = {}
+        server_targets = {}
+        delivered = []
+        for target in params[0].split(","):
+            if not target:
+                continue
+            if target.startswith("#"):
+                channel = self.find_channel(target)
+                if channel is None:
+                    if not prefix:
+                        err_msg = self.create_numeric_reply("ERR_NOSUCHCHANNEL", target + " :No such channel")
+                        self.send_message_to_select_key(select_key, err_msg)
+                    continue
+                if not prefix and sender not in channel.users:
+                    err_msg = self.create_numeric_reply("ERR_CANNOTSENDTOCHAN", channel.channelname + " :Cannot send to channel")
+                    self.send_message_to_select_key(select_key, err_msg)
+                    continue
+                delivered.append(channel.channelname)
+                for nick, data in channel.local_members.items():
+                    if nick != sender and nick not in local_recipients:
+                        local_recipients[nick] = (data, channel.channelname)
+                for servername in channel.links:
+                    if servername != ignore_server:
+                        server_targets.setdefault(servername, OrderedSet()).append(channel.channelname)
+            else:
+                user = self.find_user(target)
+                if user is None:
+                    if not prefix:
+                        err_msg = self.create_numeric_reply("ERR_NOSUCHNICK", target + " :No such nick")
+                        self.send_message_to_select_key(select_key, err_msg)
+                    continue
+                delivered.append(user.nick)
+                route = self.user_routes[user.nick]
+                if route is user:
+                    if user.nick not in local_recipients:
+                        local_recipients[user.nick] = (user, user.nick)
+                elif route.servername != ignore_server:
+                    server_targets.setdefault(route.servername, OrderedSet()).append(user.nick)
+
+        if self.journal is not None and delivered:
+            self.journal_message(delivered, IRCMessage("PRIVMSG", [",".join(delivered)], text,
+                                                       prefix=sender).serialize())
+
+        # Local users reached through the same target share one encoded message
+        by_target = {}
+        for data, target in local_recipients.values():
+            by_target.setdefault(target, []).append(data)
+        for target, recipients in by_target.items():
+            msg = IRCMessage("PRIVMSG", [target], text, prefix=sender)
+            self.send_message_to_many(recipients, msg.serialize())
+
+        room = MAX_LINE_LENGTH - len((":%s PRIVMSG  :%s\r\n" % (sender, text)).encode())
+        for servername, targets in server_targets.items():
+            for receivers in self.pack_names(targets, room, ","):
+                msg = IRCMessage("PRIVMSG", [receivers], text, prefix=sender)
+                self.send_message_to_server(servername, msg.serialize())
+
+    # Join names (nicks or channel names) into lists separated by separator, each at most room characters long. A list
+    # always holds at least one name. Nicks and channel names are counted as one byte per character
+    def pack_names(self, names, room, separator):
+        packed = []
+        length = -1
+        for name in names:
+            if packed and length + 1 + len(name) > room:
+                yield separator.join(packed)
+                packed = []
+                length = -1
+            packed.append(name)
+            length += 1 + len(name)
+        if packed:
+            yield separator.join(packed)
+
+    ######################################################################
+    # Ping message
+    # Command: PING
+    # Parameters:
+    #   <token>: anything; it is sent back in the PONG
+    # Examples:
+    #   :theshire.irc.com PING :theshire.irc.com        # A keepalive from an adjacent server
+    #   PING :are you there                             # A client checking on its server
+    # Numeric replies:
+    #   ERR_NEEDMOREPARAMS: The message is missing parameters
+    # Notes:
+    # PINGs are only exchanged between adjacent connections, and are never relayed. The server answers over the
+    # connection the PING arrived on with :<servername> PONG <servername> :<token>
+
+    def handle_ping_message(self, select_key, prefix, command, params):
+        if not params:
+            self.send_message_to_select_key(select_key, self.create_numeric_reply(
+                "ERR_NEEDMOREPARAMS", command + " :Not enough parameters"))
+            return
+        pong = IRCMessage("PONG", [self.servername], params[-1], prefix=self.servername)
+        self.send_message_to_select_key(select_key, pong.serialize())
+
+    ######################################################################
+    # Pong message
+    # Command: PONG
+    # Parameters:
+    #   <servername>: the server or client answering
+    #   [<token>]: the token from the PING being answered
+    # Examples:
+    #   :rivendale.irc.com PONG rivendale.irc.com :theshire.irc.com     # The answer to a keepalive PING
+    # Numeric replies:
+    #   None
+    # Notes:
+    # The answer to a keepalive PING sent by check_keepalive(). The time since the PING was sent is recorded as the
+    # connection's round trip time (rtt). Like PING, it is never relayed.
+
+    def handle_pong_message(self, select_key, prefix, command, params):
+        data = select_key.data
+        conn = data.connection
+        if conn.ping_sent is not None:
+            conn.rtt = time.monotonic() - conn.ping_sent
+            conn.ping_sent = None
+            if isinstance(data, ServerDetails):
+                self.print_debug("[%s] Round trip time to %s: %.1f ms" %
+                                 (self.servername, data.servername, conn.rtt * 1000))
+
+    ######################################################################
+    # Routes message
+    # Command: ROUTES
+    # Parameters:
+    #   None
+    # Examples:
+    #   ROUTES          # Ask this server for its routing table
+    # Numeric replies:
+    #   RPL_TRACELINK: One route, as Link <nick or servername> <next hop>
+    #   RPL_TRACEEND: The end of the routing table
+    # Notes:
+    # This is a debugging command, and is not part of the assignment. The server replies over the connection the
+    # command arrived on with one RPL_TRACELINK for every user and server it knows about, naming the adjacent user or
+    # server messages for it are sent to, so the routes in a multi-server network can be checked. It is not relayed.
+
+    def handle_routes_message(self, select_key, prefix, command, params):
+        replies = []
+        for nick, data in self.user_routes.items():
+            replies.append(self.create_numeric_reply("RPL_TRACELINK", "Link %s %s" % (nick, self.route_name(data))))
+        for servername, data in self.server_routes.items():
+            replies.append(self.create_numeric_reply("RPL_TRACELINK", "Link %s %s" % (servername, self.route_name(data))))
+        replies.append(self.create_numeric_reply("RPL_TRACEEND", "%s :End of ROUTES" % self.servername))
+        self.send_message_to_select_key(select_key, b"".join(replies))
+
+    ######################################################################
+    # This block of functions keeps users_lookuptable, servers_lookuptable and channels in sync with their case
+    # insensitive indexes, the routing table and the per-link reverse index, and Channel.users in sync with
+    # user_channels. It also looks users and channels up without caring about case
+
+    def add_user(self, user):
+        self.users_lookuptable[user.nick] = user
+        self.nick_index[irc_lower(user.nick)] = user.nick
+        if user.first_link == self.servername:
+            self.user_routes[user.nick] = user
+        else:
+            self.link_users.setdefault(user.first_link, OrderedSet()).append(user.nick)
+            route = self.server_routes.get(user.first_link)
+            if route is not None:
+                self.user_routes[user.nick] = route
+
+    def remove_user(self, nick):
+        user = self.users_lookuptable.pop(nick, None)
+        if user is not None:
+            del self.nick_index[irc_lower(nick)]
+            self.user_routes.pop(nick, None)
+            members = self.link_users.get(user.first_link)
+            if members is not None:
+                members.discard(nick)
+            for channelname in self.user_channels.pop(nick, ()):
+                self.detach_channel_member(self.channels[channelname], user)
+
+    # Add a server to servers_lookuptable and the routing table. An adjacent server (one whose first_link is itself)
+    # is its own route. When a server links, it announces the servers behind it before announcing itself, so once the
+    # adjacent server is known, any servers and users that were announced through it are routed as well
+    def add_server(self, server):
+        name = server.servername
+        self.servers_lookuptable[name] = server
+        if server.first_link == name:
+            self.server_routes[name] = server
+            for other in self.servers_lookuptable.values():
+                if other.first_link == name:
+                    self.server_routes[other.servername] = server
+            for user in self.users_lookuptable.values():
+                if user.first_link == name:
+                    self.user_routes[user.nick] = server
+        else:
+            self.link_servers.setdefault(server.first_link, OrderedSet()).append(name)
+            route = self.server_routes.get(server.first_link)
+            if route is not None:
+                self.server_routes[name] = route
+
+    def remove_server(self, servername):
+        server = self.servers_lookuptable.pop(servername, None)
+        if server is not None:
+            self.server_routes.pop(servername, None)
+            self.adjacent_servers.discard(servername)
+            members = self.link_servers.get(server.first_link)
+            if members is not None:
+                members.discard(servername)
+
+    # The name of the adjacent user or server a route leads to
+    def route_name(self, data):
+        if isinstance(data, UserDetails):
+            return data.nick
+        return data.servername
+
+    # Return the UserDetails for a nick, whatever case it is given in, or None if there is no such user
+    def find_user(self, nick):
+        nick = self.nick_index.get(irc_lower(nick))
+        if nick is None:
+            return None
+        return self.users_lookuptable[nick]
+
+    def add_channel(self, channel):
+        self.channels[channel.channelname] = channel
+        self.channel_index[irc_lower(channel.channelname)] = channel.channelname
+
+    def remove_channel(self, channelname):
+        if channelname in self.channels:
+            del self.channels[channelname]
+            del self.channel_index[irc_lower(channelname)]
+
+    # Return the Channel for a channel name, whatever case it is given in, or None if there is no such channel
+    def find_channel(self, channelname):
+        channelname = self.channel_index.get(irc_lower(channelname))
+        if channelname is None:
+            return None
+        return self.channels[channelname]
+
+    # Add a user to a channel. Besides Channel.users, this records where the member is: in local_members if the user is
+    # connected to this server, or as one more member behind its adjacent server in links
+    def add_channel_member(self, channel, nick):
+        if nick in channel.users:
+            return
+        channel.add_nick(nick)
+        user = self.users_lookuptable[nick]
+        if user.first_link == self.servername:
+            channel.local_members[nick] = user
+        else:
+            channel.links[user.first_link] = channel.links.get(user.first_link, 0) + 1
+        self.user_channels.setdefault(nick, OrderedSet()).append(channel.channelname)
+
+    # Remove a user from a channel. This must be called while the user is still in users_lookuptable
+    def remove_channel_member(self, channel, nick):
+        if nick not in channel.users:
+            return
+        channels = self.user_channels.get(nick)
+        if channels is not None:
+            channels.discard(channel.channelname)
+            if not channels:
+                del self.user_channels[nick]
+        self.detach_channel_member(channel, self.users_lookuptable[nick])
+
+    # Undo everything add_channel_member() recorded about a user, apart from user_channels. A channel is removed as
+    # soon as its last member leaves
+    def detach_channel_member(self, channel, user):
+        channel.users.discard(user.nick)
+        if user.first_link == self.servername:
+            channel.local_members.pop(user.nick, None)
+        else:
+            count = channel.links.get(user.first_link, 0) - 1
+            if count > 0:
+                channel.links[user.first_link] = count
+            else:
+                channel.links.pop(user.first_link, None)
+        if not channel.users:
+            self.remove_channel(channel.channelname)
+
+    # The reply telling a user the topic of a channel: RPL_TOPIC, or RPL_NOTOPIC if no topic has been set
+    def topic_reply(self, channel):
+        if channel.topic is None:
+            return self.create_numeric_reply("RPL_NOTOPIC", channel.channelname + " :No topic is set")
+        return self.create_numeric_reply("RPL_TOPIC", channel.channelname + " :" + channel.topic)
+
+    # Send a message to every user connected to this server who shares at least one channel with nick (but not to nick
+    # itself). A user in several of those channels still only gets the message once
+    def send_message_to_channel_neighbours(self, nick, message):
+        recipients = {}
+        for channelname in self.user_channels.get(nick, ()):
+            recipients.update(self.channels[channelname].local_members)
+        recipients.pop(nick, None)
+        self.send_message_to_many(recipients.values(), message)
+
 
     # DO NOT EDIT ANY OF THE FUNCTIONS INCLUDED IN IRCServer BELOW THIS LINE
     # These are helper functions to assist with logging, and list management
@@ -883,31 +2383,310 @@ class IRCServer(object):
 # you may if you want to. You must NOT REMOVE OR RENAME any of the code or properties currently
 # defined in this class.
 class Channel(object):
+    __slots__ = ("channelname", "key", "users", "topic", "local_members", "links")
+
     def __init__(self):
         self.channelname = None     # The name of the channel
         self.key = None             # The channel key (i.e. password)
-        self.users = []             # The nicks of all users present in this channel
+        self.users = OrderedSet()   # The nicks of all users present in this channel
         # The current topic of this channel. If no topic is present, it should be None
         self.topic = None
+        # Where the members are, kept up to date by IRCServer.add_channel_member() and remove_channel_member():
+        # the UserDetails of the members connected to this server, keyed by nick, and for each adjacent server
+        # with members behind it, the number of those members. Channel messages are only sent to these
+        self.local_members = {}
+        self.links = {}
 
     # Append the nick if it's not already in the list. When adding a nick to the channel,
     # you are encouraged to use this function so as to avoid adding a user multiple times
     def add_nick(self, nick):
-        if nick not in self.users:
-            self.users.append(nick)
+        self.users.append(nick)
+
+
+# This class collects the messages of a burst (see IRCServer.handle_burst_message) until it ends. servers and users
+# hold the params of each SERVER and USER message, channels holds a (channelname, key, topic) entry for each
+# RPL_NOTOPIC/RPL_TOPIC, and names a (channelname, nicks) entry for each RPL_NAMREPLY. deferred holds the other
+# messages (as IRCMessages) that arrived from the server while the burst was in progress
+class Burst(object):
+    __slots__ = ("servers", "users", "channels", "names", "deferred")
+
+    def __init__(self):
+        self.servers = []
+        self.users = []
+        self.channels = []
+        self.names = []
+        self.deferred = []
+
+
+# This class is an insertion ordered set, used for the membership collections (adjacent_users, adjacent_servers and
+# Channel.users). It is backed by a dict, so adding, removing and checking for a member are all O(1), while iteration
+# still returns the members in the order they were added. It keeps the list methods the rest of the code (and the test
+# harness) already uses: append() adds a member (adding an existing member does nothing), remove() raises ValueError
+# for a missing member just like list.remove(), and an OrderedSet compares equal to a list with the same members in
+# the same order.
+class OrderedSet(object):
+    __slots__ = ("_members",)
+
+    def __init__(self, iterable=()):
+        self._members = dict.fromkeys(iterable)
+
+    def append(self, item):
+        self._members[item] = None
+
+    add = append
+
+    def extend(self, iterable):
+        self._members.update(dict.fromkeys(iterable))
+
+    def remove(self, item):
+        try:
+            del self._members[item]
+        except KeyError:
+            raise ValueError("%r is not in OrderedSet" % (item,)) from None
+
+    def discard(self, item):
+        self._members.pop(item, None)
+
+    def clear(self):
+        self._members.clear()
+
+    def __contains__(self, item):
+        return item in self._members
+
+    def __iter__(self):
+        return iter(self._members)
+
+    def __len__(self):
+        return len(self._members)
+
+    def __bool__(self):
+        return bool(self._members)
+
+    def __eq__(self, other):
+        if isinstance(other, (OrderedSet, list, tuple)):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    def __repr__(self):
+        return "OrderedSet(%r)" % (list(self._members),)
 
 
 # This class represents a generic connection. It contains a read_buffer and a write_buffer. When the server wants to
-# send a message to the client, it should write the message to the write_buffer, and use \r\n as a message delimiter.
-# Then, when select() determines the socket associated with ConnectionData is ready to be written, it should write
-# the write_buffer to the socket and clear it.
+# send a message to the client, it should append the message to the write_buffer (an OutputQueue), and use \r\n as a
+# message delimiter. Then, when select() determines the socket associated with ConnectionData is ready to be written,
+# it should flush the write_buffer to the socket.
 # Similarly, when reading from a socket in select(), the data should be stored in read_buffer and then processed.
 # You do not need to add any code to this class, though you may if you want to. You must NOT REMOVE OR RENAME any
 # of the code or properties currently defined in this class.
+# A server can know about a very large number of users and servers, and only a few of them are adjacent, so the
+# buffers (and the rest of the per-socket state) live in a separate Connection, which only adjacent users and servers
+# have. read_buffer, write_buffer and sock are that Connection's, or None for users and servers that aren't adjacent.
+# This class and its subclasses use __slots__, so they don't carry a __dict__ each.
 class ConnectionData(object):
+    __slots__ = ("connection",)
+
+    def __init__(self, connection=None):
+        self.connection = connection
+
+    @property
+    def read_buffer(self):
+        return self.connection.read_buffer if self.connection is not None else None
+
+    @property
+    def write_buffer(self):
+        return self.connection.write_buffer if self.connection is not None else None
+
+    @property
+    def sock(self):
+        return self.connection.sock if self.connection is not None else None
+
+
+# The state of a socket to an adjacent client or server. It is created when the connection is accepted (or made), and
+# is handed from the ConnectionData to the UserDetails or ServerDetails that replaces it on registration
+class Connection(object):
+    __slots__ = ("sock", "read_buffer", "write_buffer", "writing", "reading", "flood", "timer", "tick", "budget",
+                 "address", "last_active", "ping_sent", "rtt", "sync")
+
+    def __init__(self, sock=None):
+        self.sock = sock        # The socket for this connection. None only for the stand-ins used by IRCBenchmark
+        self.read_buffer = LineBuffer()
+        self.write_buffer = OutputQueue()
+        self.writing = False    # True while the socket is registered with the selector for WRITE events
+        self.reading = True     # False while flood control has stopped reading from the socket
+        self.flood = None       # The TokenBucket limiting the lines a client may send. None for server links
+        self.timer = None       # The pending registration timeout or keepalive Timer
+        self.tick = -1          # The pass of the event loop budget was given out on
+        self.budget = 0         # The number of messages that may still be handled on that pass
+        self.address = None     # The address an accepted connection came from. None for connections we made
+        self.last_active = 0.0  # When something was last received on the socket (from time.monotonic())
+        self.ping_sent = None   # When the keepalive PING that hasn't been answered yet was sent
+        self.rtt = None         # The round trip time of the last keepalive PING, in seconds
+        self.sync = None        # The snapshot digests a restarting server sent before registering (see SYNC)
+
+
+# This class is the token bucket used for flood control. The bucket holds up to burst tokens and gains rate tokens per
+# second, and every line a client sends takes one, so a client can send burst lines at once but only rate lines per
+# second on average. Tokens are added when the bucket is checked, rather than by a timer.
+class TokenBucket(object):
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    # Add the tokens gained since the last check, and return whether there is a token to take
+    def ready(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        return self.tokens >= 1
+
+    def take(self):
+        self.tokens -= 1
+
+    # The number of seconds until there will be a token to take
+    def delay(self):
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+# This class holds the encoded messages waiting to be sent on a connection. Messages are kept as a deque of separate
+# bytes chunks rather than being concatenated, and flush() hands as many of them as possible to the kernel in a single
+# sendmsg() (writev) call. If the kernel only accepts part of the data, the unsent remainder stays queued, and the
+# next flush resumes through a memoryview at the exact byte where the last one stopped.
+class OutputQueue(object):
+    # The most buffers passed to a single sendmsg() call (the usual IOV_MAX on Linux)
+    MAX_CHUNKS_PER_SEND = 1024
+
     def __init__(self):
-        self.read_buffer = ""
-        self.write_buffer = ""
+        self.chunks = collections.deque()
+        self.offset = 0     # The number of bytes of chunks[0] that have already been sent
+        self.pending = 0    # The total number of bytes waiting to be sent
+
+    def __len__(self):
+        return self.pending
+
+    def append(self, data):
+        if data:
+            self.chunks.append(data)
+            self.pending += len(data)
+
+    # Move everything queued in another OutputQueue to the end of this one
+    def extend(self, other):
+        if other.offset:
+            other.chunks[0] = other.chunks[0][other.offset:]
+        self.chunks.extend(other.chunks)
+        self.pending += other.pending
+        other.chunks.clear()
+        other.offset = 0
+        other.pending = 0
+
+    # Remove and return everything in the queue as a list of chunks, for handing to an asyncio transport
+    def pop_all(self):
+        chunks = list(self.chunks)
+        if self.offset:
+            chunks[0] = chunks[0][self.offset:]
+        self.chunks.clear()
+        self.offset = 0
+        self.pending = 0
+        return chunks
+
+    # Send as much of the queue as the socket will take without blocking, and return the number of bytes sent
+    def flush(self, sock):
+        sent_total = 0
+        chunks = self.chunks
+        while chunks:
+            buffers = [memoryview(chunks[0])[self.offset:]]
+            buffers.extend(itertools.islice(chunks, 1, self.MAX_CHUNKS_PER_SEND))
+            if not hasattr(sock, "sendmsg"):
+                del buffers[1:]
+            try:
+                if len(buffers) > 1:
+                    sent = sock.sendmsg(buffers)
+                else:
+                    sent = sock.send(buffers[0])
+            except (BlockingIOError, InterruptedError):
+                break
+            sent_total += sent
+            self.pending -= sent
+            # A short write means the kernel's send buffer is full
+            short_write = sent < sum(len(b) for b in buffers)
+
+            # Drop every chunk that was sent completely, and remember how far into the next one we got
+            sent += self.offset
+            while chunks and sent >= len(chunks[0]):
+                sent -= len(chunks.popleft())
+            self.offset = sent
+
+            if short_write:
+                break
+        return sent_total
+
+
+# This class frames the raw bytes read from a socket into individual IRC messages. Received data is appended to one
+# reusable bytearray, and complete messages are pulled out through a memoryview so they are only copied once, when
+# they are decoded. Anything after the last \r\n (including half of a multibyte UTF-8 character) stays in the buffer
+# until the next read. Messages may be at most max_line_length bytes long, including the \r\n. Longer messages are
+# truncated, and the rest of the message is discarded as it arrives.
+class LineBuffer(object):
+    def __init__(self, max_line_length=MAX_LINE_LENGTH):
+        self.buffer = bytearray()
+        self.start = 0                  # Offset of the first byte that has not been returned by readline() yet
+        self.max_line_length = max_line_length
+        self.discarding = False         # True while skipping the remainder of a message that was too long
+        self.truncated = 0              # The number of messages that have been truncated
+
+    # The number of bytes waiting to be processed
+    def __len__(self):
+        return len(self.buffer) - self.start
+
+    # Append newly received bytes. Data that has already been read is dropped first, so the bytearray only ever
+    # holds the unprocessed tail and doesn't grow without bound
+    def feed(self, data):
+        if self.start:
+            del self.buffer[:self.start]
+            self.start = 0
+        self.buffer += data
+
+    # Return the next complete message as a string, without the \r\n, or None if no complete message is buffered
+    def readline(self):
+        buf = self.buffer
+        limit = self.max_line_length - 2
+
+        while True:
+            start = self.start
+            end = buf.find(b"\r\n", start)
+
+            if self.discarding:
+                if end < 0:
+                    self.start = len(buf)
+                    return None
+                self.discarding = False
+                self.start = end + 2
+                continue
+
+            if end < 0:
+                if len(buf) - start <= limit:
+                    return None
+                # No end of message in sight, but we already have more than a full message worth of data
+                end = start + limit
+                self.discarding = True
+            elif end - start > limit:
+                end = start + limit
+                self.discarding = True
+
+            if self.discarding:
+                self.truncated += 1
+                # Don't cut a multibyte UTF-8 character in half
+                while end > start and buf[end] & 0xC0 == 0x80:
+                    end -= 1
+                self.start = end
+            else:
+                self.start = end + 2
+
+            with memoryview(buf) as view:
+                return str(view[start:end], "utf-8", "replace")
 
 
 # UserDetails extends ConnectionData with properties specific to a connection with a user. As UserDetails extends
@@ -915,6 +2694,8 @@ class ConnectionData(object):
 # You do not need to add any code to this class, though you may if you want to. You must NOT REMOVE OR RENAME any
 # of the code or properties currently defined in this class.
 class UserDetails(ConnectionData):
+    __slots__ = ("nick", "hostname", "servername", "realname", "first_link")
+
     def __init__(self):
         super(UserDetails, self).__init__()
         self.nick = None
@@ -929,12 +2710,16 @@ class UserDetails(ConnectionData):
 # You do not need to add any code to this class, though you may if you want to. You must NOT REMOVE OR RENAME any
 # of the code or properties currently defined in this class.
 class ServerDetails(ConnectionData):
+    __slots__ = ("servername", "hopcount", "info", "burst", "outgoing_burst", "first_link")
+
     def __init__(self):
         super(ServerDetails, self).__init__()
         self.servername = None  # The name of the server
         # The number of hops this server is away from the server who created this instance
         self.hopcount = None
         self.info = None        # A human-readable description of the server
+        self.burst = None       # The Burst this server is in the middle of sending, if any
+        self.outgoing_burst = None  # The rest of the burst being streamed to this server, if any
 
         # The name of the server on the first link towards this server. This is a VERY important
         self.first_link = None
@@ -951,3 +2736,128 @@ class ServerDetails(ConnectionData):
         # the write_buffer associated with A. D can determine this
         # by checking to see that the first_link property for C is
         # the name of A, and then look A up in the servers_lookuptree.
+
+
+# The command line options of the server. The test harnesses (IRCNetworkLauncher and IRCBasicConnectivityTest) parse
+# the LAUNCHSERVER commands in the test cases with this parser, and the options it returns are passed to IRCServer
+def server_option_parser():
+    server_op = OptionParser(
+        version="0.1a",
+        description="CPSC 3600 IRC Server application")
+    server_op.add_option(
+        "--servername",
+        metavar="X", type="string",
+        help="The name for this server")
+    server_op.add_option(
+        "--port",
+        metavar="X", type="int",
+        help="The port this server listens on")
+    server_op.add_option(
+        "--info",
+        metavar="X", type="string",
+        help="Human readable information about this server")
+    server_op.add_option(
+        "--connect_to_host",
+        metavar="X", type="string",
+        help="Connect to a server running on this host")
+    server_op.add_option(
+        "--connect_to_port",
+        metavar="X", type="int",
+        help="Connect to a server running on port X")
+    server_op.add_option(
+        "--debug",
+        action="store_true",
+        help="print debug messages to stdout")
+    server_op.add_option(
+        "--verbose",
+        action="store_true",
+        help="be verbose (print some progress messages to stdout)")
+    server_op.add_option(
+        "--log-file",
+        metavar="X",
+        help="store log in file X")
+    server_op.add_option(
+        "--engine",
+        metavar="X", type="choice", choices=["selectors", "asyncio"],
+        help="The event loop to run the server on: selectors (default) or asyncio")
+    server_op.add_option(
+        "--sendq-client",
+        metavar="X", type="int",
+        help="Disconnect a client with more than X bytes of output waiting to be sent")
+    server_op.add_option(
+        "--sendq-server",
+        metavar="X", type="int",
+        help="Disconnect a server with more than X bytes of output waiting to be sent")
+    server_op.add_option(
+        "--flood-rate",
+        metavar="X", type="float",
+        help="Let each client send X lines per second after its first burst (0 turns flood control off)")
+    server_op.add_option(
+        "--flood-burst",
+        metavar="X", type="int",
+        help="Let each client send X lines at once before flood control starts")
+    server_op.add_option(
+        "--ping-interval",
+        metavar="X", type="float",
+        help="Send a PING to a connection that has been quiet for X seconds")
+    server_op.add_option(
+        "--ping-timeout",
+        metavar="X", type="float",
+        help="Disconnect a connection that hasn't answered a PING within X seconds")
+    server_op.add_option(
+        "--registration-timeout",
+        metavar="X", type="float",
+        help="Disconnect a connection that hasn't registered within X seconds of connecting")
+    server_op.add_option(
+        "--read-budget",
+        metavar="X", type="int",
+        help="Read at most X bytes from a connection on each pass of the event loop")
+    server_op.add_option(
+        "--message-budget",
+        metavar="X", type="int",
+        help="Handle at most X messages from a connection on each pass of the event loop")
+    server_op.add_option(
+        "--listen-backlog",
+        metavar="X", type="int",
+        help="Let up to X connections wait to be accepted")
+    server_op.add_option(
+        "--accept-budget",
+        metavar="X", type="int",
+        help="Accept at most X connections on each pass of the event loop")
+    server_op.add_option(
+        "--max-connections",
+        metavar="X", type="int",
+        help="Refuse connections while X are open")
+    server_op.add_option(
+        "--max-connections-per-ip",
+        metavar="X", type="int",
+        help="Refuse connections from an address that already has X open (default: no limit)")
+    server_op.add_option(
+        "--user-store",
+        metavar="X", type="choice", choices=["dict", "columnar"],
+        help="How to store the users the server knows about: dict (default) or columnar (experimental)")
+    server_op.add_option(
+        "--snapshot-file",
+        metavar="X",
+        help="Save snapshots of the server's state to file X, and restore from it on startup")
+    server_op.add_option(
+        "--snapshot-interval",
+        metavar="X", type="float",
+        help="Save a snapshot every X seconds (default: 300)")
+    server_op.add_option(
+        "--journal-dir",
+        metavar="X",
+        help="Journal the messages the server delivers in directory X")
+    server_op.add_option(
+        "--journal-fsync",
+        metavar="X", choices=["always", "interval", "never"],
+        help="When to fsync the journal: always, interval (default, at most once a second) or never")
+    server_op.add_option(
+        "--journal-max-size",
+        metavar="X", type="int",
+        help="Remove the oldest journal segments once the journal is over X MiB (default: 1024)")
+    server_op.add_option(
+        "--journal-max-age",
+        metavar="X", type="float",
+        help="Remove journal segments older than X seconds (default: keep them)")
+    return server_op
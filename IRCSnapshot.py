@@ -0,0 +1,181 @@
+# This module contains the snapshot file IRCServer saves what it knows about the network to, so a restarted server
+# doesn't have to learn all of it from its uplink again. A snapshot holds every known server and user (with its
+# first_link) and every channel (with its key, topic and members), in a compact binary format:
+#   header:   MAGIC, the time it was saved and BUCKET_COUNT (HEADER)
+#             the name of the server that saved it, and of its uplink (the server it had connected to)
+#   digests:  BUCKET_COUNT 64 bit digests (see below)
+#   offsets:  BUCKET_COUNT + 1 offsets into the records, where each bucket's records start (and the last one ends)
+#   records:  the records, grouped by bucket. Each one is its first_link, followed by the record itself: a kind byte
+#             (S, U or C) and its fields
+# Strings are stored as UTF-8, each preceded by its length (NONE_LENGTH for None).
+#
+# Servers, users and channels are spread over BUCKET_COUNT buckets by name. The digest of a bucket is the sum of a
+# hash of every record in it that a restarted server could take over: the servers and users behind its uplink, and
+# the channels with the members behind its uplink. The uplink computes the same digests over what it would send in a
+# burst, so comparing the two tells which buckets have changed since the snapshot was saved, and only those need to
+# be sent (see IRCServer.handle_sync_message).
+#
+# A snapshot is written to a temporary file that is renamed over the old one, so there is always a complete snapshot
+# on disk. It is read through mmap, and the records of a bucket are only decoded when they are asked for.
+
+import hashlib
+import mmap
+import os
+import struct
+import time
+import zlib
+
+MAGIC = b"IRCSNAP1"
+BUCKET_COUNT = 128
+
+HEADER = struct.Struct("<8sdI")
+LENGTH = struct.Struct("<H")
+COUNT = struct.Struct("<I")
+NONE_LENGTH = 0xFFFF
+DIGEST_MASK = 2 ** 64 - 1
+
+
+def bucket_of(kind, name):
+    return zlib.crc32(kind + name.encode()) % BUCKET_COUNT
+
+
+def record_digest(record):
+    return int.from_bytes(hashlib.blake2b(record, digest_size=8).digest(), "little")
+
+
+def pack_strings(*values):
+    parts = []
+    for value in values:
+        if value is None:
+            parts.append(LENGTH.pack(NONE_LENGTH))
+        else:
+            encoded = value.encode()
+            parts.append(LENGTH.pack(len(encoded)))
+            parts.append(encoded)
+    return b"".join(parts)
+
+
+# Return the string at pos in buf, and the position after it
+def unpack_string(buf, pos):
+    length = LENGTH.unpack_from(buf, pos)[0]
+    pos += LENGTH.size
+    if length == NONE_LENGTH:
+        return None, pos
+    return str(buf[pos:pos + length], "utf-8"), pos + length
+
+
+# The records. A server is described as the server the snapshot is for sees it, so its hopcount is the one that
+# server's uplink would send it. A channel's members are sorted, so the record doesn't depend on the order they joined
+def server_record(servername, hopcount, info):
+    return b"S" + pack_strings(servername, hopcount, info)
+
+
+def user_record(nick, hostname, servername, realname):
+    return b"U" + pack_strings(nick, hostname, servername, realname)
+
+
+def channel_record(channelname, key, topic, members):
+    members = sorted(members)
+    return b"C" + pack_strings(channelname, key, topic) + COUNT.pack(len(members)) + pack_strings(*members)
+
+
+# This class collects the records of a snapshot and the digests of its buckets. IRCServer adds the records to one of
+# these for a snapshot it saves, and (with digests only) for the state it compares with a restarted server's snapshot
+class SnapshotBuilder(object):
+    def __init__(self, keep_records=True):
+        self.buckets = [[] for i in range(BUCKET_COUNT)] if keep_records else None
+        self.digests = [0] * BUCKET_COUNT
+
+    # Add a record. restorable is whether the server the snapshot is for could take it over (see the top of the
+    # module); only those records count towards the digests
+    def add(self, kind, name, record, first_link=None, restorable=True):
+        bucket = bucket_of(kind, name)
+        if self.buckets is not None:
+            self.buckets[bucket].append(pack_strings(first_link) + record)
+        if restorable:
+            self.digests[bucket] = (self.digests[bucket] + record_digest(record)) & DIGEST_MASK
+
+    def serialize(self, servername, uplink):
+        parts = [HEADER.pack(MAGIC, time.time(), BUCKET_COUNT), pack_strings(servername, uplink),
+                 struct.pack("<%iQ" % BUCKET_COUNT, *self.digests)]
+        offsets = [0]
+        for records in self.buckets:
+            offsets.append(offsets[-1] + sum(len(record) for record in records))
+        parts.append(struct.pack("<%iQ" % (BUCKET_COUNT + 1), *offsets))
+        for records in self.buckets:
+            parts.extend(records)
+        return b"".join(parts)
+
+
+# Write a snapshot to path, replacing the one there (if any) only once the new one is safely on disk
+def write_snapshot(path, data):
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+    directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+
+
+# This class reads a snapshot file. Opening it only maps the file and reads the header, digests and offsets; the
+# records of a bucket are decoded by records(). Raises ValueError if the file isn't a snapshot
+class Snapshot(object):
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if len(self.map) < HEADER.size:
+                raise ValueError("%s is not a snapshot" % path)
+            magic, self.saved_at, bucket_count = HEADER.unpack_from(self.map, 0)
+            if magic != MAGIC or bucket_count != BUCKET_COUNT:
+                raise ValueError("%s is not a snapshot" % path)
+            pos = HEADER.size
+            self.servername, pos = unpack_string(self.map, pos)
+            self.uplink, pos = unpack_string(self.map, pos)
+            self.digests = struct.unpack_from("<%iQ" % BUCKET_COUNT, self.map, pos)
+            pos += 8 * BUCKET_COUNT
+            self.offsets = struct.unpack_from("<%iQ" % (BUCKET_COUNT + 1), self.map, pos)
+            self.records_start = pos + 8 * (BUCKET_COUNT + 1)
+            if self.records_start + self.offsets[-1] != len(self.map):
+                raise ValueError("%s is truncated" % path)
+        except (ValueError, struct.error, UnicodeDecodeError):
+            self.map.close()
+            raise ValueError("%s is not a valid snapshot" % path)
+
+    # Decode the records in a bucket. Yields (first_link, kind, fields) for each one, where kind is "S", "U" or "C" and
+    # fields are the fields of the record in the order the *_record() functions take them
+    def records(self, bucket):
+        buf = self.map
+        pos = self.records_start + self.offsets[bucket]
+        end = self.records_start + self.offsets[bucket + 1]
+        while pos < end:
+            first_link, pos = unpack_string(buf, pos)
+            kind = chr(buf[pos])
+            pos += 1
+            if kind == "C":
+                fields = []
+                for i in range(3):
+                    value, pos = unpack_string(buf, pos)
+                    fields.append(value)
+                count = COUNT.unpack_from(buf, pos)[0]
+                pos += COUNT.size
+                members = []
+                for i in range(count):
+                    nick, pos = unpack_string(buf, pos)
+                    members.append(nick)
+                fields.append(members)
+            else:
+                fields = []
+                for i in range(3 if kind == "S" else 4):
+                    value, pos = unpack_string(buf, pos)
+                    fields.append(value)
+            yield first_link, kind, fields
+
+    def close(self):
+        self.map.close()
@@ -0,0 +1,88 @@
+# This module contains the timer wheel IRCServer keeps its timeouts on: keepalive PINGs, registration timeouts, and
+# the time flood control stops reading from a client for. Every connection has a timer pending, so scheduling and
+# cancelling a timer must not depend on how many other timers there are.
+
+import math
+import time
+
+
+# A single scheduled callback. tick is the tick of the wheel the timer fires on
+class Timer(object):
+    __slots__ = ("tick", "callback", "args")
+
+    def __init__(self, tick, callback, args):
+        self.tick = tick
+        self.callback = callback
+        self.args = args
+
+
+# This class is a hashed timer wheel. Time is divided into ticks of resolution seconds, and the wheel has slot_count
+# slots. A timer is stored in the slot its tick hashes to (tick % slot_count), under its tick, so a slot can hold
+# timers for several turns of the wheel without them getting in each other's way:
+# * schedule() and cancel() add and remove a single dictionary entry, so both are O(1)
+# * advance() visits each tick that has passed once, and only touches the timers that are due on it
+# * timeout() looks ahead a bounded number of ticks for the next one with a timer on it, which is how long the event
+#   loop can wait
+# A timer never fires early, but may fire up to one tick late.
+class TimerWheel(object):
+    def __init__(self, resolution=0.05, slot_count=1024):
+        self.resolution = resolution
+        self.slots = [{} for i in range(slot_count)]
+        self.origin = time.monotonic()
+        self.current = 0    # The next tick to run
+        self.count = 0      # The number of timers scheduled
+
+    def __len__(self):
+        return self.count
+
+    # Call callback(*args) in delay seconds. Returns the Timer, which can be passed to cancel()
+    def schedule(self, delay, callback, *args):
+        tick = math.ceil((time.monotonic() + delay - self.origin) / self.resolution)
+        if tick < self.current:
+            tick = self.current
+        timer = Timer(tick, callback, args)
+        slot = self.slots[tick % len(self.slots)]
+        timers = slot.get(tick)
+        if timers is None:
+            slot[tick] = timers = {}
+        timers[timer] = None
+        self.count += 1
+        return timer
+
+    # Stop a timer from firing. Cancelling a timer that has already fired (or been cancelled) does nothing
+    def cancel(self, timer):
+        slot = self.slots[timer.tick % len(self.slots)]
+        timers = slot.get(timer.tick)
+        if timers is not None and timer in timers:
+            del timers[timer]
+            self.count -= 1
+            if not timers:
+                del slot[timer.tick]
+
+    # Fire every timer that is due at time now (from time.monotonic())
+    def advance(self, now):
+        target = int((now - self.origin) / self.resolution + 1e-9)
+        if not self.count:
+            self.current = max(self.current, target + 1)
+            return
+        slot_count = len(self.slots)
+        while self.current <= target and self.count:
+            tick = self.current
+            self.current += 1
+            timers = self.slots[tick % slot_count].pop(tick, None)
+            if timers:
+                self.count -= len(timers)
+                for timer in timers:
+                    timer.callback(*timer.args)
+        self.current = max(self.current, target + 1)
+
+    # The number of seconds from now until the next timer is due, or None if no timer is due in the next limit seconds
+    def timeout(self, now, limit):
+        if not self.count:
+            return None
+        slot_count = len(self.slots)
+        last = self.current + min(int(limit / self.resolution) + 1, slot_count)
+        for tick in range(self.current, last):
+            if tick in self.slots[tick % slot_count]:
+                return max(0.0, self.origin + tick * self.resolution - now)
+        return None
@@ -0,0 +1,208 @@
+# This module contains UserStore, the columnar alternative to the users_lookuptable dictionary. On a large network
+# almost every user a server knows about is remote, and all the server ever needs from a remote user is where it is
+# (first_link) and whether it exists, so keeping a UserDetails object for each of them costs far more memory than the
+# information is worth. UserStore keeps the same information in a handful of arrays instead, and only builds a
+# UserDetails for a remote user when one is asked for.
+#
+# UserStore is experimental, and only used when a server is started with --user-store columnar. It does NOT reach the
+# order of magnitude saving it was meant to. With "IRCBenchmark.py memory", users_lookuptable itself shrinks by about a
+# third (109 bytes per remote user against 168 for slotted UserDetails, at 20k users), but a whole server only drops
+# from 345 to 327 bytes per remote user at 20k users (5%), and from 415 to 361 at 100k (13%). Most of what a server
+# holds per user is elsewhere: the nick itself, and the user's entries in nick_index, user_routes and link_users, which
+# the store doesn't change.
+# A remote user looked up in the store is also a new copy every time, so code that changes a user it has looked up
+# changes nothing: the change is silently lost unless the copy is stored again (see UserStore and
+# tests/test_user_store.py). Nothing in IRCServer changes a user after adding it, but new code has to keep to that.
+
+from array import array
+
+
+# This class holds one string for each slot of a UserStore, packed one after the other into a single bytearray (the
+# arena) as UTF-8. offsets and lengths give the part of the arena each slot's string is in. A string that is replaced
+# or cleared leaves its bytes behind in the arena; once more than half of the arena is unused, the arena is rebuilt
+# with only the strings still in use.
+class StringColumn(object):
+    NONE = 0xFFFF       # The length stored for a slot whose string is None
+
+    # Arenas smaller than this aren't worth compacting
+    MIN_COMPACT_SIZE = 64 * 1024
+
+    def __init__(self):
+        self.arena = bytearray()
+        self.offsets = array("I")
+        self.lengths = array("H")
+        self.garbage = 0    # The number of bytes in the arena no slot uses any more
+
+    def __getitem__(self, slot):
+        length = self.lengths[slot]
+        if length == self.NONE:
+            return None
+        start = self.offsets[slot]
+        return self.arena[start:start + length].decode()
+
+    # Set the string for slot. slot is either an existing slot, or the next one (len(self.offsets))
+    def set(self, slot, value):
+        if value is None:
+            encoded = b""
+            length = self.NONE
+        else:
+            encoded = value.encode()
+            length = len(encoded)
+        if slot == len(self.offsets):
+            self.offsets.append(len(self.arena))
+            self.lengths.append(length)
+        else:
+            self.clear(slot)
+            self.offsets[slot] = len(self.arena)
+            self.lengths[slot] = length
+        self.arena += encoded
+
+    def clear(self, slot):
+        length = self.lengths[slot]
+        if length != self.NONE:
+            self.garbage += length
+        self.lengths[slot] = self.NONE
+        if self.garbage > self.MIN_COMPACT_SIZE and self.garbage * 2 > len(self.arena):
+            self.compact()
+
+    def compact(self):
+        arena = bytearray()
+        for slot, length in enumerate(self.lengths):
+            if length != self.NONE:
+                start = self.offsets[slot]
+                self.offsets[slot] = len(arena)
+                arena += self.arena[start:start + length]
+        self.arena = arena
+        self.garbage = 0
+
+
+# This class stores users by nick, and can be used wherever the users_lookuptable dictionary is. It supports the parts
+# of the dictionary interface the server (and the test harness) use: lookups, assignment, deletion, pop(), get(),
+# len(), membership tests and iteration over the nicks, keys(), values() and items(), in the order the users were added.
+# * Users connected to this server (and any user with a Connection) are stored as the UserDetails objects themselves,
+#   since the selector, the channels and the routing table hold on to them
+# * Every other user is given a slot. Its servername and first_link are stored as the ids of those names in a table of
+#   servernames (two bytes each), and its hostname and realname in a StringColumn each. Slots of users that have left
+#   are reused
+# * Looking up a user in a slot returns a new UserDetails built from the columns. It is a copy: changing it doesn't
+#   change the user in the store (the server never changes a user once it has been added)
+class UserStore(object):
+    def __init__(self, server, view_class):
+        self.server = server            # The IRCServer this store belongs to; its users are kept as objects
+        self.view_class = view_class    # The class built for users in slots (UserDetails)
+        # nick -> the slot of a remote user, or the UserDetails of a local one
+        self.entries = {}
+        self.free = array("I")          # The slots no user is in at the moment
+        # The servername table. Id 0 stands for None
+        self.server_names = [None]
+        self.server_ids = {None: 0}
+        # The columns, indexed by slot
+        self.servernames = array("H")
+        self.first_links = array("H")
+        self.hostnames = StringColumn()
+        self.realnames = StringColumn()
+
+    def server_id(self, servername):
+        server_id = self.server_ids.get(servername)
+        if server_id is None:
+            server_id = len(self.server_names)
+            self.server_names.append(servername)
+            self.server_ids[servername] = server_id
+        return server_id
+
+    def __setitem__(self, nick, user):
+        entry = self.entries.get(nick)
+        if entry.__class__ is int:
+            self.release(entry)
+        if user.first_link == self.server.servername or user.connection is not None:
+            self.entries[nick] = user
+            return
+
+        servername = self.server_id(user.servername)
+        first_link = self.server_id(user.first_link)
+        if self.free:
+            slot = self.free.pop()
+            self.servernames[slot] = servername
+            self.first_links[slot] = first_link
+        else:
+            slot = len(self.servernames)
+            self.servernames.append(servername)
+            self.first_links.append(first_link)
+        self.hostnames.set(slot, user.hostname)
+        self.realnames.set(slot, user.realname)
+        self.entries[nick] = slot
+
+    def __getitem__(self, nick):
+        entry = self.entries[nick]
+        if entry.__class__ is int:
+            return self.view(nick, entry)
+        return entry
+
+    def __delitem__(self, nick):
+        entry = self.entries.pop(nick)
+        if entry.__class__ is int:
+            self.release(entry)
+
+    def get(self, nick, default=None):
+        entry = self.entries.get(nick)
+        if entry is None:
+            return default
+        if entry.__class__ is int:
+            return self.view(nick, entry)
+        return entry
+
+    def pop(self, nick, *default):
+        entry = self.entries.pop(nick, None)
+        if entry is None:
+            if default:
+                return default[0]
+            raise KeyError(nick)
+        if entry.__class__ is int:
+            user = self.view(nick, entry)
+            self.release(entry)
+            return user
+        return entry
+
+    def update(self, users):
+        for nick, user in users.items():
+            self[nick] = user
+
+    def clear(self):
+        for nick in list(self.entries):
+            del self[nick]
+
+    def __contains__(self, nick):
+        return nick in self.entries
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def keys(self):
+        return self.entries.keys()
+
+    def values(self):
+        return (self[nick] for nick in self.entries)
+
+    def items(self):
+        return ((nick, self[nick]) for nick in self.entries)
+
+    def __repr__(self):
+        return "UserStore(%i users, %i in slots)" % (len(self.entries), len(self.servernames) - len(self.free))
+
+    # Build the UserDetails for the user in slot
+    def view(self, nick, slot):
+        user = self.view_class()
+        user.nick = nick
+        user.hostname = self.hostnames[slot]
+        user.servername = self.server_names[self.servernames[slot]]
+        user.realname = self.realnames[slot]
+        user.first_link = self.server_names[self.first_links[slot]]
+        return user
+
+    def release(self, slot):
+        self.hostnames.clear(slot)
+        self.realnames.clear(slot)
+        self.free.append(slot)
@@ -0,0 +1,129 @@
+# Helpers shared by the tests and by IRCBenchmark: building the options an IRCServer is created with, and wiring
+# servers together in-process with SimulatedNetwork
+
+import selectors
+import socket
+
+from IRCServer import IRCServer, ConnectionData, Connection, server_option_parser
+
+
+# Build the options object IRCServer expects with the server's own option parser, the same way IRCNetworkLauncher
+# would from its command line. Any other keyword arguments are set on it afterwards
+def server_options(servername="bench.irc", port=6700, **kwargs):
+    options, args = server_option_parser().parse_args(
+        ["--servername", servername, "--port", str(port), "--info", "Benchmark server"])
+    for name, value in kwargs.items():
+        setattr(options, name, value)
+    return options
+
+
+# SimulatedNetwork wires IRCServer objects together in a single thread, without running their event loops. Every link
+# is a socketpair whose ends are registered with the two servers' selectors (so the servers treat them as ordinary
+# connections), but nothing is ever sent over the sockets: pump() moves each connection's queued output straight into
+# the other server's process_data(). Clients are connections whose output is collected instead. Messages a server
+# leaves in its backlog (see IRCServer.run_backlog()) are handled as if the event loop had gone round again.
+
+class SimulatedNetwork(object):
+    def __init__(self):
+        self.servers = {}
+        self.peers = {}         # (server, sock) -> (peer server, peer sock) for every server link
+        self.clients = {}       # nick -> (server, sock)
+        self.received = {}      # nick -> list of the lines the client has received
+        self.client_ends = []   # The clients' ends of their connections, which nothing reads from
+        self.link_messages = 0  # The number of messages that have crossed a server link
+        self.largest_write = 0  # The most output (in bytes) a server had queued on a link at once
+
+    # Add a server, linked to parent if there is one. Any other keyword arguments are options for the server
+    def add_server(self, servername, parent=None, **options):
+        server = IRCServer(server_options(servername=servername, **options))
+        self.servers[servername] = server
+        if server.snapshot_file:
+            server.load_snapshot()
+        if server.journal_dir:
+            server.open_journal()
+        if parent is not None:
+            parent = self.servers[parent]
+            child_sock, parent_sock = socket.socketpair()
+            for owner, sock in ((server, child_sock), (parent, parent_sock)):
+                data = ConnectionData(Connection(sock))
+                owner.sel.register(sock, selectors.EVENT_READ, data)
+            self.peers[(server, child_sock)] = (parent, parent_sock)
+            self.peers[(parent, parent_sock)] = (server, child_sock)
+            server.send_server_registration(server.sel.get_key(child_sock).data)
+            self.pump()
+        return server
+
+    # Take a server off the network, as if it had stopped. Its neighbours see the links close, and its clients are
+    # disconnected (what they received is kept)
+    def remove_server(self, servername):
+        server = self.servers.pop(servername)
+        for (owner, sock), (peer, peer_sock) in list(self.peers.items()):
+            if owner is server:
+                del self.peers[(owner, sock)]
+                del self.peers[(peer, peer_sock)]
+                peer.close_connection(peer_sock)
+                server.sel.unregister(sock)
+                sock.close()
+        for nick, (owner, sock) in list(self.clients.items()):
+            if owner is server:
+                del self.clients[nick]
+        for key in list(server.sel.get_map().values()):
+            key.fileobj.close()
+        server.sel.close()
+        self.pump()
+        return server
+
+    def add_client(self, servername, nick):
+        server = self.servers[servername]
+        sock, client_end = socket.socketpair()
+        self.client_ends.append(client_end)
+        data = ConnectionData(Connection(sock))
+        server.sel.register(sock, selectors.EVENT_READ, data)
+        self.clients[nick] = (server, sock)
+        self.received[nick] = []
+        self.send(nick, "USER %s simhost %s :Simulated User" % (nick, servername))
+
+    # Close every socket registered with the servers, the servers' selectors, and the clients' ends of their
+    # connections
+    def close(self):
+        for server in self.servers.values():
+            for key in list(server.sel.get_map().values()):
+                key.fileobj.close()
+            server.sel.close()
+        for sock in self.client_ends:
+            sock.close()
+
+    # Send a line from a client, and deliver everything that results from it
+    def send(self, nick, line):
+        server, sock = self.clients[nick]
+        server.process_data(server.sel.get_key(sock), (line + "\r\n").encode())
+        self.pump()
+
+    def pump(self):
+        moved = True
+        while moved:
+            moved = False
+            for (server, sock), (peer, peer_sock) in self.peers.items():
+                data = server.sel.get_key(sock).data
+                if data.write_buffer:
+                    output = b"".join(data.write_buffer.pop_all())
+                    server.stop_writing(data)
+                    self.largest_write = max(self.largest_write, len(output))
+                    self.link_messages += output.count(b"\r\n")
+                    peer.process_data(peer.sel.get_key(peer_sock), output)
+                    moved = True
+            for server in self.servers.values():
+                if server.backlog:
+                    server.tick += 1
+                    server.run_backlog()
+                    moved = True
+        for nick, (server, sock) in self.clients.items():
+            # A client that flood control has stopped reading from, and that has no output waiting, isn't registered
+            key = server.sel.get_map().get(sock)
+            if key is None:
+                continue
+            data = key.data
+            if data.write_buffer:
+                output = b"".join(data.write_buffer.pop_all())
+                server.stop_writing(data)
+                self.received[nick].extend(output.decode().split("\r\n")[:-1])
@@ -0,0 +1,92 @@
+# Tests for how IRCServer accepts connections: up to accept_budget per call of accept_new_connection(), and connections
+# past max_connections (or past max_connections_per_ip from one address) are refused with an ERROR. The server's
+# listening socket is a real one on the loopback interface, but its event loop isn't run
+
+import socket
+import unittest
+
+from tests.support import server_options
+from IRCServer import IRCServer, TokenBucket
+
+
+class AcceptTest(unittest.TestCase):
+    def setUp(self):
+        self.listener = socket.socket()
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(16)
+        self.listener.setblocking(False)
+        self.clients = []
+        self.server = None
+
+    def tearDown(self):
+        for key in list(self.server.sel.get_map().values()):
+            key.fileobj.close()
+        self.server.sel.close()
+        for sock in self.clients + [self.listener]:
+            sock.close()
+
+    def start(self, **options):
+        self.server = IRCServer(server_options(**options))
+
+    def connect(self, count):
+        for i in range(count):
+            sock = socket.create_connection(self.listener.getsockname())
+            self.clients.append(sock)
+
+    # Each call accepts at most accept_budget connections, and the rest are left for the next
+    def test_accept_budget(self):
+        self.start(accept_budget=2)
+        self.connect(5)
+        for expected in (2, 4, 5, 5):
+            self.server.accept_new_connection(self.listener)
+            self.assertEqual(self.server.connection_count, expected)
+        self.assertEqual(len(self.server.sel.get_map()), 5)
+        self.assertEqual(self.server.connections_per_ip, {"127.0.0.1": 5})
+
+    # Accepted connections are flood controlled, unless flood_rate is 0
+    def test_flood_control(self):
+        self.start(flood_rate=3, flood_burst=7)
+        self.connect(1)
+        self.server.accept_new_connection(self.listener)
+        data = next(iter(self.server.sel.get_map().values())).data
+        self.assertIsInstance(data.connection.flood, TokenBucket)
+        self.assertEqual((data.connection.flood.rate, data.connection.flood.burst), (3, 7))
+
+        self.server.flood_rate = 0
+        self.connect(1)
+        self.server.accept_new_connection(self.listener)
+        self.assertEqual([key.data.connection.flood is None for key in self.server.sel.get_map().values()],
+                         [False, True])
+
+    # Connections from an address that already has max_connections_per_ip open are refused, and told why
+    def test_max_connections_per_ip(self):
+        self.start(max_connections_per_ip=2)
+        self.connect(3)
+        self.server.accept_new_connection(self.listener)
+        self.assertEqual(self.server.connection_count, 2)
+        self.assertEqual(self.server.connections_refused, 1)
+        self.clients[2].settimeout(5)
+        self.assertEqual(self.clients[2].recv(1024), b"ERROR :Too many connections from your address\r\n")
+        self.assertEqual(self.clients[2].recv(1024), b"")
+
+        # Once one of them has closed, the address may connect again
+        self.server.close_connection(next(iter(self.server.sel.get_map().values())).fileobj)
+        self.assertEqual(self.server.connections_per_ip, {"127.0.0.1": 1})
+        self.connect(1)
+        self.server.accept_new_connection(self.listener)
+        self.assertEqual(self.server.connection_count, 2)
+        self.assertEqual(self.server.connections_refused, 1)
+
+    # Past max_connections, every new connection is refused
+    def test_max_connections(self):
+        self.start(max_connections=3)
+        self.connect(4)
+        self.server.accept_new_connection(self.listener)
+        self.assertEqual(self.server.connection_count, 3)
+        self.assertEqual(self.server.connections_refused, 1)
+        self.clients[3].settimeout(5)
+        self.assertEqual(self.clients[3].recv(1024), b"ERROR :Too many connections\r\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+# Tests for the read and message budgets in IRCServer: how much a connection is read from, and how many of its messages
+# are handled, before the event loop moves on to other connections, and the backlog of connections waiting for another
+# turn. The servers are wired together in-process with the SimulatedNetwork from tests/support.py
+
+import selectors
+import unittest
+
+from tests.support import SimulatedNetwork
+
+
+class BudgetTest(unittest.TestCase):
+    def setUp(self):
+        self.network = SimulatedNetwork()
+        self.hub = self.network.add_server("hub.irc", read_budget=64, message_budget=3)
+        self.network.add_client("hub.irc", "frodo")
+        self.network.add_client("hub.irc", "sam")
+        self.network.add_client("hub.irc", "merry")
+        self.sam = self.hub.users_lookuptable["sam"]
+        self.sam.connection.write_buffer.pop_all()
+        self.key = self.hub.sel.get_key(self.network.clients["frodo"][1])
+        self.received = []
+        # Registering used part of this pass's budget
+        self.hub.tick += 1
+
+    def tearDown(self):
+        self.network.close()
+
+    # What sam has been sent so far. This doesn't go through SimulatedNetwork.pump(), which would run the backlog
+    def delivered(self):
+        output = b"".join(self.sam.connection.write_buffer.pop_all()).decode()
+        self.received.extend(line.rsplit(":", 1)[1] for line in output.split("\r\n")[:-1])
+        return self.received
+
+    # A connection handles message_budget messages per pass of the loop, and then waits in the backlog with the rest
+    # of its input buffered
+    def test_message_budget(self):
+        data = self.key.data
+        self.hub.process_data(self.key, "".join("PRIVMSG sam :%i\r\n" % i for i in range(7)).encode())
+        self.assertEqual(self.hub.backlog, [data])
+        self.hub.run_backlog()
+        self.assertEqual(self.delivered(), ["0", "1", "2"])
+
+        self.hub.tick += 1
+        self.hub.run_backlog()
+        self.assertEqual(self.delivered(), ["0", "1", "2", "3", "4", "5"])
+        self.assertEqual(self.hub.backlog, [data])
+
+        self.hub.tick += 1
+        self.hub.run_backlog()
+        self.assertEqual(self.delivered(), [str(i) for i in range(7)])
+        self.assertEqual(self.hub.backlog, [])
+
+    # Connections in the backlog take their turns in the order they ran out of budget
+    def test_backlog_order(self):
+        merry = self.hub.sel.get_key(self.network.clients["merry"][1])
+        for key, nick in ((self.key, "frodo"), (merry, "merry")):
+            self.hub.process_data(key, "".join("PRIVMSG sam :%s\r\n" % nick for i in range(4)).encode())
+        self.assertEqual(self.hub.backlog, [self.key.data, merry.data])
+        self.hub.tick += 1
+        self.hub.run_backlog()
+        self.assertEqual(self.delivered(), ["frodo"] * 3 + ["merry"] * 3 + ["frodo", "merry"])
+
+    # A single read takes at most read_budget bytes from the socket, and a connection in the backlog isn't read from
+    def test_read_budget(self):
+        client_end = self.network.client_ends[0]
+        client_end.sendall("".join("PRIVMSG sam :%i\r\n" % i for i in range(20)).encode())
+        read_buffer = self.key.data.connection.read_buffer
+        # Each line is 16 bytes, so the first read takes four of them, and one is left over
+        self.hub.service_socket(self.key, selectors.EVENT_READ)
+        self.assertEqual(self.delivered(), ["0", "1", "2"])
+        self.assertEqual(len(read_buffer), 16)
+
+        self.hub.tick += 1
+        self.hub.service_socket(self.key, selectors.EVENT_READ)
+        self.assertEqual(self.delivered(), ["0", "1", "2"])
+        self.assertEqual(len(read_buffer), 16)
+
+        self.hub.run_backlog()
+        self.assertEqual(self.delivered(), ["0", "1", "2", "3"])
+        self.hub.tick += 1
+        self.hub.service_socket(self.key, selectors.EVENT_READ)
+        self.assertEqual(self.delivered(), [str(i) for i in range(7)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,48 @@
+# Tests for leaving channels in IRCServer, on servers wired up with the SimulatedNetwork from tests/support.py
+
+import unittest
+
+from tests.support import SimulatedNetwork
+
+
+class PartTest(unittest.TestCase):
+    def setUp(self):
+        self.network = SimulatedNetwork()
+        self.hub = self.network.add_server("hub.irc")
+        self.leaf = self.network.add_server("leaf.irc", "hub.irc")
+        self.network.add_client("hub.irc", "frodo")
+        self.network.add_client("leaf.irc", "sam")
+        self.network.send("frodo", "JOIN #shire")
+        self.network.send("sam", "JOIN #shire")
+        self.network.received["frodo"] = []
+
+    def tearDown(self):
+        self.network.close()
+
+    # The PART is echoed to the user who left, and every server drops them from the channel
+    def test_part(self):
+        self.network.send("frodo", "PART #shire")
+        self.assertEqual(self.network.received["frodo"], [":frodo PART #shire"])
+        for server in (self.hub, self.leaf):
+            self.assertEqual(list(server.channels["#shire"].users), ["sam"])
+            self.assertNotIn("frodo", server.user_channels)
+
+    # A PART that fails is answered with the error alone, so the client knows it is still in its channels
+    def test_part_errors_are_not_echoed(self):
+        self.network.send("frodo", "PART #mordor")
+        self.network.send("frodo", "JOIN #rohan")
+        self.network.send("sam", "PART #rohan")
+        self.assertEqual(self.network.received["frodo"],
+                         [":hub.irc 403 #mordor :No such channel", ":hub.irc 331 #rohan :No topic is set"])
+        self.assertEqual(self.network.received["sam"][-1], ":leaf.irc 442 #rohan :You're not on that channel")
+
+    # The last member to leave a channel takes it with them
+    def test_empty_channel_is_removed(self):
+        self.network.send("frodo", "PART #shire")
+        self.network.send("sam", "PART #shire")
+        self.assertEqual(self.hub.channels, {})
+        self.assertEqual(self.leaf.channels, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
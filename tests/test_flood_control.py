@@ -0,0 +1,89 @@
+# Tests for flood control in IRCServer: the TokenBucket each client connection is given, and a flooding client having
+# its excess lines held back until it has tokens again. The servers are wired together in-process with the
+# SimulatedNetwork from tests/support.py
+
+import unittest
+
+from tests.support import SimulatedNetwork
+from IRCServer import TokenBucket
+
+
+class TokenBucketTest(unittest.TestCase):
+    # A full bucket allows burst lines at once
+    def test_burst(self):
+        bucket = TokenBucket(2, 5)
+        for i in range(5):
+            self.assertTrue(bucket.ready())
+            bucket.take()
+        self.assertFalse(bucket.ready())
+
+    # An empty bucket gains rate tokens a second, up to burst
+    def test_refill(self):
+        bucket = TokenBucket(2, 5)
+        bucket.tokens = 0
+        bucket.stamp -= 1
+        self.assertTrue(bucket.ready())
+        self.assertAlmostEqual(bucket.tokens, 2, places=2)
+        bucket.stamp -= 60
+        bucket.ready()
+        self.assertEqual(bucket.tokens, 5)
+
+    # delay() is how long until there is a token to take
+    def test_delay(self):
+        bucket = TokenBucket(4, 5)
+        bucket.tokens = 0
+        self.assertEqual(bucket.delay(), 0.25)
+        bucket.tokens = 0.5
+        self.assertEqual(bucket.delay(), 0.125)
+        bucket.tokens = 3
+        self.assertEqual(bucket.delay(), 0.0)
+
+
+class FloodTest(unittest.TestCase):
+    def setUp(self):
+        self.network = SimulatedNetwork()
+        self.hub = self.network.add_server("hub.irc")
+        self.network.add_client("hub.irc", "frodo")
+        self.network.add_client("hub.irc", "sam")
+        self.frodo = self.hub.users_lookuptable["frodo"]
+        self.bucket = self.frodo.connection.flood = TokenBucket(2, 5)
+        self.network.received["sam"] = []
+
+    def tearDown(self):
+        self.network.close()
+
+    def delivered(self):
+        return [line.rsplit(":", 1)[1] for line in self.network.received["sam"]]
+
+    # Lines past the burst wait in the client's buffer, and the client isn't read from, until it has tokens again.
+    # They are then handled in order
+    def test_flood_held_back(self):
+        self.network.send("frodo", "\r\n".join("PRIVMSG sam :%i" % i for i in range(10)))
+        self.assertEqual(self.delivered(), ["0", "1", "2", "3", "4"])
+        self.assertIn(self.frodo, self.hub.throttled)
+        self.assertFalse(self.frodo.connection.reading)
+
+        self.bucket.stamp -= 1
+        self.hub.resume_throttled(self.frodo)
+        self.network.pump()
+        self.assertEqual(self.delivered(), ["0", "1", "2", "3", "4", "5", "6"])
+        self.assertIn(self.frodo, self.hub.throttled)
+
+        self.bucket.stamp -= 60
+        self.hub.resume_throttled(self.frodo)
+        self.network.pump()
+        self.assertEqual(self.delivered(), [str(i) for i in range(10)])
+        self.assertNotIn(self.frodo, self.hub.throttled)
+        self.assertTrue(self.frodo.connection.reading)
+
+    # A throttled client that disconnects is forgotten, along with its resume timer
+    def test_throttled_client_closed(self):
+        self.network.send("frodo", "\r\n".join("PRIVMSG sam :%i" % i for i in range(10)))
+        del self.network.clients["frodo"]
+        self.hub.close_connection(self.frodo.connection.sock)
+        self.assertEqual(self.hub.throttled, {})
+        self.assertNotIn("frodo", self.hub.users_lookuptable)
+
+
+if __name__ == "__main__":
+    unittest.main()
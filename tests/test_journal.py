@@ -0,0 +1,150 @@
+# Tests for the message journal in IRCJournal: appending records, querying a target's history by sequence number and
+# by time, rolling over to new segments, reopening a journal (including one whose last record was cut short), and
+# removing old segments
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from IRCJournal import Journal
+
+
+def line(n, target="#shire"):
+    return (":frodo PRIVMSG %s :message %i\r\n" % (target, n)).encode()
+
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.journals = []
+
+    def tearDown(self):
+        for journal in self.journals:
+            if journal.writer.is_alive():
+                journal.close()
+        shutil.rmtree(self.directory)
+
+    def open(self, **options):
+        journal = Journal(self.directory, **options)
+        self.journals.append(journal)
+        return journal
+
+    def segment_files(self):
+        return sorted(os.listdir(self.directory))
+
+    def test_history_of_a_target(self):
+        journal = self.open()
+        journal.append(["#shire"], line(1))
+        journal.append(["#mordor"], line(2, "#mordor"))
+        journal.append(["#shire", "sam"], line(3, "#shire,sam"))
+        self.assertEqual([seq for seq, when, data in journal.history("#shire")], [1, 3])
+        self.assertEqual(journal.history("sam")[0][2], line(3, "#shire,sam"))
+        self.assertEqual(journal.history("#gondor"), [])
+
+    # Targets are looked up without caring about case, like nicks and channel names
+    def test_history_is_case_insensitive(self):
+        journal = self.open()
+        journal.append(["#Shire"], line(1))
+        self.assertEqual(len(journal.history("#SHIRE")), 1)
+        self.assertEqual(len(journal.history("#shire")), 1)
+
+    def test_history_by_sequence_number_and_limit(self):
+        journal = self.open()
+        for n in range(1, 11):
+            journal.append(["#shire"], line(n))
+        self.assertEqual([seq for seq, when, data in journal.history("#shire", start=4, end=6)], [4, 5, 6])
+        self.assertEqual([seq for seq, when, data in journal.history("#shire", limit=3)], [8, 9, 10])
+        self.assertEqual([seq for seq, when, data in journal.history("#shire", start=9)], [9, 10])
+
+    def test_history_by_time(self):
+        journal = self.open()
+        times = []
+        for n in range(1, 6):
+            journal.append(["#shire"], line(n))
+            times.append(journal.last_time)
+        history = journal.history("#shire", since=times[1], until=times[3])
+        self.assertEqual([seq for seq, when, data in history], [2, 3, 4])
+        self.assertTrue(all(times[1] <= when <= times[3] for seq, when, data in history))
+
+    # Queries work the same on sealed segments (read through their index files) as on the one being written
+    def test_history_across_segments(self):
+        journal = self.open(segment_size=512)
+        for n in range(1, 101):
+            journal.append(["#shire" if n % 2 else "#mordor"], line(n))
+        self.assertGreater(len(journal.sealed), 3)
+        history = journal.history("#shire")
+        self.assertEqual([seq for seq, when, data in history], list(range(1, 101, 2)))
+        self.assertEqual(history[-1][2], line(99))
+        self.assertEqual([seq for seq, when, data in journal.history("#mordor", start=40, end=60)],
+                         list(range(40, 61, 2)))
+
+    def test_reopen(self):
+        journal = self.open(segment_size=512)
+        for n in range(1, 51):
+            journal.append(["#shire"], line(n))
+        journal.close()
+
+        journal = self.open(segment_size=512)
+        self.assertEqual(journal.next_seq, 51)
+        journal.append(["#shire"], line(51))
+        self.assertEqual([seq for seq, when, data in journal.history("#shire")], list(range(1, 52)))
+
+    # A record cut short by a crash is removed when the journal is opened again, and the next record takes its place
+    def test_reopen_after_a_torn_write(self):
+        journal = self.open()
+        for n in range(1, 4):
+            journal.append(["#shire"], line(n))
+        journal.close()
+        log = os.path.join(self.directory, self.segment_files()[-1])
+        with open(log, "r+b") as f:
+            f.truncate(os.path.getsize(log) - 5)
+
+        journal = self.open()
+        self.assertEqual(journal.next_seq, 3)
+        journal.append(["#shire"], line(4))
+        self.assertEqual([data for seq, when, data in journal.history("#shire")], [line(1), line(2), line(4)])
+
+    def test_prune_by_size(self):
+        journal = self.open(segment_size=1024, max_size=4096)
+        for n in range(1, 501):
+            journal.append(["#shire"], line(n))
+        journal.sync()
+        size = sum(os.path.getsize(os.path.join(self.directory, name)) for name in self.segment_files())
+        self.assertLessEqual(size, 4096 + 1024)
+        history = journal.history("#shire")
+        self.assertEqual(history[-1][0], 500)
+        self.assertGreater(history[0][0], 1)
+
+    def test_prune_by_age(self):
+        journal = self.open(segment_size=512, max_age=3600)
+        for n in range(1, 51):
+            journal.append(["#shire"], line(n))
+        sealed = len(journal.sealed)
+        self.assertGreater(sealed, 0)
+        journal.prune()
+        self.assertEqual(len(journal.sealed), sealed)
+
+        # Every sealed segment is older than this, but the one being written is never removed
+        journal.max_age = 0.001
+        time.sleep(0.01)
+        journal.prune()
+        journal.sync()
+        self.assertEqual(journal.sealed, [])
+        self.assertEqual(len([name for name in self.segment_files() if name.endswith(".log")]), 1)
+        self.assertEqual(journal.history("#shire")[-1][0], 50)
+
+    def test_unknown_fsync_policy(self):
+        with self.assertRaises(ValueError):
+            Journal(self.directory, fsync="sometimes")
+
+    def test_fsync_always(self):
+        journal = self.open(fsync="always")
+        journal.append(["#shire"], line(1))
+        journal.sync()
+        self.assertEqual(len(journal.history("#shire")), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
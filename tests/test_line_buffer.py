@@ -0,0 +1,98 @@
+# Tests for LineBuffer in IRCServer, which frames the bytes received on a connection into messages
+
+import unittest
+
+from IRCServer import LineBuffer
+
+
+def read_all(buf):
+    lines = []
+    while True:
+        line = buf.readline()
+        if line is None:
+            return lines
+        lines.append(line)
+
+
+class LineBufferTest(unittest.TestCase):
+    def test_several_messages_in_one_read(self):
+        buf = LineBuffer()
+        buf.feed(b"NICK a\r\nJOIN #b\r\nPART #b\r\n")
+        self.assertEqual(read_all(buf), ["NICK a", "JOIN #b", "PART #b"])
+        self.assertEqual(len(buf), 0)
+
+    def test_message_split_over_reads(self):
+        buf = LineBuffer()
+        buf.feed(b"PRIVMSG bob :hel")
+        self.assertIsNone(buf.readline())
+        buf.feed(b"lo\r")
+        self.assertIsNone(buf.readline())
+        buf.feed(b"\nQUIT\r\n")
+        self.assertEqual(read_all(buf), ["PRIVMSG bob :hello", "QUIT"])
+
+    # Only \r\n ends a message
+    def test_bare_newline_is_not_a_line_end(self):
+        buf = LineBuffer()
+        buf.feed(b"QUIT\nmore\r\n")
+        self.assertEqual(read_all(buf), ["QUIT\nmore"])
+
+    def test_empty_message(self):
+        buf = LineBuffer()
+        buf.feed(b"\r\nQUIT\r\n")
+        self.assertEqual(read_all(buf), ["", "QUIT"])
+
+    # Half of a multibyte UTF-8 character stays in the buffer until the rest of it arrives
+    def test_utf8_character_split_over_reads(self):
+        encoded = "PRIVMSG bob :café\r\n".encode()
+        buf = LineBuffer()
+        buf.feed(encoded[:-3])
+        self.assertIsNone(buf.readline())
+        buf.feed(encoded[-3:])
+        self.assertEqual(read_all(buf), ["PRIVMSG bob :café"])
+
+    def test_invalid_utf8_is_replaced(self):
+        buf = LineBuffer()
+        buf.feed(b"PRIVMSG bob :\xff\r\n")
+        self.assertEqual(read_all(buf), ["PRIVMSG bob :�"])
+
+    def test_processed_data_is_dropped(self):
+        buf = LineBuffer()
+        for i in range(1000):
+            buf.feed(b"PRIVMSG bob :message\r\n")
+            buf.readline()
+        buf.feed(b"partial")
+        self.assertEqual(len(buf.buffer), len(b"partial"))
+
+    # A message longer than max_line_length (counting the \r\n) is cut short, and the rest of it is skipped
+    def test_long_message_is_truncated(self):
+        buf = LineBuffer(max_line_length=16)
+        buf.feed(b"PRIVMSG bob :0123456789\r\nQUIT\r\n")
+        self.assertEqual(read_all(buf), ["PRIVMSG bob :0", "QUIT"])
+        self.assertEqual(buf.truncated, 1)
+
+    def test_message_at_the_limit_is_kept(self):
+        buf = LineBuffer(max_line_length=16)
+        buf.feed(b"PRIVMSG bob :0\r\n")
+        self.assertEqual(read_all(buf), ["PRIVMSG bob :0"])
+        self.assertEqual(buf.truncated, 0)
+
+    # The start of a long message is handed on as soon as there is a full message worth of it, and the rest is skipped
+    # as it arrives, so the buffer doesn't grow while the sender keeps going
+    def test_long_message_without_end_yet(self):
+        buf = LineBuffer(max_line_length=16)
+        buf.feed(b"PRIVMSG bob :0123456789")
+        self.assertEqual(buf.readline(), "PRIVMSG bob :0")
+        buf.feed(b"x" * 1000)
+        self.assertIsNone(buf.readline())
+        self.assertEqual(len(buf), 0)
+        buf.feed(b"yyy\r\nQUIT\r\n")
+        self.assertEqual(read_all(buf), ["QUIT"])
+        self.assertEqual(buf.truncated, 1)
+
+    def test_truncation_does_not_split_a_character(self):
+        buf = LineBuffer(max_line_length=10)
+        buf.feed("abcdefgéé\r\n".encode())
+        self.assertEqual(read_all(buf), ["abcdefg"])
+
+if __name__ == "__main__":
+    unittest.main()
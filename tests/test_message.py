@@ -0,0 +1,90 @@
+# Tests for the message codec in IRCMessage: parsing received lines, the parameters the handlers are given, and
+# serializing messages back into the wire format
+
+import unittest
+
+from IRCMessage import IRCMessage, irc_lower
+
+
+class ParseTest(unittest.TestCase):
+    def test_prefix_command_params_and_trailing(self):
+        msg = IRCMessage.parse(":rivendale.irc.com USER samwise bagend theshire.irc.com :Samwise Gamgee")
+        self.assertEqual(msg.prefix, "rivendale.irc.com")
+        self.assertEqual(msg.command, "USER")
+        self.assertEqual(msg.params, ["samwise", "bagend", "theshire.irc.com"])
+        self.assertEqual(msg.trailing, "Samwise Gamgee")
+
+    def test_no_prefix(self):
+        msg = IRCMessage.parse("JOIN #Orcs4Isengard fubar")
+        self.assertIsNone(msg.prefix)
+        self.assertEqual(msg.command, "JOIN")
+        self.assertEqual(msg.params, ["#Orcs4Isengard", "fubar"])
+        self.assertIsNone(msg.trailing)
+
+    # Only the first " :" starts the trailing parameter; anything after it, colons included, is part of it
+    def test_trailing_keeps_colons_and_spaces(self):
+        msg = IRCMessage.parse("PRIVMSG #RingBearers :one : two  three")
+        self.assertEqual(msg.params, ["#RingBearers"])
+        self.assertEqual(msg.trailing, "one : two  three")
+
+    def test_empty_trailing(self):
+        msg = IRCMessage.parse("TOPIC #RingBearers :")
+        self.assertEqual(msg.trailing, "")
+        self.assertEqual(msg.handler_params(), ["#RingBearers", ""])
+
+    def test_repeated_spaces_between_params(self):
+        self.assertEqual(IRCMessage.parse("JOIN   #a   key").params, ["#a", "key"])
+
+    def test_empty_line(self):
+        msg = IRCMessage.parse("")
+        self.assertEqual(msg.command, "")
+        self.assertIsNone(msg.handler_params())
+
+
+class HandlerParamsTest(unittest.TestCase):
+    def test_trailing_is_last(self):
+        self.assertEqual(IRCMessage.parse("PRIVMSG bob :hi there").handler_params(), ["bob", "hi there"])
+
+    def test_middle_params_only(self):
+        self.assertEqual(IRCMessage.parse("PART #a").handler_params(), ["#a"])
+
+    def test_no_params(self):
+        self.assertIsNone(IRCMessage.parse("QUIT").handler_params())
+
+
+class SerializeTest(unittest.TestCase):
+    def test_wire_format(self):
+        msg = IRCMessage("PRIVMSG", ["#a,bob"], "hello world", prefix="alice")
+        self.assertEqual(msg.serialize(), b":alice PRIVMSG #a,bob :hello world\r\n")
+
+    def test_without_prefix_or_trailing(self):
+        self.assertEqual(IRCMessage("NAMES").serialize(), b"NAMES\r\n")
+        self.assertEqual(IRCMessage("QUIT", prefix="bob").serialize(), b":bob QUIT\r\n")
+
+    def test_round_trip(self):
+        line = ":gondor.irc.com SERVER rivendale.irc.edu 2 :The House of Elrond"
+        self.assertEqual(IRCMessage.parse(line).serialize(), (line + "\r\n").encode())
+        self.assertEqual(str(IRCMessage.parse(line)), line)
+
+    # A message relayed to many connections is encoded once, and they all share the same bytes
+    def test_serialize_is_cached(self):
+        msg = IRCMessage("PRIVMSG", ["#a"], "hi", prefix="alice")
+        self.assertIs(msg.serialize(), msg.serialize())
+
+    def test_non_ascii_text(self):
+        msg = IRCMessage("PRIVMSG", ["bob"], "café", prefix="alice")
+        self.assertEqual(msg.serialize(), ":alice PRIVMSG bob :café\r\n".encode())
+
+
+class IrcLowerTest(unittest.TestCase):
+    def test_ascii_letters(self):
+        self.assertEqual(irc_lower("#RingBearers"), "#ringbearers")
+
+    # RFC 1459 treats {}|^ as the lower case versions of []\~
+    def test_rfc1459_casemap(self):
+        self.assertEqual(irc_lower("[Nick]\\~"), "{nick}|^")
+        self.assertEqual(irc_lower("{nick}|^"), "{nick}|^")
+
+
+if __name__ == "__main__":
+    unittest.main()
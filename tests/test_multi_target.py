@@ -0,0 +1,68 @@
+# Tests for PRIVMSGs addressed to a list of targets: the message crosses each server link once, addressed to every
+# target behind it, and each user gets it once however many of the targets reach them. The servers are wired together
+# in-process with the SimulatedNetwork from tests/support.py
+
+import unittest
+
+from tests.support import SimulatedNetwork
+
+
+class MultiTargetTest(unittest.TestCase):
+    # hub.irc with frodo and bilbo, and two leaves linked to it: one with sam and pippin, one with merry
+    def setUp(self):
+        self.network = SimulatedNetwork()
+        self.hub = self.network.add_server("hub.irc")
+        self.network.add_server("leaf1.irc", "hub.irc")
+        self.network.add_server("leaf2.irc", "hub.irc")
+        for servername, nick in (("hub.irc", "frodo"), ("hub.irc", "bilbo"), ("leaf1.irc", "sam"),
+                                 ("leaf1.irc", "pippin"), ("leaf2.irc", "merry")):
+            self.network.add_client(servername, nick)
+        self.clear()
+
+    def tearDown(self):
+        self.network.close()
+
+    def clear(self):
+        for nick in self.network.received:
+            self.network.received[nick] = []
+        self.network.link_messages = 0
+
+    # One message goes to each leaf, naming only the targets behind it (once each)
+    def test_one_message_per_next_hop(self):
+        hub = self.hub
+        leaf1 = hub.servers_lookuptable["leaf1.irc"].connection.write_buffer
+        leaf2 = hub.servers_lookuptable["leaf2.irc"].connection.write_buffer
+        hub.process_data(hub.sel.get_key(self.network.clients["frodo"][1]), b"PRIVMSG sam,merry,pippin,sam :hi\r\n")
+        self.assertEqual(list(leaf1.pop_all()), [b":frodo PRIVMSG sam,pippin :hi\r\n"])
+        self.assertEqual(list(leaf2.pop_all()), [b":frodo PRIVMSG merry :hi\r\n"])
+
+    # Every target gets the message once, addressed to themselves
+    def test_remote_users(self):
+        self.network.send("frodo", "PRIVMSG sam,merry,pippin,sam :hi")
+        self.assertEqual(self.network.link_messages, 2)
+        self.assertEqual(self.network.received["sam"], [":frodo PRIVMSG sam :hi"])
+        self.assertEqual(self.network.received["pippin"], [":frodo PRIVMSG pippin :hi"])
+        self.assertEqual(self.network.received["merry"], [":frodo PRIVMSG merry :hi"])
+        self.assertEqual(self.network.received["frodo"], [])
+
+    # A user reached both through a channel and by name gets the message once, addressed to the first target that
+    # reached them, whether they are on the sender's server or another
+    def test_channel_and_nick(self):
+        for nick in ("frodo", "bilbo", "sam"):
+            self.network.send(nick, "JOIN #shire")
+        self.clear()
+        self.network.send("frodo", "PRIVMSG #shire,bilbo,sam :hi")
+        self.assertEqual(self.network.link_messages, 1)
+        self.assertEqual(self.network.received["bilbo"], [":frodo PRIVMSG #shire :hi"])
+        self.assertEqual(self.network.received["sam"], [":frodo PRIVMSG #shire :hi"])
+        self.assertEqual(self.network.received["frodo"], [])
+
+    # Targets that don't exist are reported, and the rest are still delivered to
+    def test_unknown_target(self):
+        self.network.send("frodo", "PRIVMSG gollum,sam :hi")
+        self.assertEqual(self.network.received["frodo"], [":hub.irc 401 gollum :No such nick"])
+        self.assertEqual(self.network.received["sam"], [":frodo PRIVMSG sam :hi"])
+
+
+if __name__ == "__main__":
+    unittest.main()
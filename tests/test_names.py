@@ -0,0 +1,37 @@
+# Tests for the NAMES command in IRCServer, on a single server wired up with the SimulatedNetwork from tests/support.py
+
+import unittest
+
+from tests.support import SimulatedNetwork
+
+
+class NamesTest(unittest.TestCase):
+    def setUp(self):
+        self.network = SimulatedNetwork()
+        self.network.add_server("hub.irc")
+        self.network.add_client("hub.irc", "frodo")
+        self.network.add_client("hub.irc", "sam")
+        self.network.send("frodo", "JOIN #shire")
+        self.network.received["sam"] = []
+
+    def tearDown(self):
+        self.network.close()
+
+    def test_names_of_a_channel(self):
+        self.network.send("sam", "NAMES #shire")
+        self.assertEqual(self.network.received["sam"],
+                         [":hub.irc 353 #shire :frodo", ":hub.irc 366 #shire :End of /NAMES list"])
+
+    # Without a channel, every channel is listed, then the users who aren't in one under *
+    def test_names_of_every_channel(self):
+        self.network.send("sam", "NAMES")
+        self.assertEqual(self.network.received["sam"],
+                         [":hub.irc 353 #shire :frodo", ":hub.irc 353 * :sam", ":hub.irc 366 * :End of /NAMES list"])
+
+    def test_no_such_channel(self):
+        self.network.send("sam", "NAMES #mordor")
+        self.assertEqual(self.network.received["sam"], [":hub.irc 403 #mordor :No such channel"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+# Tests for how IRCServer cleans up after losing the link to an adjacent server (a netsplit), on servers wired
+# together in-process with the SimulatedNetwork from tests/support.py
+
+import unittest
+
+from tests.support import SimulatedNetwork
+
+
+class NetsplitTest(unittest.TestCase):
+    # other.irc - hub.irc - middle.irc - edge.irc, with a user on each server, all in #shire
+    def setUp(self):
+        self.network = SimulatedNetwork()
+        self.hub = self.network.add_server("hub.irc")
+        self.other = self.network.add_server("other.irc", "hub.irc")
+        self.network.add_server("middle.irc", "hub.irc")
+        self.network.add_server("edge.irc", "middle.irc")
+        for servername, nick in (("hub.irc", "frodo"), ("other.irc", "merry"), ("middle.irc", "sam"),
+                                 ("edge.irc", "pippin")):
+            self.network.add_client(servername, nick)
+            self.network.send(nick, "JOIN #shire")
+        self.network.received["frodo"] = []
+        self.network.received["merry"] = []
+
+    def tearDown(self):
+        self.network.close()
+
+    # Everything behind the lost link is removed: its users and servers, their routes, and the link's entries in
+    # the reverse index
+    def test_state_removed(self):
+        self.network.remove_server("middle.irc")
+        for server in (self.hub, self.other):
+            self.assertEqual(sorted(server.users_lookuptable), ["frodo", "merry"])
+            self.assertEqual(sorted(server.user_routes), ["frodo", "merry"])
+            self.assertNotIn("middle.irc", server.servers_lookuptable)
+            self.assertNotIn("edge.irc", server.servers_lookuptable)
+            self.assertNotIn("middle.irc", server.server_routes)
+            self.assertNotIn("edge.irc", server.server_routes)
+            self.assertEqual(sorted(server.channels["#shire"].users), ["frodo", "merry"])
+        self.assertEqual(list(self.hub.adjacent_servers), ["other.irc"])
+        self.assertNotIn("middle.irc", self.hub.link_users)
+        self.assertNotIn("middle.irc", self.hub.link_servers)
+        self.assertNotIn("sam", self.other.link_users["hub.irc"])
+        self.assertNotIn("edge.irc", self.other.link_servers["hub.irc"])
+
+    # The users left in the channel are told each lost user has quit, on both sides of the remaining link
+    def test_neighbours_see_quits(self):
+        self.network.remove_server("middle.irc")
+        expected = [":sam QUIT :hub.irc middle.irc", ":pippin QUIT :hub.irc middle.irc"]
+        self.assertEqual(self.network.received["frodo"], expected)
+        self.assertEqual(self.network.received["merry"], expected)
+
+    # The remaining servers are sent the QUITs and then the SQUITs, queued as a single write
+    def test_single_batch(self):
+        link = next(sock for (server, sock), (peer, peer_sock) in self.network.peers.items()
+                    if server is self.hub and peer is self.network.servers["middle.irc"])
+        other = self.hub.servers_lookuptable["other.irc"]
+        self.hub.close_connection(link)
+        chunks = list(other.connection.write_buffer.pop_all())
+        self.assertEqual(len(chunks), 1)
+        self.assertEqual(chunks[0].decode().split("\r\n")[:-1],
+                         [":sam QUIT :hub.irc middle.irc", ":pippin QUIT :hub.irc middle.irc",
+                          ":hub.irc SQUIT edge.irc :hub.irc middle.irc",
+                          ":hub.irc SQUIT middle.irc :hub.irc middle.irc"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+# Tests for OutputQueue in IRCServer, which holds the output waiting to be sent on a connection and resumes partial
+# sends
+
+import unittest
+
+from IRCServer import OutputQueue
+
+
+# A socket that accepts at most limit bytes per call, and records what it was sent
+class FakeSocket(object):
+    def __init__(self, limit):
+        self.limit = limit
+        self.data = bytearray()
+        self.calls = 0
+
+    def sendmsg(self, buffers):
+        return self.send(b"".join(bytes(b) for b in buffers))
+
+    def send(self, data):
+        self.calls += 1
+        if self.limit == 0:
+            raise BlockingIOError
+        sent = bytes(data[:self.limit])
+        self.data += sent
+        return len(sent)
+
+
+class OutputQueueTest(unittest.TestCase):
+    def test_everything_sent_in_one_call(self):
+        queue = OutputQueue()
+        for chunk in (b"one\r\n", b"two\r\n", b"three\r\n"):
+            queue.append(chunk)
+        sock = FakeSocket(1000)
+        self.assertEqual(queue.flush(sock), 17)
+        self.assertEqual(bytes(sock.data), b"one\r\ntwo\r\nthree\r\n")
+        self.assertEqual(sock.calls, 1)
+        self.assertEqual(len(queue), 0)
+
+    # The kernel taking only part of the output leaves the rest queued, and the next flush resumes where it stopped
+    def test_partial_send_resumes_mid_chunk(self):
+        queue = OutputQueue()
+        queue.append(b"abcdef")
+        queue.append(b"ghij")
+        sock = FakeSocket(4)
+        self.assertEqual(queue.flush(sock), 4)
+        self.assertEqual(len(queue), 6)
+        sock.limit = 3
+        queue.flush(sock)
+        sock.limit = 100
+        queue.flush(sock)
+        self.assertEqual(bytes(sock.data), b"abcdefghij")
+        self.assertEqual(len(queue), 0)
+
+    def test_would_block(self):
+        queue = OutputQueue()
+        queue.append(b"abc")
+        self.assertEqual(queue.flush(FakeSocket(0)), 0)
+        self.assertEqual(len(queue), 3)
+
+    def test_empty_chunks_are_ignored(self):
+        queue = OutputQueue()
+        queue.append(b"")
+        self.assertEqual(len(queue), 0)
+        self.assertFalse(queue.chunks)
+
+    def test_pop_all_after_partial_send(self):
+        queue = OutputQueue()
+        queue.append(b"abcdef")
+        queue.append(b"gh")
+        queue.flush(FakeSocket(2))
+        self.assertEqual(b"".join(queue.pop_all()), b"cdefgh")
+        self.assertEqual(len(queue), 0)
+
+    def test_extend(self):
+        first, second = OutputQueue(), OutputQueue()
+        first.append(b"ab")
+        second.append(b"cdef")
+        second.flush(FakeSocket(1))
+        first.extend(second)
+        self.assertEqual(len(first), 5)
+        self.assertEqual(len(second), 0)
+        self.assertEqual(b"".join(first.pop_all()), b"abdef")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+# Tests for how IRCServer handles commands around registration: commands from connections that haven't sent USER or
+# SERVER yet, a second USER or SERVER on a registered connection, and the QUIT sent for a user whose connection is
+# closed. The servers are wired together in-process with the SimulatedNetwork from tests/support.py
+
+import selectors
+import shutil
+import socket
+import tempfile
+import unittest
+
+from tests.support import SimulatedNetwork
+from IRCServer import ConnectionData, Connection
+
+
+class RegistrationTest(unittest.TestCase):
+    def setUp(self):
+        self.network = SimulatedNetwork()
+        self.hub = self.network.add_server("hub.irc")
+        self.sockets = []
+
+    def tearDown(self):
+        self.network.close()
+        for sock in self.sockets:
+            sock.close()
+
+    # Connect a client that hasn't sent USER, under the name it is known by in the network's clients
+    def connect(self, name):
+        sock, peer = socket.socketpair()
+        self.sockets.append(peer)
+        self.hub.sel.register(sock, selectors.EVENT_READ, ConnectionData(Connection(sock)))
+        self.network.clients[name] = (self.hub, sock)
+        self.network.received[name] = []
+
+    def replies(self, name):
+        received = self.network.received[name]
+        self.network.received[name] = []
+        return received
+
+    def test_commands_before_registering(self):
+        self.connect("raw")
+        for line in ("JOIN #a", "JOIN", "PART #a", "PART", "TOPIC #a :topic", "TOPIC", "PRIVMSG #a :hi", "PRIVMSG",
+                     "QUIT :bye"):
+            self.network.send("raw", line)
+            command = line.split()[0]
+            self.assertEqual(self.replies("raw"), [":hub.irc 451 %s :You have not registered" % command])
+        self.assertEqual(self.hub.channels, {})
+
+        # The connection can still register afterwards
+        self.network.send("raw", "USER frodo bagend hub.irc :Frodo Baggins")
+        self.assertIn("frodo", self.hub.users_lookuptable)
+
+    # A registered user who leaves out a command's parameters is told so
+    def test_missing_params_after_registering(self):
+        self.network.add_client("hub.irc", "frodo")
+        self.replies("frodo")
+        for command in ("JOIN", "PART", "TOPIC", "PRIVMSG"):
+            self.network.send("frodo", command)
+            self.assertEqual(self.replies("frodo"), [":hub.irc 461 %s :Not enough parameters" % command])
+
+    # A second USER is refused, and the user keeps its nick and connection
+    def test_second_user(self):
+        self.network.add_client("hub.irc", "frodo")
+        self.network.add_client("hub.irc", "sam")
+        self.replies("frodo")
+        self.network.send("frodo", "USER baggins bagend hub.irc :Mr. Underhill")
+        self.assertEqual(self.replies("frodo"), [":hub.irc 462 USER :You may not reregister"])
+        self.assertNotIn("baggins", self.hub.users_lookuptable)
+
+        self.network.send("sam", "PRIVMSG frodo :Mr. Frodo")
+        self.assertEqual(self.replies("frodo"), [":sam PRIVMSG frodo :Mr. Frodo"])
+
+    def test_server_from_registered_user(self):
+        self.network.add_client("hub.irc", "frodo")
+        self.replies("frodo")
+        self.network.send("frodo", "SERVER bagend.irc 1 :Bag End")
+        self.assertEqual(self.replies("frodo"), [":hub.irc 462 SERVER :You may not reregister"])
+        self.assertNotIn("bagend.irc", self.hub.servers_lookuptable)
+
+    # A PRIVMSG relayed from a nick this server doesn't know is dropped
+    def test_privmsg_from_unknown_nick(self):
+        leaf = self.network.add_server("leaf.irc", "hub.irc")
+        self.network.add_client("hub.irc", "frodo")
+        self.replies("frodo")
+        link = next(sock for (server, sock) in self.network.peers if server is leaf)
+        leaf.queue_message(leaf.sel.get_key(link).data, b":nazgul PRIVMSG frodo :give it to us\r\n")
+        self.network.pump()
+        self.assertEqual(self.replies("frodo"), [])
+
+    # A user whose connection closes quits the same way as one that sent QUIT, with the reason as its goodbye
+    def test_closed_connection_quits(self):
+        directory = tempfile.mkdtemp()
+        network = SimulatedNetwork()
+        try:
+            hub = network.add_server("hub.irc", journal_dir=directory)
+            network.add_server("leaf.irc", "hub.irc")
+            network.add_client("hub.irc", "frodo")
+            network.add_client("leaf.irc", "sam")
+            network.send("frodo", "JOIN #shire")
+            network.send("sam", "JOIN #shire")
+
+            server, sock = network.clients.pop("frodo")
+            hub.close_connection(sock, "Ping timeout")
+            network.pump()
+            self.assertEqual(network.received["sam"][-1], ":frodo QUIT :Ping timeout")
+            self.assertNotIn("frodo", network.servers["leaf.irc"].users_lookuptable)
+            self.assertEqual(hub.journal.history("#shire")[-1][2], b":frodo QUIT :Ping timeout\r\n")
+            hub.journal.close()
+        finally:
+            network.close()
+            shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+# Tests for IRCServer's routing table (user_routes and server_routes), which maps every known user and server to the
+# adjacent connection messages for it are queued on. The servers are wired together in-process with the
+# SimulatedNetwork from tests/support.py
+
+import unittest
+
+from tests.support import SimulatedNetwork
+
+
+class RoutingTest(unittest.TestCase):
+    # hub.irc - middle.irc - edge.irc, with a user on each server
+    def setUp(self):
+        self.network = SimulatedNetwork()
+        self.hub = self.network.add_server("hub.irc")
+        self.middle = self.network.add_server("middle.irc", "hub.irc")
+        self.edge = self.network.add_server("edge.irc", "middle.irc")
+        self.network.add_client("hub.irc", "frodo")
+        self.network.add_client("middle.irc", "sam")
+        self.network.add_client("edge.irc", "pippin")
+
+    def tearDown(self):
+        self.network.close()
+
+    # Every route leads to the next hop: a local user is its own route, and everything else goes through the
+    # adjacent server it was announced by
+    def test_routes_lead_to_next_hop(self):
+        middle = self.hub.servers_lookuptable["middle.irc"]
+        self.assertIs(self.hub.user_routes["frodo"], self.hub.users_lookuptable["frodo"])
+        self.assertIs(self.hub.user_routes["sam"], middle)
+        self.assertIs(self.hub.user_routes["pippin"], middle)
+        self.assertIs(self.hub.server_routes["middle.irc"], middle)
+        self.assertIs(self.hub.server_routes["edge.irc"], middle)
+
+        self.assertIs(self.middle.user_routes["frodo"], self.middle.servers_lookuptable["hub.irc"])
+        self.assertIs(self.middle.user_routes["pippin"], self.middle.servers_lookuptable["edge.irc"])
+        self.assertIs(self.edge.server_routes["hub.irc"], self.edge.servers_lookuptable["middle.irc"])
+
+    # send_message_to_client() queues a message for a remote user on the link to the next hop only
+    def test_message_queued_on_next_hop(self):
+        middle = self.hub.servers_lookuptable["middle.irc"]
+        frodo = self.hub.users_lookuptable["frodo"]
+        frodo.connection.write_buffer.pop_all()
+        self.hub.send_message_to_client("pippin", b":frodo PRIVMSG pippin :hello\r\n")
+        self.assertEqual(list(middle.connection.write_buffer.pop_all()), [b":frodo PRIVMSG pippin :hello\r\n"])
+        self.assertEqual(len(frodo.connection.write_buffer), 0)
+
+    # A message sent to a user on another server arrives by way of the routes
+    def test_privmsg_across_servers(self):
+        self.network.send("frodo", "PRIVMSG pippin :hello")
+        self.assertEqual(self.network.received["pippin"][-1], ":frodo PRIVMSG pippin :hello")
+
+    # A user that quits is taken out of the routing table and its link's reverse index on every server
+    def test_routes_removed_on_quit(self):
+        self.network.send("pippin", "QUIT :bye")
+        for server in (self.hub, self.middle, self.edge):
+            self.assertNotIn("pippin", server.user_routes)
+        self.assertNotIn("pippin", self.hub.link_users["middle.irc"])
+        self.assertNotIn("pippin", self.middle.link_users["edge.irc"])
+        self.assertIn("sam", self.hub.link_users["middle.irc"])
+
+
+if __name__ == "__main__":
+    unittest.main()
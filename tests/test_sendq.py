@@ -0,0 +1,73 @@
+# Tests for send queue limits in IRCServer: a connection whose queued output grows past its limit is noted as a slow
+# consumer, and disconnected by evict_slow_consumers() unless its queue has drained in the meantime. The servers are
+# wired together in-process with the SimulatedNetwork from tests/support.py
+
+import unittest
+
+from tests.support import SimulatedNetwork
+
+
+class SendQTest(unittest.TestCase):
+    def setUp(self):
+        self.network = SimulatedNetwork()
+        self.hub = self.network.add_server("hub.irc", sendq_client=1024, sendq_server=4096)
+        self.network.add_server("leaf.irc", "hub.irc")
+        self.network.add_client("hub.irc", "frodo")
+        self.network.add_client("hub.irc", "sam")
+        self.network.add_client("leaf.irc", "merry")
+        for nick in ("frodo", "sam", "merry"):
+            self.network.send(nick, "JOIN #shire")
+        for nick in self.network.received:
+            self.network.received[nick] = []
+
+    def tearDown(self):
+        self.network.close()
+
+    def fill(self, data, size):
+        for i in range(size // 100):
+            self.hub.queue_message(data, b"x" * 98 + b"\r\n")
+
+    # A client over its limit is disconnected, and its channel and the other servers are told why
+    def test_client_evicted(self):
+        sam = self.hub.users_lookuptable["sam"]
+        self.fill(sam, 1100)
+        self.assertEqual(self.hub.slow_consumers, [sam])
+        self.hub.evict_slow_consumers()
+        self.assertEqual(self.hub.sendq_evictions, 1)
+        self.assertEqual(self.hub.slow_consumers, [])
+        self.assertEqual(sam.connection.sock.fileno(), -1)
+        del self.network.clients["sam"]
+        self.network.pump()
+        self.assertEqual(self.network.received["frodo"], [":sam QUIT :SendQ exceeded"])
+        self.assertEqual(self.network.received["merry"], [":sam QUIT :SendQ exceeded"])
+        self.assertNotIn("sam", self.network.servers["leaf.irc"].users_lookuptable)
+
+    # A client whose queue has been sent by the time evictions are checked stays connected
+    def test_drained_client_kept(self):
+        sam = self.hub.users_lookuptable["sam"]
+        self.fill(sam, 1100)
+        sam.connection.write_buffer.pop_all()
+        self.hub.evict_slow_consumers()
+        self.assertEqual(self.hub.sendq_evictions, 0)
+        self.assertIn("sam", self.hub.users_lookuptable)
+
+    # A client is only noted once, however far past the limit its queue grows
+    def test_noted_once(self):
+        sam = self.hub.users_lookuptable["sam"]
+        self.fill(sam, 3000)
+        self.assertEqual(self.hub.slow_consumers, [sam])
+
+    # Server links have their own, larger limit. Going past it is handled as a netsplit
+    def test_server_limit(self):
+        leaf = self.hub.servers_lookuptable["leaf.irc"]
+        self.fill(leaf, 2000)
+        self.assertEqual(self.hub.slow_consumers, [])
+        self.fill(leaf, 3000)
+        self.hub.evict_slow_consumers()
+        self.assertEqual(self.hub.sendq_evictions, 1)
+        self.assertNotIn("leaf.irc", self.hub.servers_lookuptable)
+        self.assertNotIn("merry", self.hub.users_lookuptable)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+# Tests for the snapshot file format in IRCSnapshot: writing a snapshot, reading its records back by bucket, the
+# bucket digests, and rejecting files that aren't complete snapshots
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from IRCSnapshot import Snapshot, SnapshotBuilder, write_snapshot, server_record, user_record, channel_record, \
+    bucket_of, BUCKET_COUNT
+
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "state.snap")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def build(self):
+        builder = SnapshotBuilder()
+        builder.add(b"S", "gondor.irc", server_record("gondor.irc", "2", "The White City"), "rohan.irc")
+        builder.add(b"U", "aragorn", user_record("aragorn", "dunedain", "gondor.irc", "Strider"), "rohan.irc")
+        builder.add(b"U", "frodo", user_record("frodo", "bagend", "shire.irc", None), "shire.irc")
+        builder.add(b"C", "#fellowship", channel_record("#fellowship", "mellon", None, ["frodo", "aragorn"]),
+                    restorable=False)
+        return builder
+
+    def read_all(self, snapshot):
+        records = {}
+        for bucket in range(BUCKET_COUNT):
+            for first_link, kind, fields in snapshot.records(bucket):
+                self.assertEqual(bucket, bucket_of(kind.encode(), fields[0]))
+                records[fields[0]] = (first_link, kind, fields)
+        return records
+
+    def test_round_trip(self):
+        write_snapshot(self.path, self.build().serialize("shire.irc", "rohan.irc"))
+        snapshot = Snapshot(self.path)
+        try:
+            self.assertEqual(snapshot.servername, "shire.irc")
+            self.assertEqual(snapshot.uplink, "rohan.irc")
+            self.assertEqual(self.read_all(snapshot), {
+                "gondor.irc": ("rohan.irc", "S", ["gondor.irc", "2", "The White City"]),
+                "aragorn": ("rohan.irc", "U", ["aragorn", "dunedain", "gondor.irc", "Strider"]),
+                "frodo": ("shire.irc", "U", ["frodo", "bagend", "shire.irc", None]),
+                # Members are stored sorted
+                "#fellowship": (None, "C", ["#fellowship", "mellon", None, ["aragorn", "frodo"]]),
+            })
+        finally:
+            snapshot.close()
+        self.assertFalse(os.path.exists(self.path + ".tmp"))
+
+    # The digests only count the records a restarted server could take over, and don't depend on the order records
+    # were added in
+    def test_digests(self):
+        builder = self.build()
+        snapshot_digests = list(builder.digests)
+        self.assertEqual(snapshot_digests[bucket_of(b"C", "#fellowship")], 0)
+
+        reordered = SnapshotBuilder(keep_records=False)
+        reordered.add(b"U", "frodo", user_record("frodo", "bagend", "shire.irc", None))
+        reordered.add(b"U", "aragorn", user_record("aragorn", "dunedain", "gondor.irc", "Strider"))
+        reordered.add(b"S", "gondor.irc", server_record("gondor.irc", "2", "The White City"))
+        self.assertEqual(reordered.digests, snapshot_digests)
+
+        changed = SnapshotBuilder(keep_records=False)
+        changed.add(b"U", "frodo", user_record("frodo", "bagend", "shire.irc", "Mr. Underhill"))
+        bucket = bucket_of(b"U", "frodo")
+        self.assertNotEqual(changed.digests[bucket], snapshot_digests[bucket])
+
+    def test_truncated_snapshot(self):
+        data = self.build().serialize("shire.irc", "rohan.irc")
+        with open(self.path, "wb") as f:
+            f.write(data[:-1])
+        with self.assertRaises(ValueError):
+            Snapshot(self.path)
+
+    def test_not_a_snapshot(self):
+        with open(self.path, "wb") as f:
+            f.write(b"this is not a snapshot at all, but it is long enough to have a header")
+        with self.assertRaises(ValueError):
+            Snapshot(self.path)
+
+
+if __name__ == "__main__":
+    unittest.main()
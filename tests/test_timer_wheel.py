@@ -0,0 +1,85 @@
+# Tests for the hashed timer wheel in IRCTimerWheel. The wheel is advanced to times given by the tests, so nothing here
+# waits for real time to pass
+
+import time
+import unittest
+
+from IRCTimerWheel import TimerWheel
+
+
+class TimerWheelTest(unittest.TestCase):
+    def setUp(self):
+        self.wheel = TimerWheel(resolution=0.01, slot_count=8)
+        self.fired = []
+
+    def fire(self, name):
+        self.fired.append(name)
+
+    def test_fires_when_due(self):
+        now = time.monotonic()
+        self.wheel.schedule(0.05, self.fire, "a")
+        self.assertEqual(len(self.wheel), 1)
+        self.wheel.advance(now)
+        self.assertEqual(self.fired, [])
+        self.wheel.advance(now + 0.1)
+        self.assertEqual(self.fired, ["a"])
+        self.assertEqual(len(self.wheel), 0)
+
+    # A timer may fire up to a tick late, but never early
+    def test_never_fires_early(self):
+        start = time.monotonic()
+        self.wheel.schedule(0.05, self.fire, "a")
+        self.wheel.advance(start + 0.03)
+        self.assertEqual(self.fired, [])
+
+    def test_fires_in_order(self):
+        now = time.monotonic()
+        self.wheel.schedule(0.05, self.fire, "late")
+        self.wheel.schedule(0.02, self.fire, "early")
+        self.wheel.advance(now + 0.1)
+        self.assertEqual(self.fired, ["early", "late"])
+
+    def test_cancel(self):
+        now = time.monotonic()
+        timer = self.wheel.schedule(0.02, self.fire, "a")
+        self.wheel.cancel(timer)
+        self.assertEqual(len(self.wheel), 0)
+        self.wheel.advance(now + 0.1)
+        self.assertEqual(self.fired, [])
+        # Cancelling again, or cancelling a timer that has fired, does nothing
+        self.wheel.cancel(timer)
+        fired = self.wheel.schedule(0.0, self.fire, "b")
+        self.wheel.advance(now + 0.2)
+        self.wheel.cancel(fired)
+        self.assertEqual(len(self.wheel), 0)
+
+    # A timer further away than one turn of the wheel shares its slot with nearer ones, but only fires on its own tick
+    def test_timer_beyond_one_turn(self):
+        now = time.monotonic()
+        self.wheel.schedule(0.25, self.fire, "far")
+        self.wheel.advance(now + 0.1)
+        self.assertEqual(self.fired, [])
+        self.wheel.advance(now + 0.3)
+        self.assertEqual(self.fired, ["far"])
+
+    # A timer that a callback schedules for a time advance() has already reached fires in the same call
+    def test_timer_scheduled_from_a_callback(self):
+        now = time.monotonic()
+        self.wheel.schedule(0.01, lambda: self.wheel.schedule(0.01, self.fire, "again"))
+        self.wheel.advance(now + 0.05)
+        self.assertEqual(self.fired, ["again"])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_timeout(self):
+        now = time.monotonic()
+        self.assertIsNone(self.wheel.timeout(now, 1.0))
+        self.wheel.schedule(0.05, self.fire, "a")
+        timeout = self.wheel.timeout(now, 1.0)
+        self.assertGreaterEqual(timeout, 0.04)
+        self.assertLessEqual(timeout, 0.1)
+        # Nothing due within the limit
+        self.assertIsNone(self.wheel.timeout(now, 0.01))
+
+
+if __name__ == "__main__":
+    unittest.main()
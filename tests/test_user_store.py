@@ -0,0 +1,96 @@
+# Tests for the columnar user store in IRCUserStore. A UserStore must behave like the users_lookuptable dictionary
+# it stands in for, except that a remote user looked up in it is a copy, which these tests pin down
+
+import socket
+import unittest
+
+from IRCServer import IRCServer, UserDetails, Connection, server_option_parser
+
+
+def make_user(nick, servername, first_link, hostname="host", realname="Real Name"):
+    user = UserDetails()
+    user.nick = nick
+    user.hostname = hostname
+    user.servername = servername
+    user.realname = realname
+    user.first_link = first_link
+    return user
+
+
+class UserStoreTest(unittest.TestCase):
+    def setUp(self):
+        options, args = server_option_parser().parse_args(["--servername", "hub.irc", "--user-store", "columnar"])
+        self.server = IRCServer(options)
+        self.users = self.server.users_lookuptable
+
+    def test_replaces_the_dictionary(self):
+        self.assertEqual(type(self.users).__name__, "UserStore")
+        self.server.users_lookuptable = {"frodo": make_user("frodo", "shire.irc", "shire.irc")}
+        self.assertEqual(type(self.server.users_lookuptable).__name__, "UserStore")
+        self.assertEqual(self.server.users_lookuptable["frodo"].servername, "shire.irc")
+
+    def test_dictionary_interface(self):
+        self.users["frodo"] = make_user("frodo", "shire.irc", "rohan.irc", realname="Frodo Baggins")
+        self.users["sam"] = make_user("sam", "shire.irc", "rohan.irc", realname=None)
+        self.assertIn("frodo", self.users)
+        self.assertEqual(len(self.users), 2)
+        self.assertEqual(list(self.users), ["frodo", "sam"])
+        self.assertEqual([user.nick for user in self.users.values()], ["frodo", "sam"])
+        self.assertIsNone(self.users["sam"].realname)
+        self.assertIsNone(self.users.get("gollum"))
+
+        user = self.users.pop("frodo")
+        self.assertEqual((user.nick, user.realname, user.first_link), ("frodo", "Frodo Baggins", "rohan.irc"))
+        self.assertNotIn("frodo", self.users)
+        self.assertEqual(self.users.pop("frodo", None), None)
+        with self.assertRaises(KeyError):
+            self.users.pop("frodo")
+        del self.users["sam"]
+        self.assertEqual(len(self.users), 0)
+
+    # A remote user is rebuilt from the columns on every lookup: each lookup is a new object, and changing it doesn't
+    # change the user in the store. Storing the changed copy again does
+    def test_remote_users_are_copies(self):
+        self.users["frodo"] = make_user("frodo", "shire.irc", "rohan.irc")
+        first = self.users["frodo"]
+        self.assertIsNot(first, self.users["frodo"])
+        self.assertIsNot(self.users.get("frodo"), self.users.get("frodo"))
+
+        first.first_link = "gondor.irc"
+        first.realname = "Mr. Underhill"
+        self.assertEqual(self.users["frodo"].first_link, "rohan.irc")
+        self.assertEqual(self.users["frodo"].realname, "Real Name")
+
+        self.users["frodo"] = first
+        self.assertEqual(self.users["frodo"].first_link, "gondor.irc")
+        self.assertEqual(self.users["frodo"].realname, "Mr. Underhill")
+
+    # Users connected to this server (and any user with a Connection) are kept as the objects themselves, since the
+    # selector, the channels and the routing table refer to them
+    def test_local_users_are_kept_as_objects(self):
+        local = make_user("aragorn", "hub.irc", "hub.irc")
+        self.users["aragorn"] = local
+        self.assertIs(self.users["aragorn"], local)
+
+        sock, peer = socket.socketpair()
+        try:
+            connected = make_user("legolas", "mirkwood.irc", "mirkwood.irc")
+            connected.connection = Connection(sock)
+            self.users["legolas"] = connected
+            self.assertIs(self.users["legolas"], connected)
+        finally:
+            sock.close()
+            peer.close()
+
+    # Slots of users that have left are reused, without anything of the old user showing through
+    def test_slots_are_reused(self):
+        self.users["frodo"] = make_user("frodo", "shire.irc", "rohan.irc", hostname="bagend")
+        del self.users["frodo"]
+        self.users["gollum"] = make_user("gollum", "mordor.irc", "rohan.irc", hostname=None, realname=None)
+        user = self.users["gollum"]
+        self.assertEqual((user.hostname, user.servername, user.realname), (None, "mordor.irc", None))
+        self.assertEqual(len(self.users.servernames), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()